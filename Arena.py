@@ -56,9 +56,9 @@ class Arena():
         players = [self.player2, None, self.player1]
         arenaCurPlayer = 1
         akCurPlayer = 1
-        board = self.game.getInitBoard()
+        _, valids, ended, _ = self.game.observe(akCurPlayer, m_or_b)
         it = 0
-        while self.game.getGameEnded(board, akCurPlayer, m_or_b) == 0:
+        while ended == 0:
             it += 1
             # if verbose:
             #     assert self.display
@@ -70,13 +70,12 @@ class Arena():
             self.log(f"ARENA GAME {n_game}: TURN {it} PLAYER {arenaCurPlayer} TAKES ACTION!: {action}")
 
             #valids = self.game.getValidMoves(self.game.getCanonicalForm(board, curPlayer, m_or_b), 1)
-            valids = self.game.getValidMoves(None, akCurPlayer, m_or_b)
 
             if valids[action] == 0:
                 log.error(f'Action {action} is not valid!')
                 log.debug(f'valids = {valids}')
                 assert valids[action] > 0
-            board, akCurPlayer = self.game.getNextState(board, akCurPlayer, action, m_or_b, print_to_terminal = False)
+            _, valids, ended, _, akCurPlayer = self.game.step(action, akCurPlayer, m_or_b)
             arenaCurPlayer = 1 if akCurPlayer == 1 else -1
 
         # if verbose:
@@ -84,7 +83,7 @@ class Arena():
         #     print("Game over: Turn ", str(it), "Result ", str(self.game.getGameEnded(board, 1, m_or_b)))
         #     self.display(board)
 
-        return arenaCurPlayer * self.game.getGameEnded(None, akCurPlayer, m_or_b)
+        return arenaCurPlayer * ended
 
     def playGames(self, num):
         """
@@ -10,7 +10,7 @@ import numpy as np
 from tqdm import tqdm
 
 from Arena import Arena
-from MCTS import MCTS
+from MCTS import MCTS, RootParallelPool
 
 log = logging.getLogger(__name__)
 
@@ -27,6 +27,7 @@ class Coach():
         self.pnet = self.nnet.__class__(self.game)  # the competitor network
         self.args = args
         self.mcts = MCTS(self.game, self.nnet, self.args, verbose = verbose, display_time=display_time)
+        self.nnet_onnx = None  # .onnx file with nnet's current weights, for root-parallel workers with args.onnx_workers
         self.trainExamplesHistory = []  # history of examples from args.numItersForTrainExamplesHistory latest iterations
         self.skipFirstSelfPlay = False  # can be overriden in loadTrainExamples()
         self.verbose = verbose
@@ -79,6 +80,24 @@ class Coach():
             with open(self.debug_file_path, 'w') as f:
                 f.write('')
 
+    def root_parallel_pool(self, nnet, onnx_file = None, onnx_filename = 'temp.onnx'):
+        """
+        Root-parallel worker processes for every MCTS searching with nnet's current weights, or None if
+        args.root_parallel_workers isn't over 1. Close it before those weights change.
+
+        With args.onnx_workers the workers predict with onnxruntime (see splendor/OnnxNNet.py) from onnx_file, an .onnx
+        file of nnet's current weights, so they don't need torch. Without one, nnet is exported to
+        checkpoint/onnx_filename first. The pool's onnx_model is the file it uses.
+        """
+        n_workers = self.args.get('root_parallel_workers', 1)
+        if n_workers <= 1:
+            return None
+        if not self.args.get('onnx_workers', False):
+            return RootParallelPool(self.game, nnet, self.args, n_workers)
+        if onnx_file is None:
+            onnx_file = nnet.export_onnx(folder=self.args.checkpoint, filename=onnx_filename)
+        return RootParallelPool(self.game, nnet, self.args, n_workers, onnx_file)
+
     def executeEpisode(self, round_number, game_number, nn_version, new_nn_version = False):
         """
         This function executes one episode of self-play, starting with player 1.
@@ -96,7 +115,6 @@ class Coach():
                            the player eventually won the game, else -1.
         """
         trainExamples = []
-        board = self.game.getInitBoard()
         self.curPlayer = 1
         episodeStep = 0
 
@@ -104,6 +122,7 @@ class Coach():
         m_or_b = 'main'
         # Restart the game
         self.game.reset_main()
+        canonicalBoard, _, _, _ = self.game.observe(self.curPlayer, m_or_b)
 
         # self.log("Coach: Starting a new game of self-play!")
 
@@ -112,8 +131,6 @@ class Coach():
             episodeStep += 1
             time0 = time.time()
 
-            canonicalBoard = self.game.getCanonicalForm(board, self.curPlayer, m_or_b)
-            
             # Get state value before taking action
             _, state_value = self.nnet.predict(canonicalBoard)
 
@@ -126,7 +143,8 @@ class Coach():
             time1 = time.time()
             pi = self.mcts.getActionProb(self.curPlayer, temp=temp)
             time2 = time.time()
-            sym = self.game.getSymmetries(canonicalBoard, pi)
+            # canonicalBoard is a view into the game state, so keep a copy for training
+            sym = self.game.getSymmetries(canonicalBoard.copy(), pi)
             for b, p in sym:
                 trainExamples.append([b, self.curPlayer, p, None])
 
@@ -142,18 +160,16 @@ class Coach():
                 self.log(f"\t***** MCTS (NN V{nn_version} | TURN {episodeStep}): TAKE ACTION! Based on final probs, take action: {action} (p = {round(p_action * 100, 3)}%), state_value = {round(state_value, 3)} *****", print_to_terminal = new_nn_version)
                 self.log(f"\tpi: {', '.join(strs)}")
 
-            board, self.curPlayer = self.game.getNextState(board, self.curPlayer, action, m_or_b, print_to_terminal = new_nn_version)
+            canonicalBoard, _, r, _, self.curPlayer = self.game.step(action, self.curPlayer, m_or_b, print_to_terminal = new_nn_version)
             time3 = time.time()
 
             if episodeStep == 1:
                 self.first_temp = temp
                 self.first_prob_strs = strs
                 self.first_action = action
-                self.first_nn_value = self.nnet.predict(self.game.getCanonicalForm(None, self.curPlayer, m_or_b))
+                self.first_nn_value = self.nnet.predict(canonicalBoard)
                 # self.log(f"NN (next line) on state: {self.game.getCanonicalForm(None, self.curPlayer, m_or_b)}", debug_file_path="./logs/init_state_examples.txt")
 
-            r = self.game.getGameEnded(board, self.curPlayer, m_or_b, print_to_terminal = new_nn_version)
-
             time4 = time.time()
 
             self.times['misc'] += time1 - time0
@@ -164,9 +180,9 @@ class Coach():
             if r == -2:
                 # Game ended on 2 consecutive do-nothings so whoever has the highest score wins
 
-                if self.game.states[m_or_b].scores[self.curPlayer] > self.game.states[m_or_b].scores[3 - self.curPlayer]:
+                if self.game.states[m_or_b].scores[self.curPlayer - 1] > self.game.states[m_or_b].scores[2 - self.curPlayer]:
                     r = 1
-                elif self.game.states[m_or_b].scores[3 - self.curPlayer] > self.game.states[m_or_b].scores[self.curPlayer]:
+                elif self.game.states[m_or_b].scores[2 - self.curPlayer] > self.game.states[m_or_b].scores[self.curPlayer - 1]:
                     r = -1
                 else:
                     return [(x[0], x[2], -1) for x in trainExamples]
@@ -254,6 +270,11 @@ class Coach():
         if not self.skipFirstSelfPlay or num_iter > 1:
             iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
 
+            # Every game of the iteration uses the same network, so root-parallel workers are only started once
+            pool = self.root_parallel_pool(self.nnet, self.nnet_onnx, 'selfplay.onnx')
+            if pool is not None:
+                self.nnet_onnx = pool.onnx_model
+
             for game_num in tqdm(range(self.args.numEps), desc="Self Play"):
                 if self.display_all:
                     self.verbose = True
@@ -266,11 +287,12 @@ class Coach():
                 if self.verbose:
                     self.log(f"##### COACH SELF-PLAY ROUND {num_iter} | NN VERSION {n_accepted} | GAME {game_num} #####")
 
-                self.mcts = MCTS(self.game, self.nnet, self.args, verbose=self.verbose, output = self.output, debug_file_path=self.debug_file_path, display_time=self.display_time)  # reset search tree
+                self.mcts = MCTS(self.game, self.nnet, self.args, verbose=self.verbose, output = self.output, debug_file_path=self.debug_file_path, display_time=self.display_time, pool=pool)  # reset search tree
 
                 # Run an episode of self-play
                 start_time = time.time()
                 currentTrainExamples = self.executeEpisode(round_number=num_iter, game_number=game_num, nn_version=n_accepted, new_nn_version=True)
+                self.mcts.close()
 
                 pi = currentTrainExamples[0][1]
                 r = currentTrainExamples[0][2]
@@ -317,10 +339,16 @@ class Coach():
                     print(self.times)
                     print(self.game.times)
                     print(self.mcts.times)
+                    print(self.mcts.nodes.eviction_stats)
                     self.reset_times()
 
+            if pool is not None:
+                pool.close()
+
             # save the iteration examples to the history
             self.trainExamplesHistory.append(iterationTrainExamples)
+            if getattr(self.nnet, 'eval_cache', None) is not None:
+                log.info('SELF-PLAY EVAL CACHE : %s' % self.nnet.eval_cache.stats())
 
 
         # If too many iterationTrainExamples stored, remove oldest entry in trainExampleshistory
@@ -341,10 +369,14 @@ class Coach():
         # training new network, keeping a copy of the old one
         self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
         self.pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
-        pmcts = MCTS(self.game, self.pnet, self.args, verbose=self.verbose, output = self.output, debug_file_path=self.debug_file_path)
+        ppool = self.root_parallel_pool(self.pnet, self.nnet_onnx, 'temp.onnx')
+        pnet_onnx = self.nnet_onnx if ppool is None else ppool.onnx_model
+        pmcts = MCTS(self.game, self.pnet, self.args, verbose=self.verbose, output = self.output, debug_file_path=self.debug_file_path, pool=ppool)
 
         self.nnet.train(trainExamples)
-        nmcts = MCTS(self.game, self.nnet, self.args, verbose=self.verbose, output = self.output, debug_file_path=self.debug_file_path)
+        self.nnet_onnx = None
+        npool = self.root_parallel_pool(self.nnet, None, 'new.onnx')
+        nmcts = MCTS(self.game, self.nnet, self.args, verbose=self.verbose, output = self.output, debug_file_path=self.debug_file_path, pool=npool)
 
         self.game.reset_main()
 
@@ -359,8 +391,8 @@ class Coach():
                        sorted(policies, key=lambda x: x[1], reverse=True)][:5]
 
         state = np.concatenate(
-            [self.game.states["main"].board, self.game.states['main'].reserved[1], self.game.states["main"].reserved[2],
-             list(self.game.states["main"].perma_gems[1].values()), list(self.game.states["main"].perma_gems[2].values()),
+            [self.game.states["main"].board, self.game.states['main'].reserved[0], self.game.states["main"].reserved[1],
+             self.game.states["main"].perma_gems[0], self.game.states["main"].perma_gems[1],
              [0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 2, 0],
              [0, 0, -1],
              self.game.states["main"].nobles_board
@@ -398,6 +430,14 @@ class Coach():
                       output= self.output,
                       debug_file_path= self.debug_file_path)
         pwins, nwins, draws = arena.playGames(self.args.arenaCompare)
+        pmcts.close()
+        nmcts.close()
+        for pool in [ppool, npool]:
+            if pool is not None:
+                pool.close()
+        log.info('PREV/NEW MCTS EVICTIONS : %s / %s' % (pmcts.nodes.eviction_stats, nmcts.nodes.eviction_stats))
+        if getattr(self.nnet, 'eval_cache', None) is not None:
+            log.info('PREV/NEW EVAL CACHE : %s / %s' % (self.pnet.eval_cache.stats(), self.nnet.eval_cache.stats()))
         
         # Store arena results
         self.arena_results.append((nwins, pwins, draws))
@@ -412,11 +452,17 @@ class Coach():
         if pwins + nwins == 0 or float(nwins) / (pwins + nwins) < self.args.updateThreshold:
             log.info('REJECTING NEW MODEL')
             self.nnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
+            self.nnet_onnx = pnet_onnx
             return False
         else:
             log.info('ACCEPTING NEW MODEL')
             self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(num_iter))
             self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+            # ONNX copy for torch-free root-parallel workers (see splendor/OnnxNNet.py), used from the next self-play on
+            try:
+                self.nnet_onnx = self.nnet.export_onnx(folder=self.args.checkpoint, filename='best.onnx')
+            except Exception as e:
+                log.warning(f"Couldn't export the accepted model to ONNX: {e}")
 
             self.log(f"""######### NN TEST ##############""")
 
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import weakref
+import zlib
+
+import numpy as np
+
+
+class EvalCache():
+    """
+    Network evaluations (policy, value) keyed by 64-bit state keys (game.stringRepresentation), shared by every MCTS
+    that uses the same network.
+
+    Entries are only valid for one set of weights: sync(weights_version) tells the cache which weights this process
+    predicts with, and only entries computed with them are returned. hits / misses count the lookups made in this
+    process.
+
+    By default the cache is a dict holding the capacity most recently used entries, which sync clears once the weights
+    change. With shared=True it's a table in shared memory instead, which worker processes started from this one attach
+    to when the cache is pickled to them (e.g. with the network for root-parallel MCTS). A key there can only go in
+    slot key % capacity and replaces whatever was in it, so it isn't strictly LRU. Each slot keeps the weights version
+    it was computed with, and processes on older weights than the newest one synced don't write. The process that
+    created a shared cache should close() it when done.
+    """
+
+    def __init__(self, action_size, capacity = 2 ** 15, shared = False):
+        self.action_size = action_size
+        self.capacity = capacity
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.shared_size())
+            self.owner = True
+            self.attach_arrays()
+            self.newest_version[:] = 0
+            self.keys[:] = 0
+            self.versions[:] = 0
+            self.finalizer = weakref.finalize(self, close_shared_memory, self.shm, True)
+        else:
+            self.entries = OrderedDict()  # key -> (pi, v), least recently used first
+        self.weights_version = None
+
+    def shared_size(self):
+        # Bytes of the shared table: the newest weights version, then per slot its key, weights version, checksum,
+        # value and policy
+        return 8 + self.capacity * (8 + 8 + 8 + 4 + 4 * self.action_size)
+
+    def attach_arrays(self):
+        buf = self.shm.buf
+        self.newest_version = np.ndarray((1,), dtype=np.uint64, buffer=buf, offset=0)
+        offset = 8
+        for name in ['keys', 'versions', 'checks']:
+            setattr(self, name, np.ndarray((self.capacity,), dtype=np.uint64, buffer=buf, offset=offset))
+            offset += 8 * self.capacity
+        self.values = np.ndarray((self.capacity,), dtype=np.float32, buffer=buf, offset=offset)
+        offset += 4 * self.capacity
+        self.policies = np.ndarray((self.capacity, self.action_size), dtype=np.float32, buffer=buf, offset=offset)
+
+    def __len__(self):
+        if self.shared:
+            return int(np.count_nonzero((self.keys != 0) & (self.versions == self.newest_version[0])))
+        return len(self.entries)
+
+    def sync(self, weights_version):
+        # Predictions in this process now come from weights_version
+        if self.shared:
+            # Entries of other versions are never returned, and are overwritten over time. A process still on older
+            # weights (e.g. a worker of a pool started before training) mustn't clear the newer entries
+            if weights_version > self.newest_version[0]:
+                self.newest_version[0] = weights_version
+        elif self.weights_version != weights_version:
+            self.entries.clear()
+        self.weights_version = weights_version
+
+    def get(self, key):
+        # (pi, v) cached for key with this process's weights, or None
+        if self.shared:
+            slot = key % self.capacity
+            if self.keys[slot] == key and self.versions[slot] == self.weights_version:
+                pi, v, check = self.policies[slot].copy(), self.values[slot], self.checks[slot]
+                # Another process may have been writing the slot while it was copied, or two processes may have
+                # written it at once, so only an entry that matches its checksum is used
+                if check == entry_check(key, self.weights_version, pi, v):
+                    self.hits += 1
+                    return pi, float(v)
+            self.misses += 1
+            return None
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, pi, v):
+        if self.shared:
+            # Key 0 marks an empty slot. Newer weights' entries aren't replaced by ones from older weights
+            if key == 0 or self.weights_version is None or self.weights_version < self.newest_version[0]:
+                return
+            slot = key % self.capacity
+            pi, v = np.asarray(pi, dtype=np.float32), np.float32(v)
+            self.keys[slot] = 0
+            self.versions[slot] = self.weights_version
+            self.policies[slot] = pi
+            self.values[slot] = v
+            self.checks[slot] = entry_check(key, self.weights_version, pi, v)
+            self.keys[slot] = key
+            return
+
+        self.entries[key] = (np.array(pi, dtype=np.float32), float(v))
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self),
+        }
+
+    def close(self):
+        # Detaches from the shared memory, and frees it if this process created it
+        if self.shared:
+            self.finalizer()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared:
+            # Other processes attach to the same shared memory by name
+            for name in ['shm', 'finalizer', 'newest_version', 'keys', 'versions', 'checks', 'values', 'policies']:
+                del state[name]
+            state['shm_name'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('shm_name', None)
+        self.__dict__.update(state)
+        if self.shared:
+            # Worker processes share the resource tracker of the process that started them, which only frees the
+            # memory if the creating process never unlinks it
+            self.shm = shared_memory.SharedMemory(name=shm_name)
+            self.owner = False
+            self.attach_arrays()
+            self.finalizer = weakref.finalize(self, close_shared_memory, self.shm, False)
+
+
+def entry_check(key, weights_version, pi, v):
+    # Checksum of a shared cache entry (pi and v as float32)
+    check = zlib.crc32(np.array([key, weights_version], dtype=np.uint64).tobytes())
+    check = zlib.crc32(np.float32(v).tobytes(), check)
+    return zlib.crc32(pi.tobytes(), check)
+
+
+def close_shared_memory(shm, unlink):
+    shm.close()
+    if unlink:
+        shm.unlink()
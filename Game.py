@@ -46,6 +46,75 @@ class Game():
         """
         pass
 
+    def apply(self, action, player):
+        """
+        Input:
+            action: action taken by current player
+            player: current player
+
+        Plays the action on the game's working state in place.
+
+        Returns:
+            undoToken: an opaque token that undo() uses to take the action back
+        """
+        pass
+
+    def undo(self, undoToken):
+        """
+        Input:
+            undoToken: token returned by apply(). Tokens must be undone in the
+                       reverse order they were created.
+        """
+        pass
+
+    def observe(self, player):
+        """
+        Input:
+            player: player to move
+
+        Returns:
+            canonicalBoard: getCanonicalForm() for player
+            validMoves: getValidMoves() for player
+            ended: getGameEnded() for player
+            stateKey: stringRepresentation() for player
+        """
+        pass
+
+    def step(self, action, player):
+        """
+        Input:
+            action: action taken by current player
+            player: current player
+
+        Plays the action and observes the resulting state in one pass.
+
+        Returns:
+            (canonicalBoard, validMoves, ended, stateKey, nextPlayer), where the
+            first four are observe(nextPlayer)
+        """
+        pass
+
+    def randomOutcomes(self):
+        """
+        Returns:
+            outcomes: number of random outcomes (e.g. hidden cards revealed)
+                      the working state has seen so far. A move that
+                      changes it had a random outcome.
+        """
+        pass
+
+    def endedByScore(self, player):
+        """
+        Input:
+            player: current player (1 or -1)
+
+        Returns:
+            by_score: True if the game has ended on the score, with a result
+                      that wouldn't be different had other hidden cards been
+                      drawn on the last move.
+        """
+        pass
+
     def getValidMoves(self, board, player):
         """
         Input:
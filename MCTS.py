@@ -1,12 +1,22 @@
+import contextlib
+import copy
+import io
 import logging
-import math
+import multiprocessing
+import queue
+import sys
+import threading
 import time
 
 import numpy as np
 import pandas as pd
 
+from NodeTable import NodeTable
+
 EPS = 1e-8
 
+NO_LOCK = contextlib.nullcontext()
+
 log = logging.getLogger(__name__)
 
 def round_to_1(x):
@@ -28,17 +38,16 @@ class MCTS():
     This class handles the MCTS tree.
     """
 
-    def __init__(self, game, nnet, args, verbose = False, output = "file", debug_file_path = None, display_time = False):
+    def __init__(self, game, nnet, args, verbose = False, output = "file", debug_file_path = None, display_time = False, pool = None):
         self.game = game
         self.nnet = nnet
         self.args = args
-        self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
-
-        self.Es = {}  # stores game.getGameEnded ended for board s
-        self.Vs = {}  # stores game.getValidMoves for board s
+        self.nodes = NodeTable()  # stores N(s), and P, N and Q of each valid action, per expanded state s
+        self.undo_tokens = []  # undo tokens of the moves the current simulation played on the branch
+        # Root-parallel worker processes (a RootParallelPool for nnet), started on first use unless one is given
+        self.pool = pool
+        self.owns_pool = False
+        self.tree_workers = []  # tree-parallel searchers sharing this tree, each with its own copy of the game
         self.verbose = verbose
 
         self.output = output
@@ -52,12 +61,10 @@ class MCTS():
 
     def reset_times(self):
         self.times = {
-            'misc1': 0.0,
-            'misc2': 0.0,
+            'select': 0.0,
             'get_next_state': 0.0,
-            'get_game_ended': 0.0,
             'nn': 0.0,
-            'valid': 0.0
+            'backup': 0.0
         }
 
     def log(self, s):
@@ -91,40 +98,18 @@ class MCTS():
 
         action_start_time = time.time()
 
-        # Perform MCTS search numMCTSSims times
-        for i in range(self.args.numMCTSSims):
-            if self.verbose:
-                self.log(f"\n\t########## MCTS: Search iteration {i} #########\n")
-                self.log(f"\t\tMCTS: Reloading new branch")
-
-            self.game.reset_branch()
-            if self.verbose:
-                tabs = "\t\t"
-                canonicalBoard = self.game.getCanonicalForm(None, player, 'branch')
-                # self.log(f"""
-                # {tabs}\t board: {canonicalBoard[:90]}
-                # {tabs}\t reserved 1: {canonicalBoard[90:180]}
-                # {tabs}\t reserved 2: {canonicalBoard[180:270]}
-                # {tabs}\t perma_gems 1:  {canonicalBoard[270:275]}
-                # {tabs}\t perma_gems 2:  {canonicalBoard[275:280]}
-                # {tabs}\t coins 1:  {canonicalBoard[280:286]}
-                # {tabs}\t coins 2:  {canonicalBoard[286:292]}
-                # {tabs}\t score 1:  {canonicalBoard[292]}
-                # {tabs}\t score 2:  {canonicalBoard[293]}
-                # {tabs}\t started_first:  {canonicalBoard[294]}
-                # {tabs}\t nobles:  {canonicalBoard[295:305]}
-                # """)
-
-            self.search(player, depth = 0, did_nothing_last_recursion = False)
-
-
-
-        # On main branch of the game since we're not taking any steps, just displaying things
-        m_or_b = 'main'
-
-        canonicalBoard = self.game.getCanonicalForm(None, player, m_or_b)
-        s = self.game.stringRepresentation(player, m_or_b)
-        counts = [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(self.game.getActionSize())]
+        root_parallel_workers = self.args.get('root_parallel_workers', 1)
+        if root_parallel_workers > 1:
+            # Each worker searches its own sample of the hidden decks and their root visit counts are summed
+            counts = self.root_parallel_visit_counts(player, root_parallel_workers, stop_early = temp == 0,
+                                                     use_proof = temp == 0).tolist()
+        else:
+            if self.args.get('subtree_reuse', True):
+                self.reroot(player)
+            # Only the most visited move matters with temp=0, so the search may stop once it's settled
+            self.run_simulations(player, self.args.numMCTSSims, stop_early = temp == 0)
+            # Training policies (temp=1) keep the visit counts even when the root is proven
+            counts = self.root_visit_counts(player, use_proof = temp == 0).tolist()
 
         if self.display_time:
             print(f"Finding an action took: {round(time.time() - action_start_time, 3)}s")
@@ -143,213 +128,747 @@ class MCTS():
         probs = [x / counts_sum for x in counts]
         return probs
 
-    def search(self, player, depth, did_nothing_last_recursion):
-        """
-        This function performs one iteration of MCTS. It is recursively called
-        till a leaf node is found. The action chosen at each node is one that
-        has the maximum upper confidence bound as in the paper.
-
-        Once a leaf node is found, the neural network is called to return an
-        initial policy P and a value v for the state. This value is propagated
-        up the search path. In case the leaf node is a terminal state, the
-        outcome is propagated up the search path. The values of Ns, Nsa, Qsa are
-        updated.
-
-        NOTE: the return values are the negative of the value of the current
-        state. This is done since v is in [-1,1] and if v is the value of a
-        state for the current player, then its value is -v for the other player.
-
-        Returns:
-            v: the negative of the value of the current canonicalBoard
-        """
-        tabs = '\t\t'
-
-        m_or_b = 'branch'
+    def run_simulations(self, player, n_sims, stop_early = False):
+        # Runs n_sims iterations of MCTS from the main state, leaving the main and branch states as they were
+        # (fewer if stop_early and the most visited root move is settled, see best_move_settled)
+        # Every simulation starts from a copy of the main state and walks back up to it with undo()
+        self.game.reset_branch()
+        self.undo_tokens = []
+
+        # Simulations only change the branch below the root, so observe the root once
+        root_observation = self.game.observe(player, 'branch')
+
+        # Tree size limits are enforced between searches, when no search has a path into the tree
+        max_nodes = self.args.get('max_tree_nodes')
+        max_bytes = self.args.get('max_tree_bytes')
+        limited = max_nodes is not None or max_bytes is not None
+
+        tree_parallel_threads = self.args.get('tree_parallel_threads', 1)
+        if tree_parallel_threads > 1:
+            if limited:
+                self.limit_tree_size(root_observation[3], max_nodes, max_bytes)
+            # Limits are also enforced whenever the threads have no simulation in progress (see run_tree_parallel)
+            self.run_tree_parallel(player, root_observation, n_sims, tree_parallel_threads, stop_early)
+            return
+
+        # Perform MCTS search n_sims times, leaf_batch_size at a time if batching leaf evaluations
+        leaf_batch_size = self.args.get('leaf_batch_size', 1)
+        solver = self.args.get('mcts_solver', False)
+        i = 0
+        while i < n_sims:
+            # Once the root is proven there's nothing left to search
+            if solver and self.is_proven(root_observation[3]):
+                break
+            if stop_early and self.best_move_settled(root_observation[3], n_sims - i):
+                break
 
-        self.log(f"{tabs}##### DEPTH {depth} #####")
+            if self.verbose:
+                self.log(f"\n\t########## MCTS: Search iteration {i} #########\n")
 
-        time0 = time.time()
+            if limited:
+                self.limit_tree_size(root_observation[3], max_nodes, max_bytes)
 
-        if self.verbose and depth > 0:
-            self.game.display_game_state(m_or_b)
+            if leaf_batch_size > 1:
+                i += self.search_batch(player, root_observation, min(leaf_batch_size, n_sims - i))
+            else:
+                self.search(player, root_observation)
+                i += 1
 
-        # Q: why does this function return negative of value of the current state?
-        # A: because it's called recursively by the previous state. That previous state
-        # is associated with the other player, so the value returned to them is the opposite
+    def limit_tree_size(self, root_key, max_nodes, max_bytes):
+        """
+        Evicts nodes once the tree has max_nodes nodes or uses more than
+        max_bytes bytes (either can be None), down to 3/4 of the limit. The
+        root is always kept, args.eviction picks which other nodes stay:
+        'visits' (default) keeps the most visited, 'lru' the most recently
+        visited.
+        """
+        nodes = self.nodes
+        if not self.tree_over_limit(max_nodes, max_bytes):
+            return
+
+        root = nodes.get(root_key)
+        n_nodes = len(nodes)
+        if root == -1:
+            nodes.eviction_stats['evictions'] += 1
+            nodes.eviction_stats['nodes_evicted'] += n_nodes
+            nodes.eviction_stats['bytes_evicted'] += nodes.used_bytes()
+            nodes.clear()
+            return
+
+        nodes.evict(
+            root,
+            max_nodes = None if max_nodes is None else max_nodes * 3 // 4,
+            max_bytes = None if max_bytes is None else max_bytes * 3 // 4,
+            policy = self.args.get('eviction', 'visits')
+        )
+        if self.verbose:
+            self.log(f"\t\tMCTS: evicted {n_nodes - len(nodes)} nodes, {nodes.eviction_stats}")
 
-        # Get canonical board (board from the point of view of this player)
-        canonicalBoard = self.game.getCanonicalForm(None, player, m_or_b)
-        # print(f"canon canon: {canonicalBoard}")
-        # Convert game state to a string
-        s = self.game.stringRepresentation(player, m_or_b)
-        # print(f"stringy ouput: {s}")
+    def tree_over_limit(self, max_nodes, max_bytes):
+        nodes = self.nodes
+        return (max_nodes is not None and len(nodes) >= max_nodes) or (max_bytes is not None and nodes.used_bytes() > max_bytes)
 
-        time1 = time.time()
+    def best_move_settled(self, s, sims_left):
+        """
+        Whether the most visited move of state s is settled: with
+        args.early_stop, once the runner-up can't catch up within sims_left
+        more simulations, and with args.early_stop_z, once the gap between the
+        top two visit counts is early_stop_z standard deviations
+        ((N1 - N2) / sqrt(N1 + N2), as if each visit went to either at random).
+        """
+        early_stop = self.args.get('early_stop', False)
+        early_stop_z = self.args.get('early_stop_z')
+        if not early_stop and early_stop_z is None:
+            return False
+
+        node = self.nodes.get(s)
+        if node == -1:
+            return False
+        if self.nodes.edge_count[node] < 2:
+            # A forced move
+            return True
+
+        visits = self.nodes.edge_visits[self.nodes.edges(node)]
+        second, first = np.partition(visits, -2)[-2:]
+        if early_stop and first - second > sims_left:
+            return True
+        return early_stop_z is not None and first > second and (first - second) / np.sqrt(first + second) >= early_stop_z
+
+    def run_tree_parallel(self, player, observation, n_sims, n_threads, stop_early = False):
+        """
+        Runs n_sims iterations of MCTS with n_threads threads descending this
+        tree together. Each thread plays its moves on its own copy of the game,
+        adds a virtual loss to each edge it takes and puts its leaf on a queue.
+        An evaluator thread takes the queued leaves off in batches of up to
+        leaf_batch_size (default n_threads) for nnet.predict_batch, so tree
+        descents overlap with the network's forward pass, which runs without
+        the GIL. The tree lock is only held to read and update the tree at
+        each node (selecting an edge, expanding, backing up), not while moves
+        are played.
+
+        Once the tree reaches args.max_tree_nodes / args.max_tree_bytes, no
+        new simulation starts until the ones in progress are backed up, so
+        nodes can be evicted without breaking anyone's path.
+        """
+        virtual_loss = self.args.get('virtual_loss', 1)
+        eval_batch_size = self.args.get('leaf_batch_size', n_threads)
+        solver = self.args.get('mcts_solver', False)
+        max_nodes = self.args.get('max_tree_nodes')
+        max_bytes = self.args.get('max_tree_bytes')
+        limited = max_nodes is not None or max_bytes is not None
+
+        # Expand the root first, so threads don't all start by evaluating it
+        if self.nodes.get(observation[3]) == -1 and n_sims > 0:
+            self.search(player, observation)
+            n_sims -= 1
+
+        while len(self.tree_workers) < n_threads:
+            worker = MCTS(copy.deepcopy(self.game), self.nnet, self.args)
+            worker.nodes = self.nodes
+            self.tree_workers.append(worker)
+
+        tree_lock = threading.Lock()
+        drained = threading.Condition(tree_lock)  # notified when no simulation is in progress
+        leaves = queue.Queue()
+        errors = []
+        sims_left = [n_sims]
+        in_progress = [0]
+
+        def evaluate():
+            # Evaluates queued leaves until it takes None off the queue
+            while True:
+                batch = [leaves.get()]
+                while len(batch) < eval_batch_size:
+                    try:
+                        batch.append(leaves.get_nowait())
+                    except queue.Empty:
+                        break
+                requests = [request for request in batch if request is not None]
+
+                if requests:
+                    nn_start_time = time.time()
+                    try:
+                        pis, values = self.nnet.predict_batch(np.array([request['board'] for request in requests]))
+                        for request, pi, value in zip(requests, pis, values):
+                            request['pi'], request['value'] = pi, value
+                    except Exception as e:
+                        for request in requests:
+                            request['error'] = e
+                    self.times['nn'] += time.time() - nn_start_time
+                    for request in requests:
+                        request['done'].set()
+
+                if len(requests) < len(batch):
+                    return
+
+        def start_simulation(observation):
+            # Whether to run one more simulation (called with the tree lock held)
+            while True:
+                if sims_left[0] == 0 or (solver and self.is_proven(observation[3])):
+                    return False
+                # Up to n_threads simulations are still waiting for their leaf's evaluation
+                if stop_early and self.best_move_settled(observation[3], sims_left[0] + n_threads):
+                    return False
+                if limited and self.tree_over_limit(max_nodes, max_bytes):
+                    # Evicting renumbers nodes, so wait until no simulation has a path into the tree
+                    if in_progress[0] > 0:
+                        drained.wait()
+                        continue
+                    self.limit_tree_size(observation[3], max_nodes, max_bytes)
+                sims_left[0] -= 1
+                in_progress[0] += 1
+                return True
+
+        def descend(worker, observation):
+            # Runs simulations on worker's game until all n_sims have been started
+            while True:
+                with tree_lock:
+                    if not start_simulation(observation):
+                        return
+
+                # The virtual loss on each edge taken is added as it's selected, and always taken back
+                path = []
+                try:
+                    path, v, leaf = worker.select_leaf(player, observation, tree_lock, virtual_loss)
+                    worker.undo_moves(len(path))
+                    if leaf is None:
+                        with tree_lock:
+                            worker.update_path(path, v)
+                        continue
+
+                    s, canonicalBoard, valids = leaf
+                    with tree_lock:
+                        evaluation = self.cached_evaluation(s)
+                    if evaluation is None:
+                        request = {'board': canonicalBoard.copy(), 'done': threading.Event()}  # canonicalBoard is a view of the branch
+                        leaves.put(request)
+                        request['done'].wait()
+                        if 'error' in request:
+                            raise request['error']
+                        evaluation = request['pi'], request['value']
+
+                    with tree_lock:
+                        self.cache_evaluation(s, *evaluation)
+                        # Another thread may have expanded the same leaf while this one was waiting
+                        worker.expand(path, s, evaluation[0], valids)
+                        worker.update_path(path, -float(evaluation[1]))
+                finally:
+                    with tree_lock:
+                        self.nodes.add_virtual_loss(path, -virtual_loss)
+                        in_progress[0] -= 1
+                        if in_progress[0] == 0:
+                            drained.notify_all()
+
+        def run_worker(worker, seed):
+            try:
+                worker.game.states['main'].load(self.game.states['main'])
+                worker.game.branch_rng = np.random.default_rng(seed)
+                worker.game.reset_branch()
+                worker.undo_tokens = []
+                descend(worker, worker.game.observe(player, 'branch'))
+            except Exception as e:
+                errors.append(e)
+
+        evaluator = threading.Thread(target=evaluate, daemon=True)
+        evaluator.start()
+        threads = []
+        for worker, seed in zip(self.tree_workers[:n_threads], np.random.randint(2**31, size=n_threads)):
+            threads.append(threading.Thread(target=run_worker, args=(worker, seed), daemon=True))
+            threads[-1].start()
+
+        for thread in threads:
+            thread.join()
+        leaves.put(None)
+        evaluator.join()
+
+        for worker in self.tree_workers[:n_threads]:
+            for name, seconds in worker.times.items():
+                self.times[name] += seconds
+            worker.reset_times()
+
+        if errors:
+            raise errors[0]
+
+    def reroot(self, player):
+        """
+        Makes the main state the root of the tree: its statistics from earlier
+        searches are kept, along with everything reachable from it, and all
+        other nodes (earlier positions, card draws that didn't happen) are
+        dropped so the tree doesn't keep growing over a game.
+        """
+        root = self.nodes.get(self.game.stringRepresentation(player, 'main'))
+        if root == -1:
+            self.nodes.clear()
+        else:
+            self.nodes.keep_subtree(root)
 
-        self.game.set_current_valid_moves(player, m_or_b)
+    def is_proven(self, s):
+        # Whether the MCTS-solver has proven the result of state s
+        node = self.nodes.get(s)
+        return node != -1 and bool(self.nodes.node_solved[node])
 
-        time2 = time.time()
+    def root_visit_counts(self, player, use_proof = False):
+        """
+        N(s,a) of the main state over the whole action space (all zeros if it
+        hasn't been expanded). With use_proof, if the solver has proven the
+        main state, its visits are spread evenly over the moves that get the
+        proven result.
+        """
+        nodes = self.nodes
+        root = nodes.get(self.game.stringRepresentation(player, 'main'))
+        if root == -1:
+            return np.zeros(self.game.getActionSize(), dtype=np.float32)
+        counts = nodes.action_visits(root, self.game.getActionSize())
+
+        if use_proof and self.args.get('mcts_solver', False) and nodes.node_solved[root]:
+            edges = nodes.edges(root)
+            best = nodes.edge_solved[edges] & (nodes.edge_proof[edges] == nodes.node_proof[root])
+            best_actions = nodes.edge_action[edges][best]
+            total = max(counts.sum(), 1)
+            counts[:] = 0
+            counts[best_actions] = total / len(best_actions)
+        return counts
+
+    def root_parallel_visit_counts(self, player, n_workers, stop_early = False, use_proof = False):
+        """
+        Splits numMCTSSims over n_workers processes (the given pool's workers
+        if there is one). Every worker builds a fresh tree from the main state,
+        drawing its own sample of the hidden decks on the branch, and the root
+        visit counts of all of them are summed. stop_early and use_proof are
+        applied by each worker to its own tree (see run_simulations and
+        root_visit_counts).
+        """
+        if self.pool is None:
+            onnx_model = None
+            if self.args.get('onnx_workers', False):
+                model = io.BytesIO()
+                self.nnet.export_onnx(model)
+                onnx_model = model.getvalue()
+            self.pool = RootParallelPool(self.game, self.nnet, self.args, n_workers, onnx_model)
+            self.owns_pool = True
+        n_workers = self.pool.n_workers
+
+        # Spread the simulations as evenly as possible, with a different deck seed per worker
+        n_sims = [self.args.numMCTSSims // n_workers + (i < self.args.numMCTSSims % n_workers) for i in range(n_workers)]
+        seeds = np.random.randint(2**31, size=n_workers)
+        main_buffer = self.game.states['main'].buffer
+        jobs = [(main_buffer, player, n, seed, stop_early, use_proof) for n, seed in zip(n_sims, seeds) if n > 0]
+
+        return np.sum(self.pool.map(jobs), axis=0)
+
+    def close(self):
+        # Shuts down the root-parallel worker processes, if this MCTS started them
+        if self.owns_pool and self.pool is not None:
+            self.pool.close()
+            self.pool = None
+            self.owns_pool = False
+
+    def uct_string(self, a, Q, P, Ns, Nsa, u):
+        # Debug description of one edge in the UCT selection (only built when verbose)
+        if Nsa > 0:
+            return f"({a}, Q:{round_to_3(Q)}, Ps:{round_to_3(P)}, Ns:{round_to_1(Ns)}, Nsa:{round_to_1(Nsa)}, u:{round_to_3(u)})"
+        return f"({a}, Q:none, Ps:{round_to_3(P)}, Ns:{round_to_1(Ns)}, u:{round_to_3(u)})"
+
+    def search(self, player, observation):
+        """
+        This function performs one iteration of MCTS. It walks down the tree
+        from the root, picking the action with the maximum upper confidence
+        bound at each node as in the paper, until it reaches a leaf.
 
-        # See if we had consecutive do nothings
-        if self.game.states[m_or_b].consecutive_do_nothings >= 2:
-            return -1
+        Once a leaf node is found, the neural network is called to return an
+        initial policy P and a value v for the state. This value is propagated
+        back up the stored search path. In case the leaf node is a terminal
+        state, the outcome is propagated up the search path. The values of Ns,
+        Nsa, Qsa are updated.
 
-        # Check if we know whether s is a terminal state
-        if s not in self.Es:
-            # If we don't know, then figure out if s is a terminal state
-            self.Es[s] = self.game.getGameEnded(None, player, m_or_b)
-        # If s is a terminal state, get the value (+1 if win or -1 if lost)
-        if self.Es[s] != 0:
-            self.log(f"{tabs}MCTS: s is terminal")
-            # Return negative of the value (see above for explanation)
-            return -self.Es[s]
+        Moves are played on the 'branch' state with game.step() and taken back
+        with game.undo() on the way up, so the branch is unchanged on return.
+        observation is what game.observe() returned for the root.
 
-        time3 = time.time()
+        NOTE: the return values are the negative of the value of the current
+        state. This is done since v is in [-1,1] and if v is the value of a
+        state for the current player, then its value is -v for the other player.
 
-        # Do we have an NN-returned policy calculated for this tree
-        if s not in self.Ps:
-            self.log(f"{tabs}MCTS: Don't have an NN-policy for s so calculating now")
-            # self.log(f"canonicalForm: {canonicalBoard}")
-            # self.log(f"s: {s}")
-                # print(f"stringy ouput 2: {s}")
+        Returns:
+            v: the negative of the value of the root
+        """
+        path, v, leaf = self.select_leaf(player, observation)
 
-                # for s in self.Ps:
-                #     print(f"{tabs}\t key: {s}")
+        if leaf is not None:
             # We don't have a policy calculated (means it's a leaf node since we haven't explored down here yet for this tree)
-            nn_start_time = time.time()
-            # Calculate NN policy (probabilities assigned to actions based on goodness)
-            self.Ps[s], v = self.nnet.predict(canonicalBoard)
-            # self.log(f"NN output: {self.Ps[s]}")
-
-            self.times['nn'] += time.time()  - nn_start_time
-
-            # Valid moves for this state (canonicalBoard means just from the point of view of the current player, so "player" is just 1)
-            valids = self.game.current_valid_moves
-            # print(f"DEBUG 4: {valids}")
-
-            # Only take the probabilities for the valid moves
-            self.Ps[s] = self.Ps[s] * valids  # masking invalid moves
-
-            # Renormalize
-            sum_Ps_s = np.sum(self.Ps[s])
-            if sum_Ps_s > 0:
-                self.Ps[s] /= sum_Ps_s  # renormalize
+            s, canonicalBoard, valids = leaf
+            evaluation = self.cached_evaluation(s)
+            if evaluation is None:
+                nn_start_time = time.time()
+                # Calculate NN policy (probabilities assigned to actions based on goodness)
+                pi, value = self.nnet.predict(canonicalBoard)
+                self.times['nn'] += time.time() - nn_start_time
+                self.cache_evaluation(s, pi, value)
             else:
-                # if all valid moves were masked make all valid moves equally probable
+                pi, value = evaluation
 
-                # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've gotten overfitting or something else.
-                # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.   
-                log.error("All valid moves were masked, doing a workaround.")
-                self.Ps[s] = self.Ps[s] + valids
-                self.Ps[s] /= np.sum(self.Ps[s])
-            # print(f"stringy ouput 3: {s}")
+            self.expand(path, s, pi, valids)
+            if self.verbose:
+                self.log(f"\t\tMCTS: NN returns value {value} so MCTS returns {-value}")
+            v = -value
 
-            # Store valid moves per state
-            self.Vs[s] = valids
-            # print(f"STORING for player {player}, {m_or_b}")
-            # print(f"KEY: {s}")
+        return self.backup(path, v)
 
-            # print(f"CANONICAL: {canonicalBoard}")
-            # print(f"STORED: {self.Vs[s]}")
+    def search_batch(self, player, observation, batch_size):
+        """
+        Runs up to batch_size iterations of MCTS whose leaves are evaluated by
+        the network together in one nnet.predict_batch call.
 
-            # Initialize N at 0 because this is the first time we're seeing this state for this tree
-            # (will get incremented to 1 later in this iteration)
-            self.Ns[s] = 0
-            self.log(f"{tabs}MCTS: NN returns value {v} so MCTS returns {-v}")
-            return -v
+        Each descent adds a virtual loss to the edges it took, so the next ones
+        spread out over other lines, and its moves are taken back right away.
+        Collecting stops early when a descent reaches a leaf that's already
+        waiting for evaluation. Terminal leaves are backed up immediately.
 
-        self.log(f"{tabs}MCTS: already have NN-policy ")
+        Returns:
+            the number of iterations run
+        """
+        virtual_loss = self.args.get('virtual_loss', 1)
+        pending = []  # (path, s, valids) of the leaves waiting for the network
+        boards = []
+        pending_keys = set()
+        n_searches = 0
+
+        while n_searches < batch_size:
+            path, v, leaf = self.select_leaf(player, observation)
+
+            if leaf is None:
+                self.backup(path, v)
+                n_searches += 1
+                continue
+
+            self.undo_moves(len(path))
+            s, canonicalBoard, valids = leaf
+            if s in pending_keys:
+                break
+
+            evaluation = self.cached_evaluation(s)
+            if evaluation is not None:
+                self.expand(path, s, evaluation[0], valids)
+                self.update_path(path, -float(evaluation[1]))
+                n_searches += 1
+                continue
+
+            self.nodes.add_virtual_loss(path, virtual_loss)
+            pending.append((path, s, valids))
+            boards.append(canonicalBoard.copy())  # canonicalBoard is a view of the branch
+            pending_keys.add(s)
+            n_searches += 1
+
+        if pending:
+            nn_start_time = time.time()
+            pis, values = self.nnet.predict_batch(np.array(boards))
+            self.times['nn'] += time.time() - nn_start_time
+
+            for (path, s, valids), pi, value in zip(pending, pis, values):
+                self.cache_evaluation(s, pi, value)
+                self.nodes.add_virtual_loss(path, -virtual_loss)
+                self.expand(path, s, pi, valids)
+                self.update_path(path, -float(value))
+
+        return n_searches
+
+    def cached_evaluation(self, s):
+        # The network's (pi, v) for state key s from its evaluation cache (EvalCache.py), or None
+        cache = getattr(self.nnet, 'eval_cache', None)
+        if cache is None:
+            return None
+        cache.sync(self.nnet.weights_version)
+        return cache.get(s)
+
+    def cache_evaluation(self, s, pi, value):
+        cache = getattr(self.nnet, 'eval_cache', None)
+        if cache is not None:
+            cache.put(s, pi, value)
+
+    def select_leaf(self, player, observation, tree_lock = None, virtual_loss = 0):
+        """
+        Walks down from the state described by observation, playing the UCT
+        action of each expanded node on the branch, until it reaches a state
+        that isn't expanded yet or ends the game.
 
-        valids = self.Vs[s]
+        With tree parallelism, the tree is only read and changed under
+        tree_lock, one node at a time, and virtual_loss is added to each edge
+        as it's selected (the caller takes it back from the returned path).
 
-        if np.sum(valids) > 1:
-            # 213
-            valids[self.game.n_actions - 1] = 0
-        # print(f"DEBUG 6 for player{player} and {m_or_b}: {valids}")
+        Returns:
+            path: the (node, edge) pairs taken, root first
+            v: the value of the last state for the player who moved into it
+               (only meaningful when leaf is None)
+            leaf: (s, canonicalBoard, valids) of the state to expand, or None
+                  if the walk ended on a terminal state
+        """
+        start_time = time.time()
+        m_or_b = 'branch'
+        nodes = self.nodes
+        solver = self.args.get('mcts_solver', False)
+        path = []
+        did_nothing_last = False
+        lock = NO_LOCK if tree_lock is None else tree_lock
 
-        cur_best = -float('inf')
-        best_act = -1
+        while True:
+            if self.verbose:
+                self.log(f"\t\t##### DEPTH {len(path)} #####")
+                if path:
+                    self.game.display_game_state(m_or_b)
+
+            # Canonical board (board from the point of view of this player), valid moves, game ended value and state key
+            canonicalBoard, valids, ended, s = observation
+
+            # See if we had consecutive do nothings
+            if self.game.states[m_or_b].consecutive_do_nothings >= 2:
+                v, leaf = -1, None
+                break
+
+            with lock:
+                node = nodes.get(s)
+
+                # Terminal states are stored as nodes without edges
+                if node == -1 and ended != 0:
+                    node = nodes.add(s, ended = ended, ended_by_score = solver and self.game.endedByScore(player, m_or_b))
+                if path and node != -1:
+                    nodes.link(path[-1][1], node)
+                # If s is a terminal state, get the value (+1 if win or -1 if lost)
+                if node != -1 and nodes.node_ended[node] != 0:
+                    if self.verbose:
+                        self.log(f"\t\tMCTS: s is terminal")
+                    # Return negative of the value (see above for explanation)
+                    v, leaf = -float(nodes.node_ended[node]), None
+                    break
+                # A proven node's result is known, so it's backed up like a terminal state's
+                if solver and node != -1 and nodes.node_solved[node]:
+                    v, leaf = -float(nodes.node_proof[node]), None
+                    break
+
+                # Do we have an NN-returned policy calculated for this tree
+                if node == -1:
+                    if self.verbose:
+                        self.log(f"\t\tMCTS: Don't have an NN-policy for s so calculating now")
+                    v, leaf = 0, (s, canonicalBoard, valids)
+                    break
+
+                edge = self.select_edge(node, player)
+                a = int(nodes.edge_action[edge])
+                if virtual_loss:
+                    nodes.add_virtual_loss(((node, edge),), virtual_loss)
+
+            step_start_time = time.time()
+            if solver:
+                random_outcomes = self.game.randomOutcomes(m_or_b)
+            *observation, player = self.game.step(a, player, m_or_b, undo_tokens = self.undo_tokens)
+            if solver and self.game.randomOutcomes(m_or_b) != random_outcomes:
+                with lock:
+                    nodes.edge_chance[edge] = True
+            self.times['get_next_state'] += time.time() - step_start_time
+
+            # Two do nothings in a row end the game as a loss for whoever did nothing last
+            if a == self.game.n_actions - 1:
+                if did_nothing_last:
+                    self.game.undo(self.undo_tokens.pop())
+                    if virtual_loss:
+                        with lock:
+                            nodes.add_virtual_loss(((node, edge),), -virtual_loss)
+                    v, leaf = -1, None
+                    break
+                did_nothing_last = True
+            else:
+                did_nothing_last = False
 
-        # self.log(f"{tabs}MCTS: these are the valid moves")
+            path.append((node, edge))
 
-        time4 = time.time()
+        self.times['select'] += time.time() - start_time
+        return path, v, leaf
 
+    def select_edge(self, node, player):
+        # The edge of node with the highest upper confidence bound
         if self.verbose:
-            self.game.display_valid_moves(player, m_or_b)
-
-        # pick the action with the highest upper confidence bound
-
-        strs = []
-        us = np.ones(self.game.getActionSize()) * -99
-        # print(f"VALIDS: {valids}")
-        for a in range(self.game.getActionSize()):
-            if valids[a]:
-                if (s, a) in self.Qsa:
-                    us[a] = self.Qsa[(s, a)] + self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
-                            1 + self.Nsa[(s, a)])
-
-                    strs.append(
-                        f"({a}, Q:{round_to_3(self.Qsa[(s, a)])}, Ps:{round_to_3(self.Ps[s][a])}, Ns:{round_to_1(self.Ns[s])}, Nsa:{round_to_1(self.Nsa[(s, a)])}, u:{round_to_3(us[a])})")
-
-                else:
-                    us[a] = self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
-
-                    strs.append(
-                        f"({a}, Q:none, Ps:{round_to_3(self.Ps[s][a])}, Ns:{round_to_1(self.Ns[s])}, u:{round_to_3(us[a])})")
-
-
-        time5 = time.time()
-
-        # Find the maximum value in the array
-        max_val = np.max(us)
-        assert max_val != -99, "Max value is still -99"
-
-        # Find the indices with the maximum value
-        max_indices = np.where(us == max_val)[0]
-
-        # Randomly select one best act
-        best_act = np.random.choice(max_indices)
+            self.log(f"\t\tMCTS: already have NN-policy ")
+            self.game.display_valid_moves(player, 'branch')
+
+        # pick the action with the highest upper confidence bound, over all of the node's edges at once
+        nodes = self.nodes
+        Ns = nodes.node_visits[node]
+        edges = nodes.edges(node)
+        Ps = nodes.edge_prior[edges]
+        Nsa = nodes.edge_visits[edges]
+        Qsa = nodes.edge_value[edges]
+
+        # Searches still waiting for their leaf's evaluation count as visits that lost
+        if nodes.node_virtual[node] > 0:
+            virtual = nodes.edge_virtual[edges]
+            Ns = Ns + nodes.node_virtual[node]
+            Qsa = (Nsa * Qsa - virtual) / np.maximum(Nsa + virtual, 1)
+            Nsa = Nsa + virtual
+
+        # Unvisited edges count as Q = 0 with sqrt(N(s) + EPS)
+        us = np.where(
+            Nsa > 0,
+            Qsa + self.args.cpuct * Ps * np.sqrt(Ns) / (1 + Nsa),
+            self.args.cpuct * Ps * np.sqrt(Ns + EPS)
+        )
+
+        # Never pick a move that's proven to lose (an unsolved node always has an edge that isn't)
+        if self.args.get('mcts_solver', False):
+            us[nodes.edge_solved[edges] & (nodes.edge_proof[edges] == -1)] = -np.inf
+
+        # Randomly select one of the best edges
+        best_edges = np.flatnonzero(us == us.max())
+        best_edge = edges.start + (best_edges[0] if len(best_edges) == 1 else np.random.choice(best_edges))
 
-        self.log(f"{tabs}MCTS UCT: {', '.join(strs)}")
-        self.log(f"{tabs}Taking best action by UCT: {best_act}, leading to new state:")
-
-        a = best_act
-        next_s, next_player = self.game.getNextState(None, player, a, m_or_b, print_to_terminal = False)
-        next_s = self.game.getCanonicalForm(next_s, next_player, m_or_b)
-
-        if a == self.game.n_actions - 1:
-            if did_nothing_last_recursion:
-                return -1
-            else:
-                did_nothing_last_recursion = True
+        if self.verbose:
+            actions = nodes.edge_action[edges]
+            strs = [self.uct_string(actions[i], Qsa[i], Ps[i], Ns, Nsa[i], us[i]) for i in range(len(us))]
+            self.log(f"\t\tMCTS UCT: {', '.join(strs)}")
+            self.log(f"\t\tTaking best action by UCT: {nodes.edge_action[best_edge]}, leading to new state:")
+
+        return best_edge
+
+    def expand(self, path, s, pi, valids):
+        # Adds the leaf s at the end of path (unless another search already has) and links path's last edge to it
+        node = self.nodes.get(s)
+        if node == -1:
+            node = self.add_node(s, pi, valids)
+        if path:
+            self.nodes.link(path[-1][1], node)
+        return node
+
+    def add_node(self, s, pi, valids):
+        # Expands s with the network's policy pi
+        # Only take the probabilities for the valid moves
+        Ps = pi * valids  # masking invalid moves
+
+        # Renormalize
+        sum_Ps_s = np.sum(Ps)
+        if sum_Ps_s > 0:
+            Ps /= sum_Ps_s  # renormalize
         else:
-            did_nothing_last_recursion = False
+            # if all valid moves were masked make all valid moves equally probable
 
-        time6 = time.time()
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've gotten overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.   
+            log.error("All valid moves were masked, doing a workaround.")
+            Ps = Ps + valids
+            Ps /= np.sum(Ps)
 
-        self.times['misc1'] += (time1 - time0)
-        self.times['misc2'] += (time5 - time4)
-        self.times['get_next_state'] += time6 - time5
-        self.times['get_game_ended'] += time3 - time2
-        self.times['valid'] += time2 - time1
+        # Store an edge per valid move. Doing nothing is only searched when it's the only valid move
+        # (its share of the prior isn't handed to the other moves)
+        actions = np.where(valids)[0]
+        if len(actions) > 1:
+            actions = actions[actions != self.game.n_actions - 1]
 
+        # N(s) starts at 0 because this is the first time we're seeing this state for this tree
+        # (will get incremented to 1 later in this iteration)
+        return self.nodes.add(s, actions, Ps[actions])
 
-        # Recurrence
-        # This will call search for the next child down. For now, this particular search call is paused here.
-        # There will be a chain of unfinished "search" calls all the way down the tree
-        # Finally when it gets to a leaf node, a value v will be returned. Then we can go back up the tree and
-        # execute the next code
-        v = self.search(next_player, depth + 1, did_nothing_last_recursion=did_nothing_last_recursion)
+    def backup(self, path, v):
+        """
+        Walks path back up to its root, taking back each move on the branch
+        and updating the statistics of its edge. v is the value of the state
+        at the end of path for the player who moved into it; returns the value
+        of the root for the player who moved into it.
+        """
+        self.undo_moves(len(path))
+        return self.update_path(path, v)
+
+    def undo_moves(self, n_moves):
+        # Take back the last n_moves moves played on the branch
+        for _ in range(n_moves):
+            self.game.undo(self.undo_tokens.pop())
+
+    def update_path(self, path, v):
+        # Adds the value v of the state at the end of path to the statistics of path's edges, flipping its sign
+        # at every level, and returns the value of the root for the player who moved into it
+        start_time = time.time()
+        nodes = self.nodes
+
+        for node, edge in reversed(path):
+            # Update the running mean of Q (the first visit just sets Q = v)
+            n = nodes.edge_visits[edge]
+            nodes.edge_value[edge] = (n * nodes.edge_value[edge] + v) / (n + 1)
+            nodes.edge_visits[edge] = n + 1
+            nodes.node_visits[node] += 1
+            nodes.node_last_visit[node] = nodes.clock
+
+            v = -v
+
+        nodes.clock += 1
+        if self.args.get('mcts_solver', False):
+            nodes.update_proofs(path)
+        self.times['backup'] += time.time() - start_time
+        return v
+
+
+class RootParallelPool():
+    """
+    Worker processes for root-parallel MCTS (args.root_parallel_workers), each with its own copy of the game and of
+    nnet's current weights. Starting them means a fresh interpreter per worker, so start one pool per network version
+    and give it to every MCTS searching with that network (e.g. all the self-play games of an iteration). close() shuts
+    the workers down.
+
+    If onnx_model is given (an .onnx file of nnet's weights from NNetWrapper.export_onnx, or its bytes), workers
+    predict with an OnnxNNetWrapper on it instead of a copy of nnet, so they don't need torch. Workers are spawned and
+    re-import the parent's __main__ module, so they only start without torch (faster, and with less memory each) if
+    that module doesn't import it at the top (main.py imports splendor.NNet inside main()). They still share nnet's
+    evaluation cache if it's in shared memory.
+
+    Workers build a fresh tree for every move, so subtree reuse (args.subtree_reuse) doesn't apply.
+    """
 
-        # If we've seen this state-action pair in the Q matrix, update the value
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
-            self.Nsa[(s, a)] += 1
-        # If we haven't seen, then just make Q = v
+    def __init__(self, game, nnet, args, n_workers, onnx_model = None):
+        self.n_workers = n_workers
+        self.onnx_model = onnx_model
+        # Workers get their own copy of the game and network once, with root parallelism turned off
+        worker_args = type(args)(args)
+        worker_args['root_parallel_workers'] = 1
+        if onnx_model is None:
+            initargs = (game, nnet, worker_args)
         else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
-
-        self.Ns[s] += 1
-
-        return -v
+            initargs = (game, None, worker_args, onnx_model, getattr(nnet, 'eval_cache', None),
+                        getattr(nnet, 'weights_version', 1))
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(n_workers, initializer=_init_root_parallel_worker, initargs=initargs)
+        if args.get('subtree_reuse', True):
+            log.info("Root-parallel workers search a fresh tree for every move, subtree reuse is off")
+
+    def map(self, jobs):
+        # Root visit counts of each job (see _root_parallel_search)
+        return self.pool.map(_root_parallel_search, jobs)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+# Root-parallel search workers. Each worker process keeps the game, network and args it was started with.
+_worker = {}
+
+def _init_root_parallel_worker(game, nnet, args, onnx_model = None, eval_cache = None, weights_version = 1):
+    # One search per process, so keep torch (or onnxruntime) from spreading every forward pass over all the cores
+    if onnx_model is not None:
+        from splendor.OnnxNNet import OnnxNNetWrapper
+        nnet = OnnxNNetWrapper(game, onnx_model, n_threads = 1)
+        nnet.eval_cache = eval_cache
+        nnet.weights_version = weights_version
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(1)
+    _worker['game'] = game
+    _worker['nnet'] = nnet
+    _worker['args'] = args
+
+def _root_parallel_search(job):
+    # Searches n_sims simulations from the given main state with a fresh tree and returns the root visit counts
+    main_buffer, player, n_sims, seed, stop_early, use_proof = job
+    game = _worker['game']
+    game.states['main'].buffer[:] = main_buffer
+
+    # The seed picks this worker's sample of the hidden decks (and its tie breaks)
+    np.random.seed(seed)
+    game.branch_rng = np.random.default_rng(seed)
+
+    mcts = MCTS(game, _worker['nnet'], _worker['args'])
+    mcts.run_simulations(player, n_sims, stop_early)
+    return mcts.root_visit_counts(player, use_proof)
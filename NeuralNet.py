@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class NeuralNet():
     """
     This class specifies the base NeuralNet class. To define your own neural
@@ -36,6 +39,24 @@ class NeuralNet():
         """
         pass
 
+    def predict_batch(self, boards):
+        """
+        Input:
+            boards: a numpy array of shape (batch size, board size) of boards
+                    in their canonical form, of any integer dtype.
+
+        Returns:
+            pis: a float32 array of shape (batch size, game.getActionSize) with
+                 the policy of each board
+            vs: a float32 array of shape (batch size,) with the value of each
+                board
+
+        Used by the batched and parallel MCTS modes. This default just calls
+        predict() on each board; override it to evaluate them together.
+        """
+        pis, vs = zip(*[self.predict(board) for board in boards])
+        return np.array(pis, dtype=np.float32), np.array(vs, dtype=np.float32)
+
     def save_checkpoint(self, folder, filename):
         """
         Saves the current neural network (with its parameters) in
@@ -0,0 +1,299 @@
+import heapq
+
+import numpy as np
+
+
+class NodeTable():
+    """
+    Search statistics of every expanded state, stored in flat arrays instead of per-(s, a) dicts.
+
+    Each state key gets an integer node id. A node's legal actions are stored as a contiguous run of edges
+    (edge_start[node] to edge_start[node] + edge_count[node]) in the edge arrays, which hold the action, its prior
+    P(s,a), visit count N(s,a) and mean value Q(s,a). Terminal states are nodes with no edges and a nonzero ended value.
+    node_virtual / edge_virtual count the virtual losses of searches that are still waiting for their leaf's evaluation.
+
+    edge_child is the node a search reached by taking the edge. Card draws can lead one edge to several nodes, and the
+    ones after the first are kept in extra_children. These links are only used to find the subtree under a new root
+    and the nodes an eviction leaves unreachable. node_last_visit is the clock value of the last search through a node.
+
+    For the MCTS-solver, node_solved / node_proof mark nodes whose result is proven (+1 win, -1 loss, 0 draw for the
+    player to move) and edge_solved / edge_proof the same for the player taking the edge. edge_chance marks edges whose
+    move drew a card, so their child depends on the draw. node_ended_by_score marks terminal states where the game ended
+    on the target score, whichever cards were drawn (see Game.endedByScore).
+    """
+
+    # Arrays indexed by node id (besides edge_start, which compact() rebuilds) and by edge id
+    node_arrays = ['node_visits', 'node_ended', 'node_virtual', 'node_last_visit', 'node_solved', 'node_proof',
+                   'node_ended_by_score', 'edge_count']
+    edge_arrays = ['edge_action', 'edge_prior', 'edge_visits', 'edge_value', 'edge_virtual', 'edge_child',
+                   'edge_solved', 'edge_proof', 'edge_chance']
+
+    def __init__(self, node_capacity = 1024, edge_capacity = 16384):
+        self.node_ids = {}  # state key -> node id
+        self.node_keys = []  # node id -> state key
+        self.extra_children = {}  # edge id -> set of the other nodes it led to
+
+        # Indexed by node id
+        self.node_visits = np.zeros(node_capacity, dtype=np.float32)  # N(s)
+        self.node_ended = np.zeros(node_capacity, dtype=np.float32)  # game ended value of s (0 if not terminal)
+        self.node_virtual = np.zeros(node_capacity, dtype=np.float32)
+        self.node_last_visit = np.zeros(node_capacity, dtype=np.int64)
+        self.node_solved = np.zeros(node_capacity, dtype=bool)
+        self.node_proof = np.zeros(node_capacity, dtype=np.float32)
+        self.node_ended_by_score = np.zeros(node_capacity, dtype=bool)
+        self.edge_start = np.zeros(node_capacity, dtype=np.int64)
+        self.edge_count = np.zeros(node_capacity, dtype=np.int32)
+
+        # Indexed by edge id
+        self.edge_action = np.zeros(edge_capacity, dtype=np.int32)
+        self.edge_prior = np.zeros(edge_capacity, dtype=np.float32)
+        self.edge_visits = np.zeros(edge_capacity, dtype=np.float32)
+        self.edge_value = np.zeros(edge_capacity, dtype=np.float32)
+        self.edge_virtual = np.zeros(edge_capacity, dtype=np.float32)
+        self.edge_child = np.full(edge_capacity, -1, dtype=np.int32)
+        self.edge_solved = np.zeros(edge_capacity, dtype=bool)
+        self.edge_proof = np.zeros(edge_capacity, dtype=np.float32)
+        self.edge_chance = np.zeros(edge_capacity, dtype=bool)
+
+        self.n_nodes = 0
+        self.n_edges = 0
+        self.clock = 0  # number of finished searches, for node_last_visit
+
+        # Bytes of one row of the node arrays and of the edge arrays
+        self.node_row_bytes = sum(getattr(self, name).itemsize for name in self.node_arrays + ['edge_start'])
+        self.edge_row_bytes = sum(getattr(self, name).itemsize for name in self.edge_arrays)
+        self.eviction_stats = {'evictions': 0, 'nodes_evicted': 0, 'bytes_evicted': 0}
+
+    def __len__(self):
+        return self.n_nodes
+
+    def __contains__(self, key):
+        return key in self.node_ids
+
+    def get(self, key):
+        # Node id of the state key, or -1 if it hasn't been added
+        return self.node_ids.get(key, -1)
+
+    def add(self, key, actions = (), priors = (), ended = 0, ended_by_score = False):
+        """Adds a node for state key with an edge per action (and its prior) and returns its id."""
+        n_new_edges = len(actions)
+        if self.n_nodes == len(self.node_visits):
+            self.grow_nodes()
+        while self.n_edges + n_new_edges > len(self.edge_action):
+            self.grow_edges()
+
+        node = self.n_nodes
+        start = self.n_edges
+        self.node_ids[key] = node
+        self.node_keys.append(key)
+        self.node_visits[node] = 0
+        self.node_ended[node] = ended
+        self.node_virtual[node] = 0
+        self.node_last_visit[node] = self.clock
+        # Terminal states are proven (a game ended value of -2 is a draw)
+        self.node_solved[node] = ended != 0
+        self.node_proof[node] = ended if abs(ended) == 1 else 0
+        self.node_ended_by_score[node] = ended_by_score
+        self.edge_start[node] = start
+        self.edge_count[node] = n_new_edges
+
+        end = start + n_new_edges
+        self.edge_action[start:end] = actions
+        self.edge_prior[start:end] = priors
+        self.edge_visits[start:end] = 0
+        self.edge_value[start:end] = 0
+        self.edge_virtual[start:end] = 0
+        self.edge_child[start:end] = -1
+        self.edge_solved[start:end] = False
+        self.edge_chance[start:end] = False
+
+        self.n_nodes += 1
+        self.n_edges = end
+        return node
+
+    def edges(self, node):
+        # Slice of the node's edges in the edge arrays
+        start = self.edge_start[node]
+        return slice(start, start + self.edge_count[node])
+
+    def action_visits(self, node, n_actions):
+        # N(s,a) over the whole action space
+        counts = np.zeros(n_actions, dtype=np.float32)
+        edges = self.edges(node)
+        counts[self.edge_action[edges]] = self.edge_visits[edges]
+        return counts
+
+    def update_proofs(self, path):
+        """
+        Proves what can be proven along path (from the root, its last edge leading to the searched node) with minimax
+        rules, bottom up: a node is a win if one of its edges is, and otherwise proven once all of its edges are, with
+        the best of their results. An edge gets its child's result unless its move drew a card and the game didn't end
+        on the target score there: any other result could have been different with another card (e.g. having no valid
+        moves depends on the cards on the board).
+        """
+        for node, edge in reversed(path):
+            if self.node_solved[node]:
+                return
+            child = self.edge_child[edge]
+            if child == -1 or not self.node_solved[child] or (self.edge_chance[edge] and not self.node_ended_by_score[child]):
+                return
+
+            self.edge_solved[edge] = True
+            self.edge_proof[edge] = -self.node_proof[child]
+            if self.edge_proof[edge] == 1:
+                self.node_solved[node] = True
+                self.node_proof[node] = 1
+            else:
+                edges = self.edges(node)
+                if not self.edge_solved[edges].all():
+                    return
+                self.node_solved[node] = True
+                self.node_proof[node] = self.edge_proof[edges].max()
+
+    def link(self, edge, child):
+        # Records that taking edge led to the node child
+        first = self.edge_child[edge]
+        if first == -1:
+            self.edge_child[edge] = child
+        elif first != child:
+            self.extra_children.setdefault(edge, set()).add(child)
+
+    def children(self, node):
+        # Ids of every node reached from node
+        edges = self.edges(node)
+        children = self.edge_child[edges]
+        children = children[children != -1].tolist()
+        if self.extra_children:
+            for edge in range(edges.start, edges.stop):
+                children.extend(self.extra_children.get(edge, ()))
+        return children
+
+    def reachable(self, root):
+        # Ids of the nodes reachable from root, in breadth-first order
+        reached = np.zeros(self.n_nodes, dtype=bool)
+        reached[root] = True
+        order = [root]
+        for node in order:
+            for child in self.children(node):
+                if not reached[child]:
+                    reached[child] = True
+                    order.append(child)
+        return np.array(order)
+
+    def keep_subtree(self, root):
+        """
+        Drops every node that can't be reached from root and compacts the rest in place, root first. Returns the
+        number of nodes dropped.
+        """
+        return self.compact(self.reachable(root))
+
+    def evict(self, root, max_nodes = None, max_bytes = None, policy = 'visits'):
+        """
+        Drops nodes until at most max_nodes nodes / max_bytes bytes (see used_bytes) are left. Starting from root, the
+        reachable nodes are kept best first by policy: 'visits' prefers the most visited nodes and 'lru' the most
+        recently visited ones. Edges that led to dropped nodes keep their statistics. Returns the number of nodes
+        dropped.
+        """
+        if policy == 'visits':
+            scores = self.node_visits
+        elif policy == 'lru':
+            scores = self.node_last_visit
+        else:
+            raise ValueError(f"Unknown eviction policy {policy}")
+
+        max_nodes = self.n_nodes if max_nodes is None else max(max_nodes, 1)
+        max_bytes = np.inf if max_bytes is None else max_bytes
+        n_bytes = self.used_bytes()
+
+        reached = np.zeros(self.n_nodes, dtype=bool)
+        reached[root] = True
+        frontier = [(0, root)]
+        order = []
+        kept_bytes = 0
+        while frontier and len(order) < max_nodes:
+            _, node = heapq.heappop(frontier)
+            node_bytes = self.node_row_bytes + int(self.edge_count[node]) * self.edge_row_bytes
+            if order and kept_bytes + node_bytes > max_bytes:
+                break
+            order.append(node)
+            kept_bytes += node_bytes
+            for child in self.children(node):
+                if not reached[child]:
+                    reached[child] = True
+                    heapq.heappush(frontier, (-scores[child], child))
+
+        n_evicted = self.compact(np.array(order))
+        self.eviction_stats['evictions'] += 1
+        self.eviction_stats['nodes_evicted'] += n_evicted
+        self.eviction_stats['bytes_evicted'] += n_bytes - self.used_bytes()
+        return n_evicted
+
+    def compact(self, order):
+        """
+        Keeps only the nodes in order, renumbered in that order, and their edges. Links to other nodes are removed.
+        Returns the number of nodes dropped.
+        """
+        n_dropped = self.n_nodes - len(order)
+        new_ids = np.full(self.n_nodes, -1, dtype=np.int32)
+        new_ids[order] = np.arange(len(order))
+
+        # Old ids of the kept edges, each node's run still contiguous
+        counts = self.edge_count[order]
+        new_starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        old_edges = np.repeat(self.edge_start[order] - new_starts, counts) + np.arange(counts.sum())
+        new_edges = np.full(self.n_edges, -1, dtype=np.int64)
+        new_edges[old_edges] = np.arange(len(old_edges))
+
+        for name in self.node_arrays:
+            array = getattr(self, name)
+            array[:len(order)] = array[order]
+        self.edge_start[:len(order)] = new_starts
+        for name in self.edge_arrays:
+            array = getattr(self, name)
+            array[:len(old_edges)] = array[old_edges]
+        children = self.edge_child[:len(old_edges)]
+        children[children != -1] = new_ids[children[children != -1]]
+
+        extra_children = {}
+        for edge, others in self.extra_children.items():
+            others = {int(new_ids[child]) for child in others} - {-1}
+            if new_edges[edge] != -1 and others:
+                extra_children[int(new_edges[edge])] = others
+        self.extra_children = extra_children
+        self.node_keys = [self.node_keys[node] for node in order]
+        self.node_ids = {key: node for node, key in enumerate(self.node_keys)}
+        self.n_nodes = len(order)
+        self.n_edges = len(old_edges)
+        return n_dropped
+
+    def clear(self):
+        # Drops every node, keeping the allocated arrays
+        self.node_ids = {}
+        self.node_keys = []
+        self.extra_children = {}
+        self.n_nodes = 0
+        self.n_edges = 0
+
+    def add_virtual_loss(self, path, amount):
+        # Counts amount pending losses on every (node, edge) of path (a negative amount takes them back)
+        for node, edge in path:
+            self.node_virtual[node] += amount
+            self.edge_virtual[edge] += amount
+
+    def grow_nodes(self):
+        for name in self.node_arrays + ['edge_start']:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+
+    def grow_edges(self):
+        for name in self.edge_arrays:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+
+    def nbytes(self):
+        # Memory held by the arrays (not counting the key dict)
+        return sum(getattr(self, name).nbytes for name in self.node_arrays + self.edge_arrays + ['edge_start'])
+
+    def used_bytes(self):
+        # Bytes of the array rows in use (the arrays themselves can be up to twice as long, as they grow by doubling)
+        return self.n_nodes * self.node_row_bytes + self.n_edges * self.edge_row_bytes
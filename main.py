@@ -5,7 +5,6 @@ import coloredlogs
 
 from Coach import Coach
 from splendor.SplendorGame import SplendorGame as Game
-from splendor.NNet import NNetWrapper as nn
 from utils import *
 from splendor.config import SplendorGameVariant
 
@@ -32,6 +31,10 @@ args = dotdict({
 
 
 def main(verbose = False):
+    # Root-parallel workers re-import this module when they start, so torch is only imported here. With
+    # args.onnx_workers they then never load it (see MCTS.RootParallelPool)
+    from splendor.NNet import NNetWrapper as nn
+
     # Get debug_file_path
     debug_log_folder = "./logs"
     output = "file"
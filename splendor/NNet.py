@@ -1,6 +1,7 @@
+import logging
 import os
 import sys
-import time
+import warnings
 
 import numpy as np
 from tqdm import tqdm
@@ -8,11 +9,14 @@ from tqdm import tqdm
 sys.path.append('../../')
 from utils import *
 from NeuralNet import NeuralNet
+from EvalCache import EvalCache
 
 import torch
 import torch.optim as optim
 
-from .SplendorNNet import SplendorNNet as onnet
+from .SplendorNNet import SplendorNNet as onnet, SplendorInferenceNet
+
+log = logging.getLogger(__name__)
 
 args = dotdict({
     'lr': 0.001,
@@ -20,14 +24,29 @@ args = dotdict({
     'epochs': 10,
     'batch_size': 64,
     'cuda': torch.cuda.is_available(),
+    'quantize': False,  # predict with int8 dynamically quantized Linear layers (CPU only, training stays float32)
+    'eval_cache_size': 0,  # evaluations MCTS keeps per network across searches and games (0 = no cache)
+    'eval_cache_shared': False,  # keep the cache in shared memory, so root-parallel workers share it too
     # 'mps': torch.backends.mps.is_available(),
     # 'num_channels': 512,
 })
 
 
+def quantize(inference_net):
+    # Copy of inference_net with int8 weights in its Linear layers (activations are quantized on the fly, per batch)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='torch.quantize_per_tensor')
+        return torch.ao.quantization.quantize_dynamic(inference_net, {torch.nn.Linear}, dtype=torch.qint8)
+
+
 class NNetWrapper(NeuralNet):
     def __init__(self, game, verbose = False, output = "print", debug_file_path = None, nn_deep_dive = False):
         self.nnet = onnet(game, args)
+        self.inference_net = None  # frozen copy of nnet for predict, built on first use after every train / load
+        self.weights_version = 1  # goes up whenever the weights change, so the evaluation cache knows to clear
+        self.eval_cache = None
+        if args.eval_cache_size > 0:
+            self.eval_cache = EvalCache(game.getActionSize(), args.eval_cache_size, shared=args.eval_cache_shared)
         # self.board_x, self.board_y = game.getBoardSize()
         self.action_size = game.getActionSize()
 
@@ -40,6 +59,12 @@ class NNetWrapper(NeuralNet):
         self.output = output
         self.debug_file_path = debug_file_path
 
+    def __getstate__(self):
+        # The compiled inference net doesn't pickle (e.g. for root-parallel workers), it's rebuilt on first use
+        state = self.__dict__.copy()
+        state['inference_net'] = None
+        return state
+
     def log(self, s):
         if self.output == 'file':
             with open(self.debug_file_path, 'a') as f:
@@ -91,34 +116,105 @@ class NNetWrapper(NeuralNet):
                 total_loss.backward()
                 optimizer.step()
 
+        self.inference_net = None
+        self.weights_version += 1
+
     def predict(self, board):
         """
         board: np array with board
         """
-        # if self.verbose:
-        #     self.log("\t\tNN: getting policy")
-        # timing
-        start = time.time()
-
-        # preparing input
-        board = torch.FloatTensor(board.astype(np.float64))
-        if len(board.shape) == 1:
-            board = board.unsqueeze(0)
+        pis, vs = self.predict_batch(board[np.newaxis])
+        return pis[0], vs[0]
+
+    def predict_batch(self, boards):
+        """
+        boards: np array of shape (batch size, board size), of any integer (or float) dtype
+
+        Returns the policies (batch size, action size) and values (batch size,) of all boards from one forward pass,
+        as float32 arrays.
+        """
+        if self.inference_net is None:
+            self.inference_net = self.build_inference_net()
+
+        # One conversion to float32 (no copy if the boards already are)
+        boards = torch.from_numpy(np.ascontiguousarray(boards, dtype=np.float32))
+        if args.cuda:
+            boards = boards.cuda()
+        with torch.inference_mode():
+            pis, vs = self.inference_net(boards)
+
+        # Make sure each policy sums to 1
+        pis = pis.cpu().numpy()
+        pis /= pis.sum(1, keepdims=True)
+        return pis, vs.cpu().numpy()[:, 0]
+
+    def build_inference_net(self):
+        # BatchNorm-folded, dropout-free copy of nnet's current weights (quantized if args.quantize), compiled with
+        # TorchScript where it works
+        self.nnet.eval()
+        inference_net = SplendorInferenceNet(self.nnet)
+        if args.quantize:
+            if args.cuda:
+                log.warning("Quantized inference only runs on the CPU, predicting in float32")
+            else:
+                inference_net = quantize(inference_net)
+        try:
+            with warnings.catch_warnings():
+                # Newer versions of torch warn that TorchScript is deprecated
+                warnings.simplefilter('ignore', FutureWarning)
+                return torch.jit.freeze(torch.jit.script(inference_net))
+        except Exception as e:
+            log.warning(f"TorchScript isn't available, running the inference net eagerly: {e}")
+            return inference_net
+
+    def export_onnx(self, folder = 'checkpoint', filename = 'best.onnx'):
+        """
+        Exports the current weights as an ONNX model (the BatchNorm-folded inference net, float32, with a dynamic
+        batch size) to folder/filename, for OnnxNNetWrapper. folder can also be a file object to write to.
+        """
+        if isinstance(folder, str):
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+            f = os.path.join(folder, filename)
+        else:
+            f = folder
+
         self.nnet.eval()
-        with torch.no_grad():
-            pi, v = self.nnet(board)
-        
-        # Convert from log probabilities to probabilities
-        pi = torch.exp(pi).data.cpu().numpy()[0]  # Add [0] to get first element since we have batch size 1
-        v = v.data.cpu().numpy()[0][0]  # Add [0][0] to get scalar value
-        
-        # Ensure pi sums to 1
-        if np.sum(pi) > 0:
-            pi = pi / np.sum(pi)
-            
-        # if self.verbose:
-        #     print('PREDICTION TIME TAKEN : {0:03f}'.format(time.time()-start))
-        return pi, v
+        inference_net = SplendorInferenceNet(self.nnet).cpu()
+        example = torch.zeros(1, self.nnet.input_size)
+        export_args = dict(input_names=['boards'], output_names=['pis', 'vs'],
+                           dynamic_axes={'boards': {0: 'batch'}, 'pis': {0: 'batch'}, 'vs': {0: 'batch'}})
+        try:
+            # Newer versions of torch default to the dynamo exporter, which needs onnxscript
+            torch.onnx.export(inference_net, (example,), f, dynamo=False, **export_args)
+        except TypeError:
+            torch.onnx.export(inference_net, (example,), f, **export_args)
+        return f
+
+    def check_quantization(self, boards):
+        """
+        boards: np array of shape (number of boards, board size) of canonical boards, ideally ones the net wasn't
+        trained on
+
+        Compares the int8 quantized net to the float32 one on the boards, to check quantization doesn't hurt play
+        before turning on args.quantize. Returns a dict with the mean KL divergence of the quantized policies from the
+        float ones, the mean absolute error of the values and the fraction of boards whose most likely move is the same.
+        """
+        self.nnet.eval()
+        float_net = SplendorInferenceNet(self.nnet).cpu()
+        quantized_net = quantize(SplendorInferenceNet(self.nnet).cpu())
+
+        boards = torch.from_numpy(np.ascontiguousarray(boards, dtype=np.float32))
+        with torch.inference_mode():
+            pis, vs = float_net(boards)
+            quantized_pis, quantized_vs = quantized_net(boards)
+
+        log_ratio = torch.log(pis.clamp_min(1e-12)) - torch.log(quantized_pis.clamp_min(1e-12))
+        return {
+            'policy_kl': (pis * log_ratio).sum(1).mean().item(),
+            'value_mae': (vs - quantized_vs).abs().mean().item(),
+            'top_move_agreement': (pis.argmax(1) == quantized_pis.argmax(1)).float().mean().item(),
+        }
 
     def loss_pi(self, targets, outputs):
         return -torch.sum(targets * outputs) / targets.size()[0]
@@ -145,3 +241,5 @@ class NNetWrapper(NeuralNet):
         map_location = None if args.cuda else 'cpu'
         checkpoint = torch.load(filepath, map_location=map_location)
         self.nnet.load_state_dict(checkpoint['state_dict'])
+        self.inference_net = None
+        self.weights_version += 1
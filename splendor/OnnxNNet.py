@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import onnxruntime as ort
+
+
+class OnnxInference():
+    """
+    Runs a net exported with NNetWrapper.export_onnx on onnxruntime's CPU execution provider. model is the path to the
+    .onnx file or its bytes. n_threads = 0 lets onnxruntime pick; use 1 when there's a worker process per core.
+    """
+
+    def __init__(self, model, n_threads = 0):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = n_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, boards):
+        # boards: float32 np array of shape (batch size, board size). Returns the policies and values (batch size, 1)
+        pis, vs = self.session.run(['pis', 'vs'], {'boards': boards})
+        return pis, vs
+
+
+class OnnxNNetWrapper():
+    """
+    Inference-only network that predicts with onnxruntime from a model exported by NNetWrapper.export_onnx, without
+    needing torch. Root-parallel workers use it with args.onnx_workers (see MCTS.RootParallelPool). model is the
+    path to the .onnx file or its bytes. It has predict / predict_batch and load_checkpoint, but no training or saving.
+    """
+
+    def __init__(self, game, model = None, n_threads = 0):
+        self.action_size = game.getActionSize()
+        self.n_threads = n_threads
+        self.inference_net = None if model is None else OnnxInference(model, n_threads)
+        self.weights_version = 1  # goes up whenever another model is loaded (see EvalCache)
+        self.eval_cache = None
+
+    def predict(self, board):
+        """
+        board: np array with board
+        """
+        pis, vs = self.predict_batch(board[np.newaxis])
+        return pis[0], vs[0]
+
+    def predict_batch(self, boards):
+        """
+        boards: np array of shape (batch size, board size), of any integer (or float) dtype
+
+        Returns the policies (batch size, action size) and values (batch size,) of all boards as float32 arrays.
+        """
+        pis, vs = self.inference_net(np.ascontiguousarray(boards, dtype=np.float32))
+        pis /= pis.sum(1, keepdims=True)
+        return pis, vs[:, 0]
+
+    def load_checkpoint(self, folder='checkpoint', filename='best.onnx'):
+        filepath = os.path.join(folder, filename)
+        if not os.path.exists(filepath):
+            raise Exception("No model in path {}".format(filepath))
+        self.inference_net = OnnxInference(filepath, self.n_threads)
+        self.weights_version += 1
@@ -1,8 +1,7 @@
 from __future__ import print_function
 
-import copy
 import sys
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 sys.path.append('..')
 # from Game import Game
@@ -11,36 +10,149 @@ from numpy.typing import NDArray
 
 import random
 # import queue
-from collections import deque
 
 import re
 
 import time
 
-from splendor.config import SplendorConfig, SplendorGameVariant
+from splendor.config import SplendorConfig, SplendorGameVariant, take_coins_actions
 
 import os
 
 
-take_coins_actions = ['wug', 'wur', 'wuk', 'wgr', 'wgk', 'wrk', 'ugr', 'ugk', 'urk', 'grk', 'wu', 'wg', 'wr', 'wk', 'ug',
-                      'ur', 'uk', 'gr', 'gk', 'rk', 'w', 'u', 'g', 'r', 'k', 'ww', 'uu', 'gg', 'rr', 'kk', '']
-
 cards_per_row_count = 4
 
 randomize_branch = False
 
+# Index of each color inside the gem (first 5) and coin (all 6) vectors of a game state
+color_index : Dict[str, int] = {'w': 0, 'u': 1, 'g': 2, 'r': 3, 'k': 4, 'y': 5}
+
+# Bit of each of the 5 colors in the coin action lookup (see SplendorConfig.compile_coin_action_masks)
+color_bits : NDArray[np.int_] = 1 << np.arange(5)
+
+# Every field of a game state fits comfortably in 16 bits (card ids, coin counts, scores, deck pointers)
+state_dtype = np.int16
+
+# Zobrist keys are drawn for values 0..63 of each canonical entry (negative values wrap around)
+zobrist_value_mask = 63
+zobrist_seed = 20240612
+
+
+class SplendorStateLayout():
+    """
+    Fixed offsets of the fields packed into the buffer of a SplendorGameState.
+
+    The first getBoardSize() entries follow the order of the canonical form from player 1's point of view
+    (board, reserved 1, reserved 2, gems 1, gems 2, coins 1, coins 2, score 1, score 2, first player marker, nobles),
+    so player 1's canonical board is a prefix of the buffer. The next getBoardSize() entries mirror player 2's
+    canonical board, so both are plain slices of the buffer. The rest holds the bookkeeping that isn't visible to the
+    network: nobles gained by each player, the consecutive do-nothing counter, the draw pointers into each deck,
+    the deck orders themselves (one segment per level, covering the same id range as the level's cards) and the
+    64-bit Zobrist hash of each player's canonical form (stored as 4 int16 entries each).
+    """
+
+    def __init__(self, config : SplendorConfig):
+        self.n_cards : int = config.n_cards
+        self.n_nobles : int = config.n_nobles
+
+        self.board : int = 0
+        self.reserved : int = self.board + self.n_cards
+        self.perma_gems : int = self.reserved + 2 * self.n_cards
+        self.coins : int = self.perma_gems + 2 * 5
+        self.scores : int = self.coins + 2 * 6
+        self.first_player : int = self.scores + 2
+        self.nobles_board : int = self.first_player + 1
+        self.canonical_size : int = self.nobles_board + self.n_nobles
+        self.player_2_canonical : int = self.canonical_size
+
+        self.gained_nobles : int = self.player_2_canonical + self.canonical_size
+        self.consecutive_do_nothings : int = self.gained_nobles + 2 * self.n_nobles
+        self.deck_pointers : int = self.consecutive_do_nothings + 1
+        self.deck : int = self.deck_pointers + 3
+        # Rounded up to a multiple of 4 entries so the hashes are 8-byte aligned
+        self.hashes : int = -(-(self.deck + self.n_cards) // 4) * 4
+        self.size : int = self.hashes + 2 * 4
+
+        # Deck segment [start, end) of each level, indexed by level - 1
+        self.deck_starts : NDArray[np.int_] = np.array([
+            0,
+            config.n_level_1_cards,
+            config.n_level_1_cards + config.n_level_2_cards
+        ])
+        self.deck_ends : NDArray[np.int_] = np.append(self.deck_starts[1:], self.n_cards)
+
+        # Gather order turning the buffer into player 2's canonical form (player 1's fields swapped with player 2's)
+        def swap(offset, width):
+            return np.concatenate([np.arange(offset + width, offset + 2 * width), np.arange(offset, offset + width)])
+
+        self.player_2_canonical_index : NDArray[np.int_] = np.concatenate([
+            np.arange(self.board, self.board + self.n_cards),
+            swap(self.reserved, self.n_cards),
+            swap(self.perma_gems, 5),
+            swap(self.coins, 6),
+            swap(self.scores, 1),
+            [self.first_player],
+            np.arange(self.nobles_board, self.nobles_board + self.n_nobles)
+        ])
+
+        # Where each entry of player 1's canonical board is mirrored in player 2's
+        self.player_2_mirror_index : NDArray[np.int_] = np.empty(self.canonical_size, dtype=int)
+        self.player_2_mirror_index[self.player_2_canonical_index] = self.player_2_canonical + np.arange(self.canonical_size)
+
+
 class SplendorGameState():
-    def __init__(self, id_decks : Dict[int, deque[int]], board : NDArray[np.int_], reserved : Dict[int, NDArray[np.int_]], nobles_board : NDArray[np.int_], coins : Dict[int, Dict[str, int]], perma_gems : Dict[int, Dict[str, int]], scores : Dict[int, int], gained_nobles : Dict[int, List[int]],
-                 consecutive_do_nothings : int):
-        self.id_decks : Dict[int, deque[int]] = id_decks
-        self.board : NDArray[np.int_] = board
-        self.reserved : Dict[int, NDArray[np.int_]] = reserved
-        self.nobles_board : NDArray[np.int_] = nobles_board
-        self.coins : Dict[int, Dict[str, int]] = coins
-        self.perma_gems : Dict[int, Dict[str, int]] = perma_gems
-        self.scores : Dict[int, int] = scores
-        self.gained_nobles : Dict[int, List[int]] = gained_nobles
-        self.consecutive_do_nothings : int = consecutive_do_nothings
+    """
+    Game state stored as a single small integer buffer (see SplendorStateLayout) so that copying a state is one
+    buffer copy. The attributes below are views into that buffer; per-player fields are indexed by player - 1.
+    """
+
+    __slots__ = ('layout', 'buffer', 'board', 'reserved', 'perma_gems', 'coins', 'scores', 'nobles_board',
+                 'gained_nobles', 'deck_pointers', 'deck', 'hashes', 'canonical')
+
+    def __init__(self, layout : SplendorStateLayout, buffer : NDArray[np.int16] | None = None):
+        n_cards = layout.n_cards
+        n_nobles = layout.n_nobles
+
+        self.layout : SplendorStateLayout = layout
+        self.buffer : NDArray[np.int16] = np.zeros(layout.size, dtype=state_dtype) if buffer is None else buffer
+
+        b = self.buffer
+        self.board : NDArray[np.int16] = b[layout.board:layout.board + n_cards]
+        self.reserved : NDArray[np.int16] = b[layout.reserved:layout.reserved + 2 * n_cards].reshape(2, n_cards)
+        self.perma_gems : NDArray[np.int16] = b[layout.perma_gems:layout.perma_gems + 10].reshape(2, 5)
+        self.coins : NDArray[np.int16] = b[layout.coins:layout.coins + 12].reshape(2, 6)
+        self.scores : NDArray[np.int16] = b[layout.scores:layout.scores + 2]
+        self.nobles_board : NDArray[np.int16] = b[layout.nobles_board:layout.nobles_board + n_nobles]
+        self.gained_nobles : NDArray[np.int16] = b[layout.gained_nobles:layout.gained_nobles + 2 * n_nobles].reshape(2, n_nobles)
+        self.deck_pointers : NDArray[np.int16] = b[layout.deck_pointers:layout.deck_pointers + 3]
+        self.deck : NDArray[np.int16] = b[layout.deck:layout.deck + n_cards]
+        self.hashes : NDArray[np.uint64] = b[layout.hashes:layout.hashes + 8].view(np.uint64)
+
+        # Read-only canonical boards, indexed by player - 1
+        self.canonical : NDArray[np.int16] = b[:2 * layout.canonical_size].reshape(2, layout.canonical_size).view()
+        self.canonical.flags.writeable = False
+
+    @property
+    def consecutive_do_nothings(self) -> int:
+        return int(self.buffer[self.layout.consecutive_do_nothings])
+
+    @consecutive_do_nothings.setter
+    def consecutive_do_nothings(self, value : int):
+        self.buffer[self.layout.consecutive_do_nothings] = value
+
+    def cards_left(self, level : int) -> int:
+        return int(self.layout.deck_ends[level - 1] - self.deck_pointers[level - 1])
+
+    def copy(self) -> 'SplendorGameState':
+        return SplendorGameState(self.layout, self.buffer.copy())
+
+    def load(self, other : 'SplendorGameState'):
+        # Overwrite this state with another one in place (the views stay valid)
+        np.copyto(self.buffer, other.buffer)
+
+    def __reduce__(self):
+        # Pickle only the buffer and rebuild the views on it, otherwise they'd come back as separate copies
+        return (SplendorGameState, (self.layout, self.buffer))
 
 
 class SplendorGame():
@@ -55,18 +167,25 @@ class SplendorGame():
         output : str = "print", 
         debug_file_path : str | None = None, 
         display_time : bool = False, 
-        randomize : bool = True
+        randomize : bool = True,
+        check_hash_collisions : bool = False
     ):
         self.verbose : bool = verbose
         self.config : SplendorConfig = SplendorConfig.get_config(game_variant)
+        self.layout : SplendorStateLayout = SplendorStateLayout(self.config)
 
-        self.states = {}
+        self.states : Dict[str, SplendorGameState | None] = {}
         self.output : str = output
         self.debug_file_path : str | None = debug_file_path
 
         self.randomize : bool = randomize
 
-        self.current_valid_moves = []
+        # Draws cards for the branch out of the cards it hasn't seen yet (seeded from np.random for reproducibility)
+        self.branch_rng : np.random.Generator = np.random.default_rng(np.random.randint(2 ** 31))
+
+        # Coins thrown away at random (reserving over 10 coins) on each state. Undo doesn't take them back, it only
+        # ever goes up (see randomOutcomes)
+        self.random_discards : Dict[str, int] = {'main': 0, 'branch': 0}
 
         self.display_time : bool = display_time
 
@@ -85,6 +204,22 @@ class SplendorGame():
         self.times : Dict[str, float] = {}
         self.reset_times()
 
+        # Buffer entries each (player, action) may write, used to build undo tokens and update the hashes
+        self.touched_indices : List[List[NDArray[np.int_]]] = [
+            [self.get_touched_indices(player, action) for action in range(self.getActionSize())] for player in [1, 2]
+        ]
+
+        # (source, destination) of the entries to copy into player 2's canonical board after each (player, action)
+        self.mirrored_indices : List[List[Tuple[NDArray[np.int_], NDArray[np.int_]]]] = [
+            [self.get_mirrored_indices(touched) for touched in player_touched] for player_touched in self.touched_indices
+        ]
+
+        self.zobrist_keys : NDArray[np.uint64] = self.build_zobrist_keys()
+
+        # In collision-check mode, the canonical form seen for every hash handed out by stringRepresentation
+        self.check_hash_collisions : bool = check_hash_collisions
+        self.hashed_boards : Dict[int, bytes] = {}
+
         self.reset_main()
 
 
@@ -97,9 +232,6 @@ class SplendorGame():
             'reset_misc': 0,
             'reset_branch': 0,
             'string_representation': 0,
-            'string_representation0': 0,
-            'string_representation1': 0,
-            'string_representation2': 0,
             'display_game_state': 0,
             'get_canonical_form': 0
         }
@@ -133,105 +265,34 @@ class SplendorGame():
 
         time1 = time.time()
 
-        deck1 = deque(id_list1)
-        deck2 = deque(id_list2)
-        deck3 = deque(id_list3)
-
-        # for card in id_list1:
-        #     deck1.put(card)
-        # for card in id_list2:
-        #     deck2.put(card)
-        # for card in id_list3:
-        #     deck3.put(card)
-
-        id_decks = {
-            1: deck1,
-            2: deck2,
-            3: deck3
-        }
-
-        board = np.zeros(self.config.n_cards, dtype=int)
-        reserved = {
-            1: np.zeros(self.config.n_cards, dtype = int),
-            2: np.zeros(self.config.n_cards, dtype = int)
-        }
+        game_state = SplendorGameState(self.layout)
+        game_state.deck[:] = id_list1 + id_list2 + id_list3
+        game_state.deck_pointers[:] = self.layout.deck_starts
 
         # Draw 4 cards for each level
         for _ in range(cards_per_row_count):
-            current_card_id = id_decks[1].popleft()
-            board[current_card_id] = 1
-
-            current_card_id = id_decks[2].popleft()
-            board[current_card_id] = 1
-
-            current_card_id = id_decks[3].popleft()
-            board[current_card_id] = 1
+            for level in [1, 2, 3]:
+                self.replenish_board(level, game_state)
 
         # Pick 3 nobles
         n_nobles = len(self.config.nobles)
-        nobles_board = np.zeros(n_nobles, dtype=int)
         n_to_sample = np.min([3, n_nobles])
         if self.randomize:
-            nobles_board[random.sample(range(n_nobles), n_to_sample)] = 1
+            game_state.nobles_board[random.sample(range(n_nobles), n_to_sample)] = 1
         else:
-            nobles_board[[0, 1, 2]] = 1
-
-        # Player coins
-        coins = {
-            1: {
-                'w': 0,
-                'u': 0,
-                'g': 0,
-                'r': 0,
-                'k': 0,
-                'y': 0
-            },
-            2: {
-                'w': 0,
-                'u': 0,
-                'g': 0,
-                'r': 0,
-                'k': 0,
-                'y': 0
-            }
-        }
-
-        # Player coins
-        perma_gems = {
-            1: {
-                'w': 0,
-                'u': 0,
-                'g': 0,
-                'r': 0,
-                'k': 0,
-            },
-            2: {
-                'w': 0,
-                'u': 0,
-                'g': 0,
-                'r': 0,
-                'k': 0,
-            }
-        }
+            game_state.nobles_board[[0, 1, 2]] = 1
 
-        # Scores
-        scores = {
-            1: 0,
-            2: 0
-        }
+        # Player 1 always goes first
+        game_state.buffer[self.layout.first_player] = 1
 
-        gained_nobles : Dict[int, List[int]] = {
-            1: [],
-            2: []
-        }
+        self.mirror_canonical(game_state)
+        game_state.hashes[:] = self.compute_hashes(game_state)
 
-        consecutive_do_nothings = 0
+        # Coins, perma-gems, scores, gained nobles and consecutive do-nothings all start at 0
 
-        game_state = SplendorGameState(id_decks, board, reserved, nobles_board, coins, perma_gems, scores,
-                                       gained_nobles, consecutive_do_nothings)
         self.states = {
             'main': game_state,
-            'branch': None
+            'branch': game_state.copy()
         }
 
         time2 = time.time()
@@ -248,43 +309,141 @@ class SplendorGame():
     def reset_branch(self):
         start_time = time.time()
 
-        # Shuffle queues
-        id_decks = {}
-
-        for level in [1, 2, 3]:
-            l = list(self.states['main'].id_decks[level])
-            if self.randomize:
-                random.shuffle(l)
-            id_decks[level] = deque(l)
-
-            # temp_storage = []
-            # while not self.states['main'].id_decks[level].empty():
-            #     el = self.states['main'].id_decks[level].get()
-            #     l.append(el)
-            #     temp_storage.append(el)
-            # for item in temp_storage:
-            #     self.states['main'].id_decks[level].put(item)
-            #
-            # random.shuffle(l)
-            # for item in l:
-            #     id_decks[level].put(item)
-
-        time1 = time.time()
-
-        self.states['branch'] = SplendorGameState(
-            id_decks,
-            self.states['main'].board.copy(),
-            copy.deepcopy(self.states['main'].reserved),
-            self.states['main'].nobles_board.copy(),
-            copy.deepcopy(self.states['main'].coins),
-            copy.deepcopy(self.states['main'].perma_gems),
-            copy.deepcopy(self.states['main'].scores),
-            copy.deepcopy(self.states['main'].gained_nobles),
-            self.states['main'].consecutive_do_nothings
-        )
-
-        self.times['reset_branch'] += time1 - start_time
-
+        # Copy the main state into the branch in place. The branch doesn't know the order of the cards left in the
+        # decks: draw_card picks them at random as they're drawn
+        self.states['branch'].load(self.states['main'])
+
+        self.times['reset_branch'] += time.time() - start_time
+
+    def get_touched_indices(self, player, action):
+        # Every buffer entry that getNextState may write when player takes action (a superset is fine)
+        layout = self.layout
+        n_cards = self.config.n_cards
+        p = player - 1
+
+        coins = np.arange(layout.coins + 6 * p, layout.coins + 6 * p + 6)
+        touched = [[layout.consecutive_do_nothings]]
+
+        def drawn_from(level):
+            # Board slots a replacement card can land on, plus the level's draw pointer and deck (see draw_card)
+            start, end = layout.deck_starts[level - 1], layout.deck_ends[level - 1]
+            return [
+                np.arange(layout.board + start, layout.board + end),
+                [layout.deck_pointers + level - 1],
+                np.arange(layout.deck + start, layout.deck + end)
+            ]
+
+        if action < n_cards:
+            touched += [
+                [layout.board + action, layout.reserved + n_cards * p + action],
+                *drawn_from(self.card_id_to_level(action)),
+                coins,
+                np.arange(layout.perma_gems + 5 * p, layout.perma_gems + 5 * p + 5),
+                [layout.scores + p],
+                np.arange(layout.nobles_board, layout.nobles_board + layout.n_nobles),
+                np.arange(layout.gained_nobles + layout.n_nobles * p, layout.gained_nobles + layout.n_nobles * (p + 1))
+            ]
+        elif action < n_cards * 2:
+            card_id = action - n_cards
+            touched += [
+                [layout.board + card_id, layout.reserved + n_cards * p + card_id],
+                *drawn_from(self.card_id_to_level(card_id)),
+                coins
+            ]
+        elif action <= n_cards * 2 + 2:
+            level = action - n_cards * 2 + 1
+            start, end = layout.deck_starts[level - 1], layout.deck_ends[level - 1]
+            touched += [
+                np.arange(layout.reserved + n_cards * p + start, layout.reserved + n_cards * p + end),
+                [layout.deck_pointers + level - 1],
+                np.arange(layout.deck + start, layout.deck + end),
+                coins
+            ]
+        elif action < n_cards * 2 + 33:
+            touched += [coins]
+
+        touched = np.unique(np.concatenate(touched)).astype(int)
+
+        # Player 2's canonical board and the hashes change along with whatever else changes
+        return np.concatenate([
+            touched,
+            np.sort(layout.player_2_mirror_index[touched[touched < layout.canonical_size]]),
+            np.arange(layout.hashes, layout.size)
+        ])
+
+    def get_mirrored_indices(self, touched):
+        source = touched[touched < self.layout.canonical_size]
+        return source, self.layout.player_2_mirror_index[source]
+
+    def mirror_canonical(self, state : SplendorGameState):
+        # Rebuild player 2's canonical board from scratch
+        layout = self.layout
+        b = state.buffer
+        b[layout.player_2_canonical:layout.player_2_canonical + layout.canonical_size] = b[layout.player_2_canonical_index]
+        b[layout.player_2_canonical + layout.first_player] = -1
+
+    def build_zobrist_keys(self):
+        """
+        Random 64-bit keys indexed by [player - 1, buffer position, value & zobrist_value_mask], so that XOR-ing the
+        keys of a state's entries gives the hash of that player's canonical form. Entries outside the canonical form
+        get 0 keys. The seed is fixed so hashes agree across processes.
+        """
+        layout = self.layout
+        n_values = zobrist_value_mask + 1
+        rng = np.random.default_rng(zobrist_seed)
+        canonical_keys = rng.integers(0, 2 ** 64, size=(layout.canonical_size, n_values), dtype=np.uint64, endpoint=False)
+
+        keys = np.zeros((2, layout.size, n_values), dtype=np.uint64)
+        keys[0, :layout.canonical_size] = canonical_keys
+        keys[1, layout.player_2_canonical:layout.player_2_canonical + layout.canonical_size] = canonical_keys
+
+        return keys
+
+    def compute_hashes(self, state : SplendorGameState):
+        # Hash of both players' canonical forms from scratch
+        values = state.buffer & zobrist_value_mask
+        return np.bitwise_xor.reduce(self.zobrist_keys[:, np.arange(self.layout.size), values], axis=1)
+
+    def update_hashes(self, state : SplendorGameState, touched, old_values):
+        # XOR out the keys of the entries that changed and XOR in their new ones
+        new_values = state.buffer[touched]
+        changed = old_values != new_values
+        if changed.any():
+            changed_indices = touched[changed]
+            old_keys = self.zobrist_keys[:, changed_indices, old_values[changed] & zobrist_value_mask]
+            new_keys = self.zobrist_keys[:, changed_indices, new_values[changed] & zobrist_value_mask]
+            state.hashes[:] ^= np.bitwise_xor.reduce(old_keys, axis=1) ^ np.bitwise_xor.reduce(new_keys, axis=1)
+
+    def apply(self, action, player, m_or_b = 'branch'):
+        """
+        Plays action for player on m_or_b in place, like getNextState, and returns an undo token for undo().
+        Tokens must be undone in the reverse order they were created.
+        """
+        touched = self.touched_indices[player - 1][action]
+        token = (m_or_b, touched, self.states[m_or_b].buffer[touched])
+        self.getNextState(None, player, action, m_or_b)
+        return token
+
+    def undo(self, token):
+        # Restore the buffer entries the action may have written
+        m_or_b, touched, old_values = token
+        self.states[m_or_b].buffer[touched] = old_values
+
+
+    def randomOutcomes(self, m_or_b = 'branch'):
+        # Cards drawn from the decks so far plus coins ever thrown away at random. A move that changes it had a random
+        # outcome
+        return int(self.states[m_or_b].deck_pointers.sum()) + self.random_discards[m_or_b]
+
+    def endedByScore(self, player, m_or_b = 'branch'):
+        # Whether getGameEnded ends the game on the target score whatever the last move's random outcome. It only gets to
+        # the scores if player has a valid move, so that has to be one the cards on the board don't decide (reserving
+        # from a pile or taking coins). Whichever coin the opponent threw away, at least that color is left to take, so
+        # the random discard doesn't decide whether there is a coin move either
+        state = self.states[m_or_b]
+        if player != 1 or state.consecutive_do_nothings >= 2 or state.scores.max() < self.config.target_score:
+            return False
+        return bool(self.getValidMoves(None, player, m_or_b)[self.config.n_cards * 2:].any())
 
     def getBoardSize(self):
         # 90 cards on board or not
@@ -364,25 +523,35 @@ class SplendorGame():
         return self.config.n_cards * 2 + 3 + 10 + 10 + 5 + 5 + 1
 
     def card_id_to_level(self, id):
-        if 0 <= id <= self.config.n_level_1_cards:
-            return 1
-        elif self.config.n_level_1_cards <= id <= self.config.n_level_1_cards + self.config.n_level_2_cards:
-            return 2
-        elif self.config.n_level_1_cards + self.config.n_level_2_cards <= id <= self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards:
-            return 3
+        if 0 <= id < self.config.n_cards:
+            return int(self.config.card_levels[id])
         else:
             raise Exception(f"id {id} isn't a valid card")
 
     def switch_player(self, player):
         return 3 - player
 
-    def replenish_board(self, level, m_or_b):
-        if len(self.states[m_or_b].id_decks[level]) == 0:
+    def draw_card(self, level, state : SplendorGameState):
+        # Take the next card off the level's deck
+        pointer = state.deck_pointers[level - 1]
+
+        if self.randomize and state is self.states.get('branch'):
+            # The branch's guess at the hidden order is made one card at a time: swap a random undrawn card to the
+            # top of the deck (a Fisher-Yates step) instead of shuffling whole decks every simulation
+            swap = self.branch_rng.integers(pointer, self.layout.deck_ends[level - 1])
+            state.deck[[pointer, swap]] = state.deck[[swap, pointer]]
+
+        new_id = int(state.deck[pointer])
+        state.deck_pointers[level - 1] = pointer + 1
+        return new_id
+
+    def replenish_board(self, level, state : SplendorGameState):
+        if state.cards_left(level) == 0:
             self.log(f"Tried to draw card from level {level} but it's empty!")
             return
         else:
-            new_id = self.states[m_or_b].id_decks[level].popleft()
-            self.states[m_or_b].board[new_id] = 1
+            new_id = self.draw_card(level, state)
+            state.board[new_id] = 1
 
     def getNextState(self, board, player, action, m_or_b, print_to_terminal = False):
         start_time = time.time()
@@ -390,7 +559,12 @@ class SplendorGame():
         # if player takes action on board, return next (board,player)
         # action must be a valid move
 
-        # print(f"DEBUG: getting next state for {m_or_b}")
+        state = self.states[m_or_b]
+        p = player - 1
+        o = self.switch_player(player) - 1
+
+        touched = self.touched_indices[p][action]
+        old_values = state.buffer[touched]
 
         action_str = "" # For logging
 
@@ -399,88 +573,56 @@ class SplendorGame():
         elif action < self.config.n_cards:
             # Buy the card
             id_to_buy = action
-            if self.states[m_or_b].board[id_to_buy] == 1:
+            if state.board[id_to_buy] == 1:
                 # Remove card from board
-                self.states[m_or_b].board[id_to_buy] = 0
+                state.board[id_to_buy] = 0
 
                 # Draw new card to take its place
                 level = self.card_id_to_level(id_to_buy)
-                self.replenish_board(level, m_or_b)
+                self.replenish_board(level, state)
 
 
-            elif self.states[m_or_b].reserved[player][id_to_buy] == 1:
+            elif state.reserved[p][id_to_buy] == 1:
                 # Remove card from reserved
-                self.states[m_or_b].reserved[player][id_to_buy] = 0
+                state.reserved[p][id_to_buy] = 0
 
             else:
                 raise Exception(f"""
                     Player {player} taking action {action} trying to buy card {id_to_buy} but neither available to buy nor reserved by that player
-                        Board: {self.states[m_or_b].board}
-                        Reserved: {self.states[m_or_b].reserved}
+                        Board: {state.board}
+                        Reserved: {state.reserved}
                     """)
 
-            # Take away player's coins
-            card = self.config.cards[id_to_buy]
-            before_coins = self.states[m_or_b].coins[player].copy()
-            for color in card.cost:
-                coins_needed = np.max([card.cost[color] - self.states[m_or_b].perma_gems[player][color], 0])
-                if self.states[m_or_b].coins[player][color] >= coins_needed:
-                    self.states[m_or_b].coins[player][color] -= coins_needed
-                else:
-                    self.states[m_or_b].coins[player]['y'] -= coins_needed - self.states[m_or_b].coins[player][color]
-
-                    self.states[m_or_b].coins[player][color] = 0
-                assert self.states[m_or_b].coins[player][color] >= 0 and self.states[m_or_b].coins[player][
-                    'y'] >= 0, f"""Negative coin values for player {player} after buying: {self.states[m_or_b].coins[player]}"""
+            # Take away player's coins: colored coins first, yellow coins cover the rest
+            coins = state.coins[p]
+            coins_needed = np.maximum(self.config.card_costs[id_to_buy] - state.perma_gems[p], 0)
+            colored_paid = np.minimum(coins_needed, coins[:5])
+            coins[:5] -= colored_paid
+            coins[5] -= (coins_needed - colored_paid).sum()
+            assert coins[5] >= 0, f"""Negative coin values for player {player} after buying: {coins}"""
 
             # Add card to player gem count
-            before_gems = self.states[m_or_b].perma_gems.copy()
-            self.states[m_or_b].perma_gems[player][card.color] += 1
+            state.perma_gems[p][self.config.card_colors[id_to_buy]] += 1
 
             # Add point value to player's score
-            before_score = self.states[m_or_b].scores[player]
-            self.states[m_or_b].scores[player] += card.pv
-
-            # Check for nobles
-
-            best_noble_i = -1
-            best_opponent_distance_score = np.inf
-
-            for idx in np.where(self.states[m_or_b].nobles_board == 1)[0]:
-                noble = self.config.nobles[idx]
-                qualified = True
-
-                for color in noble.cost:
-                    if self.states[m_or_b].perma_gems[player][color] < noble.cost[color]:
-                        qualified = False
-                        break
-
-                if qualified:
-                    # Determine best noble to get
-                    opponent_distance_score = 0
+            state.scores[p] += self.config.card_points[id_to_buy]
 
-                    for color in noble.cost:
-                        if self.states[m_or_b].perma_gems[self.switch_player(player)][color] < noble.cost[color]:
-                            opponent_distance_score += noble.cost[color] - \
-                                                       self.states[m_or_b].perma_gems[self.switch_player(player)][color]
+            # Check for nobles: of those the player now qualifies for, take the one the opponent is closest to
+            # (lowest index on ties)
+            noble_costs = self.config.noble_costs
+            qualified = (state.nobles_board == 1) & (state.perma_gems[p] >= noble_costs).all(1)
 
-                    if opponent_distance_score < best_opponent_distance_score:
-                        best_noble_i = idx
-                        best_opponent_distance_score = opponent_distance_score
+            if qualified.any():
+                opponent_distance_scores = np.maximum(noble_costs - state.perma_gems[o], 0).sum(1)
+                best_noble_i = int(np.argmin(np.where(qualified, opponent_distance_scores, np.iinfo(int).max)))
 
-            if best_noble_i != -1:
                 # Noble acquired
-                self.states[m_or_b].scores[player] += self.config.nobles[best_noble_i].pv
+                state.scores[p] += self.config.noble_points[best_noble_i]
 
-                self.states[m_or_b].gained_nobles[player].append(self.config.nobles[best_noble_i])
+                state.gained_nobles[p][best_noble_i] = 1
 
-                noble_s = f"""Acquired noble: {self.config.nobles[best_noble_i]}"""
-
-                # Delete noble from the list
-                self.states[m_or_b].nobles_board[best_noble_i] = 0
-
-            else:
-                noble_s = ""
+                # Delete noble from the board
+                state.nobles_board[best_noble_i] = 0
 
             action_str = f"""Player {player} bought card {id_to_buy}: {self.config.cards[id_to_buy]}"""
 
@@ -489,34 +631,31 @@ class SplendorGame():
             # Reserve card
             id_to_reserve = action - self.config.n_cards
 
-            if self.states[m_or_b].board[id_to_reserve] == 1:
+            if state.board[id_to_reserve] == 1:
                 # Remove card from board
-                self.states[m_or_b].board[id_to_reserve] = 0
+                state.board[id_to_reserve] = 0
 
                 # Draw new card to take its place
                 level = self.card_id_to_level(id_to_reserve)
-                self.replenish_board(level, m_or_b)
+                self.replenish_board(level, state)
 
             else:
                 raise Exception(f"""
                     Player {player} taking action {action} trying to reserve card {id_to_reserve} but not on the board
-                        Board: {self.states[m_or_b].board}
+                        Board: {state.board}
                     """)
 
             # Add card to player reserved
-            before_reserved = self.states[m_or_b].reserved.copy()
-            self.states[m_or_b].reserved[player][id_to_reserve] = 1
+            state.reserved[p][id_to_reserve] = 1
 
             # Add yellow coin if possible
-            before_coins = self.states[m_or_b].coins[player]['y']
-
-            if self.states[m_or_b].coins[player]['y'] + self.states[m_or_b].coins[self.switch_player(player)]['y'] < 5:
-                self.states[m_or_b].coins[player]['y'] += 1
-                if sum(self.states[m_or_b].coins[player].values()) > 10:
+            if state.coins[p][5] + state.coins[o][5] < 5:
+                state.coins[p][5] += 1
+                if state.coins[p].sum() > 10:
                     # Throw away a random color
-                    random_color = 'wugrk'[np.random.choice(
-                        np.where(np.array(list(self.states[m_or_b].coins[player].values()))[:5] > 0)[0])]
-                    self.states[m_or_b].coins[player][random_color] -= 1
+                    random_color = np.random.choice(np.where(state.coins[p][:5] > 0)[0])
+                    state.coins[p][random_color] -= 1
+                    self.random_discards[m_or_b] += 1
 
             action_str = f"""Player {player} reserved card {id_to_reserve}: {self.config.cards[id_to_reserve]}"""
 
@@ -527,13 +666,12 @@ class SplendorGame():
             # 182 --> Reserve level 3 card
             level = action - (self.config.n_cards * 2) + 1
             # Draw card from the appropriate deck
-            new_id = self.states[m_or_b].id_decks[level].popleft()
-            self.states[m_or_b].reserved[player][new_id] = 1
+            new_id = self.draw_card(level, state)
+            state.reserved[p][new_id] = 1
 
             # Add yellow card if possible
-            before_coins = self.states[m_or_b].coins[player]['y']
-            if self.states[m_or_b].coins[player]['y'] + self.states[m_or_b].coins[self.switch_player(player)]['y'] < 5:
-                self.states[m_or_b].coins[player]['y'] += 1
+            if state.coins[p][5] + state.coins[o][5] < 5:
+                state.coins[p][5] += 1
 
             action_str = f"""Player {player} reserved card from level {level}: {self.config.cards[new_id]}"""
 
@@ -541,31 +679,31 @@ class SplendorGame():
         elif self.config.n_cards * 2 + 3 <= action <= self.config.n_cards * 2 + 32:
             # Take coins
             coins_string = self.take_coins_action_dict[action]
-            before_coins = self.states[m_or_b].coins[player].copy()
             for color in coins_string:
+                c = color_index[color]
                 # Check if can't take color
-                assert self.states[m_or_b].coins[player][color] + self.states[m_or_b].coins[self.switch_player(player)][
-                    color] < 4, f"Can't take color {color}. Player 1 has {self.states[m_or_b].coins[1][color]}. Player 2 has {self.states[m_or_b].coins[2][color]}"
-                self.states[m_or_b].coins[player][color] += 1
+                assert state.coins[p][c] + state.coins[o][c] < 4, f"Can't take color {color}. Player 1 has {state.coins[0][c]}. Player 2 has {state.coins[1][c]}"
+                state.coins[p][c] += 1
 
             action_str = f"""Player {player} took coins: {coins_string}"""
 
         elif action == self.config.n_cards * 2 + 33:
             # Do nothing
-            # print("##### DID NOTHING 1 #######")
             action_str = f"""Player {player} did nothing"""
             pass
         else:
             raise Exception(f"Unrecognized action: {action}")
 
         if action == self.config.n_cards * 2 + 33:
-            # print("##### DID NOTHING 2 #######")
-            self.states[m_or_b].consecutive_do_nothings += 1
+            state.consecutive_do_nothings += 1
         else:
-            self.states[m_or_b].consecutive_do_nothings = 0
+            state.consecutive_do_nothings = 0
 
         self.checkBoard(m_or_b)
-        # print(f"Player returned: {self.switch_player(player)}")
+
+        source, destination = self.mirrored_indices[p][action]
+        state.buffer[destination] = state.buffer[source]
+        self.update_hashes(state, touched, old_values)
 
         self.times['next'] += time.time() - start_time
 
@@ -582,211 +720,98 @@ class SplendorGame():
         # b.execute_move(move, player)
         # return (b.pieces, -player)
 
-    def can_buy(self, buying_power, yellow_possessed, card_cost):
-        yellow_needed = 0
-        for color in card_cost:
-            if card_cost[color] > buying_power[color]:
-                yellow_needed += card_cost[color] - buying_power[color]
-        return yellow_possessed >= yellow_needed
+    def observe(self, player, m_or_b = 'main', print_to_terminal = False):
+        """
+        Everything a search or game loop needs about the state with player to move, in one call:
+        (canonical form, valid moves mask, getGameEnded value, state key). The canonical form is a read-only view.
+        """
+        valid_moves = self.getValidMoves(None, player, m_or_b)
+        ended = self.getGameEnded(None, player, m_or_b, print_to_terminal = print_to_terminal, valid_moves = valid_moves)
+        return self.getCanonicalForm(None, player, m_or_b), valid_moves, ended, self.stringRepresentation(player, m_or_b)
+
+    def step(self, action, player, m_or_b = 'main', undo_tokens = None, print_to_terminal = False):
+        """
+        Plays action for player and observes the result for the next player in one pass.
+
+        Returns (canonical, valid_mask, ended_value, state_key, next_player), where everything but next_player is
+        from next_player's point of view (see observe). If a list is passed as undo_tokens, the move is played with
+        apply() and its undo token is appended to the list.
+        """
+        if undo_tokens is None:
+            _, next_player = self.getNextState(None, player, action, m_or_b, print_to_terminal = print_to_terminal)
+        else:
+            undo_tokens.append(self.apply(action, player, m_or_b))
+            next_player = self.switch_player(player)
 
-    def set_current_valid_moves(self, player, m_or_b):
-        self.current_valid_moves = self.getValidMoves(None, player, m_or_b)
+        return *self.observe(next_player, m_or_b, print_to_terminal = print_to_terminal), next_player
 
     def getValidMoves(self, board, player, m_or_b):
         start_time = time.time()
 
         start_i = self.config.n_cards * 2
 
-        s = self.stringRepresentation(player, m_or_b)
+        state = self.states[m_or_b]
+        p = player - 1
 
         valid_moves = np.zeros(self.getActionSize(), dtype=int)
 
-        buying_power = {}
-
-        for color in 'wugrk':
-            buying_power[color] = self.states[m_or_b].perma_gems[player][color] + self.states[m_or_b].coins[player][
-                color]
+        buying_power = state.perma_gems[p] + state.coins[p][:5]
 
         # 209 TOTAL
-        # 0-89 cards to buy
-        for i in range(self.config.n_cards):
-            if (self.states[m_or_b].board[i] or self.states[m_or_b].reserved[player][i]) and self.can_buy(buying_power,
-                                                                                                          self.states[
-                                                                                                              m_or_b].coins[
-                                                                                                              player][
-                                                                                                              'y'],
-                                                                                                          self.config.cards[
-                                                                                                              i].cost):
-                valid_moves[i] = 1
+        # 0-89 cards on the board or reserved by the player that yellow coins can cover the shortfall of
+        yellow_needed = np.maximum(self.config.card_costs - buying_power, 0).sum(1)
+        valid_moves[:self.config.n_cards] = ((state.board + state.reserved[p]) > 0) & (yellow_needed <= state.coins[p][5])
 
         # 90 - 179 cards to reserve
-        if np.sum(self.states[m_or_b].reserved[player] == 1) < 3:
-            valid_moves[self.config.n_cards:self.config.n_cards * 2] = self.states[m_or_b].board
-            # print(f"BOARD {m_or_b}: {self.states[m_or_b].board}")
-            # print(f"Debug 2: {valid_moves}")
-            # self.display_game_state(m_or_b)
+        if np.sum(state.reserved[p] == 1) < 3:
+            valid_moves[self.config.n_cards:self.config.n_cards * 2] = state.board
             # 180, 181, 182: 3 random pile cards to reserve
-            if not len(self.states[m_or_b].id_decks[1]) == 0:
+            if not state.cards_left(1) == 0:
                 valid_moves[self.config.n_cards  * 2] = 1
-            if not len(self.states[m_or_b].id_decks[2]) == 0:
+            if not state.cards_left(2) == 0:
                 valid_moves[self.config.n_cards  * 2 + 1] = 1
-            if not len(self.states[m_or_b].id_decks[3]) == 0:
+            if not state.cards_left(3) == 0:
                 valid_moves[self.config.n_cards  * 2 + 2] = 1
 
-        n_player_coins = np.sum(list(self.states[m_or_b].coins[player].values()))
-        coins_left = {}
-
-        for color in 'wugrk':
-            coins_left[color] = 4 - self.states[m_or_b].coins[1][color] - self.states[m_or_b].coins[2][color]
-
-        # 213 --> no coins
-        if n_player_coins == 10:
-            valid_moves[self.config.n_cards  * 2 + 33] = 1
-
-        # 203 --> W
-        # 204 --> U
-        # 205 --> G
-        # 206 --> R
-        # 207 --> K
-        elif n_player_coins == 9:
-            for i, color in enumerate('wugrk'):
-                if coins_left[color] > 0:
-                    valid_moves[self.config.n_cards * 2 + 23 + i] = 1
-
-
-        elif n_player_coins == 8:
-            for i, color in enumerate('wugrk'):
-                if coins_left[color] == 4:
-                    # 208 --> 2 Ws
-                    # 209 --> 2 Us
-                    # 210 --> 2 Gs
-                    # 211 --> 2 Rs
-                    # 212 --> 2 Ks
-                    valid_moves[self.config.n_cards * 2 + 28 + i] = 1
-
-            # 193 --> WU
-            # 194 --> WG
-            # 195 --> WR
-            # 196 --> WK
-            # 197 --> UG
-            # 198 --> UR
-            # 199 --> UK
-            # 200 --> GR
-            # 201 --> GK
-            # 202 --> RK
-            valid_moves[start_i + 13] = coins_left['w'] > 0 and coins_left['u'] > 0
-            valid_moves[start_i + 14] = coins_left['w'] > 0 and coins_left['g'] > 0
-            valid_moves[start_i + 15] = coins_left['w'] > 0 and coins_left['r'] > 0
-            valid_moves[start_i + 16] = coins_left['w'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 17] = coins_left['u'] > 0 and coins_left['g'] > 0
-            valid_moves[start_i + 18] = coins_left['u'] > 0 and coins_left['r'] > 0
-            valid_moves[start_i + 19] = coins_left['u'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 20] = coins_left['g'] > 0 and coins_left['r'] > 0
-            valid_moves[start_i + 21] = coins_left['g'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 22] = coins_left['r'] > 0 and coins_left['k'] > 0
-
-            coins_left_arr = np.array(list(coins_left.values()))
-            nonzero_is = np.where(coins_left_arr > 0)[0]
-            if len(nonzero_is) == 1:
-                # only one color left
-                valid_moves[start_i + 23 + nonzero_is] = 1
-
-
-        elif n_player_coins <= 7:
-            # 183 --> WUG
-            # 184 --> WUR
-            # 185 --> WUK
-            # 186 --> WGR
-            # 187 --> WGK
-            # 188 --> WRK
-            # 189 --> UGR
-            # 190 --> UGK
-            # 191 --> URK
-            # 192 --> GRK
-            valid_moves[start_i + 3] = coins_left['w'] > 0 and coins_left['u'] > 0 and coins_left['g'] > 0
-            valid_moves[start_i + 4] = coins_left['w'] > 0 and coins_left['u'] > 0 and coins_left['r'] > 0
-            valid_moves[start_i + 5] = coins_left['w'] > 0 and coins_left['u'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 6] = coins_left['w'] > 0 and coins_left['g'] > 0 and coins_left['r'] > 0
-            valid_moves[start_i + 7] = coins_left['w'] > 0 and coins_left['g'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 8] = coins_left['w'] > 0 and coins_left['r'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 9] = coins_left['u'] > 0 and coins_left['g'] > 0 and coins_left['r'] > 0
-            valid_moves[start_i + 10] = coins_left['u'] > 0 and coins_left['g'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 11] = coins_left['u'] > 0 and coins_left['r'] > 0 and coins_left['k'] > 0
-            valid_moves[start_i + 12] = coins_left['g'] > 0 and coins_left['r'] > 0 and coins_left['k'] > 0
-
-            coins_left_arr = np.array(list(coins_left.values()))
-            # Only 1 color left
-            if np.sum(coins_left_arr > 0) == 1:
-                valid_moves[start_i + 23 + np.where(coins_left_arr > 0)[0][0]] = 1
-
-            # Only 2 colors left
-            if np.sum(coins_left_arr > 0) == 2:
-                colors = "".join(np.array(list(coins_left.keys()))[np.where(coins_left_arr > 0)[0]])
-
-                if colors == 'wu':
-                    idx = start_i + 13
-                elif colors == 'wg':
-                    idx = start_i + 14
-                elif colors == 'wr':
-                    idx = start_i + 15
-                elif colors == 'wk':
-                    idx = start_i + 16
-                elif colors == 'ug':
-                    idx = start_i + 17
-                elif colors == 'ur':
-                    idx = start_i + 18
-                elif colors == 'uk':
-                    idx = start_i + 19
-                elif colors == 'gr':
-                    idx = start_i + 20
-                elif colors == 'gk':
-                    idx = start_i + 21
-                elif colors == 'rk':
-                    idx = start_i + 22
-                else:
-                    raise Exception(f"Invalid 2-color string: {colors}")
-
-                valid_moves[idx] = 1
-
-            for i, color in enumerate('wugrk'):
-                if coins_left[color] == 4:
-                    # 208 --> 2 Ws
-                    # 209 --> 2 Us
-                    # 210 --> 2 Gs
-                    # 211 --> 2 Rs
-                    # 212 --> 2 Ks
-                    valid_moves[start_i + 28 + i] = 1
+        # 183 - 213: coin actions, looked up from which colors are empty / untouched and how many coins the player has
+        coins_left = 4 - state.coins[0][:5] - state.coins[1][:5]
+        empty_bits = color_bits @ (coins_left == 0)
+        full_bits = color_bits @ (coins_left == 4)
+        bucket = self.config.coin_bucket(int(state.coins[p].sum()))
+        valid_moves[start_i + 3:start_i + 34] = self.config.coin_action_masks[bucket, empty_bits, full_bits]
         # print(f"DEBUG 3: {valid_moves}")
         self.times['valid'] += time.time() - start_time
 
         return valid_moves
 
-    def dict_values_sum(self, dict):
-        return np.sum(np.array(list(dict.values())))
-
-    def getGameEnded(self, board, player, m_or_b, print_to_terminal = False):
+    def getGameEnded(self, board, player, m_or_b, print_to_terminal = False, valid_moves = None):
         # return 0 if not ended, 1 if player 1 won, -1 if player 1 lost
+        # valid_moves: player's valid moves if they're already known, otherwise they're computed here
+
+        state = self.states[m_or_b]
 
-        # print(f"#### ARE THERE CONSECUTIVE DO NOTHINGS? {self.states[m_or_b].consecutive_do_nothings}")
-        if self.states[m_or_b].consecutive_do_nothings >= 2:
+        if state.consecutive_do_nothings >= 2:
             self.log("Game ended on consecutive do nothings!", print_to_terminal = print_to_terminal and self.verbose)
             return -2
 
-        if np.sum(self.current_valid_moves) == 0: # type: ignore
+        if valid_moves is None:
+            valid_moves = self.getValidMoves(None, player, m_or_b)
+
+        if not valid_moves.any():
             self.log(f"Game ended on no valid moves!", print_to_terminal = print_to_terminal and self.verbose)
             return -1
 
         if player == 2:
             return 0
         if player == 1:  # Can only end if just ended player 2's turn (assuming player 1 went first)
-            winningConditionMet : bool = self.states[m_or_b].scores[1] >= self.config.target_score or self.states[m_or_b].scores[2] >= self.config.target_score
+            winningConditionMet : bool = state.scores[0] >= self.config.target_score or state.scores[1] >= self.config.target_score
             opponent : int = self.switch_player(player)
             if winningConditionMet:
-                log_string = f"Game ended. Player 1: {self.states[m_or_b].scores[1]} pts, player 2: {self.states[m_or_b].scores[2]} pts, target: {self.config.target_score} pts => "
+                log_string = f"Game ended. Player 1: {state.scores[0]} pts, player 2: {state.scores[1]} pts, target: {self.config.target_score} pts => "
 
-                if self.states[m_or_b].scores[1] == self.states[m_or_b].scores[2]:
-                    player_gems = self.dict_values_sum(self.states[m_or_b].perma_gems[player])
-                    opponent_gems = self.dict_values_sum(self.states[m_or_b].perma_gems[opponent])
+                if state.scores[0] == state.scores[1]:
+                    player_gems = state.perma_gems[player - 1].sum()
+                    opponent_gems = state.perma_gems[opponent - 1].sum()
                     if player_gems > opponent_gems:
                         self.log(log_string + f"Tied but player {player} has more permanent gems! -> Player {opponent} wins", print_to_terminal = print_to_terminal and self.verbose)
                         return -1
@@ -796,21 +821,21 @@ class SplendorGame():
                     else:
                         self.log(log_string + "Tied and both players have the same number of permanent gems! -> Draw", print_to_terminal = print_to_terminal and self.verbose)
                         return -2
-                elif self.states[m_or_b].scores[player] > self.states[m_or_b].scores[opponent]:
+                elif state.scores[player - 1] > state.scores[opponent - 1]:
                     self.log(log_string + f"Player {player} wins", print_to_terminal = print_to_terminal and self.verbose)
                     return 1
-                elif self.states[m_or_b].scores[player] < self.states[m_or_b].scores[opponent]:
+                elif state.scores[player - 1] < state.scores[opponent - 1]:
                     self.log(log_string + f"Player {opponent} wins", print_to_terminal = print_to_terminal and self.verbose)
                     return -1
                 else:
                     raise Exception(f"""
                     Something went wrong with end-of-game score comparison
-                        Scores: {self.states[m_or_b].scores}
+                        Scores: {state.scores}
                         
-                        Perma-gems: {self.states[m_or_b].perma_gems}
+                        Perma-gems: {state.perma_gems}
                     """)
             else:
-                self.log(f"Game not over yet since scores are {self.states[m_or_b].scores} and target score is {self.config.target_score}")
+                self.log(f"Game not over yet since scores are {state.scores} and target score is {self.config.target_score}")
                 return 0
 
     def getCanonicalForm(self, board, player, m_or_b):
@@ -825,26 +850,13 @@ class SplendorGame():
         # 1 indicator for whether player went first
         # 10 nobles
 
-        start_time = time.time()
-        if player == 1:
-            arr =  np.concatenate(
-                [self.states[m_or_b].board, self.states[m_or_b].reserved[1], self.states[m_or_b].reserved[2],
-                 list(self.states[m_or_b].perma_gems[1].values()), list(self.states[m_or_b].perma_gems[2].values()),
-                 list(self.states[m_or_b].coins[1].values()), list(self.states[m_or_b].coins[2].values()),
-                 [self.states[m_or_b].scores[1], self.states[m_or_b].scores[2], 1],
-                 self.states[m_or_b].nobles_board
-                 ], dtype=int)
-        elif player == 2:
-            arr = np.concatenate(
-                [self.states[m_or_b].board, self.states[m_or_b].reserved[2], self.states[m_or_b].reserved[1],
-                 list(self.states[m_or_b].perma_gems[2].values()), list(self.states[m_or_b].perma_gems[1].values()),
-                 list(self.states[m_or_b].coins[2].values()), list(self.states[m_or_b].coins[1].values()),
-                 [self.states[m_or_b].scores[2], self.states[m_or_b].scores[1], -1],
-                 self.states[m_or_b].nobles_board
-                 ], dtype=int)
+        # Both canonical forms are kept up to date in the state buffer by getNextState, so this is a read-only view
+        # that changes along with the state: copy it if it needs to outlive the next move
 
-        else:
+        start_time = time.time()
+        if player != 1 and player != 2:
             raise Exception(f"Invalid player {player}")
+        arr = self.states[m_or_b].canonical[player - 1]
         self.times['get_canonical_form'] += time.time() - start_time
 
         return arr
@@ -868,38 +880,26 @@ class SplendorGame():
         return [(board, pi)]
 
     def stringRepresentation(self, player, m_or_b):
-        # print(f"Stringy: {player}, {m_or_b}")
+        # 64-bit Zobrist hash of the canonical form from player's point of view, kept up to date by getNextState
         start_time = time.time()
-        canonical_form = self.getCanonicalForm(None, player, m_or_b)
-        time1 = time.time()
+        key = int(self.states[m_or_b].hashes[player - 1])
 
-        # 292: player 1 score
-        # 293: player 2 score
-        canonical_form[self.config.n_cards * 3 + 22] = str(canonical_form[self.config.n_cards * 3 + 22]).zfill(2)
-        canonical_form[self.config.n_cards * 3 + 23] = str(canonical_form[self.config.n_cards * 3 + 23]).zfill(2)
-        time2 = time.time()
-        # print(f"Stringy canon: {canonical_form}")
-        #arr =  ''.join(map(str, canonical_form))
-        #arr = str(canonical_form)
-        arr = canonical_form.tobytes()
-        # if self.verbose:
-        #     print(f"canonicalForm: {canonical_form}\nbytes: {arr}")
-        time3 = time.time()
-        self.times['string_representation'] += time.time() - start_time
-
-        self.times['string_representation0'] += time1 - start_time
-        self.times['string_representation1'] += time2 - time1
-        self.times['string_representation2'] += time3 - time2
+        if self.check_hash_collisions:
+            canonical_bytes = self.getCanonicalForm(None, player, m_or_b).tobytes()
+            seen = self.hashed_boards.setdefault(key, canonical_bytes)
+            if seen != canonical_bytes:
+                raise Exception(f"Hash collision: two different canonical forms share the key {key}")
 
+        self.times['string_representation'] += time.time() - start_time
 
-        return arr
+        return key
 
     # def stringRepresentationReadable(self, board):
     #     board_s = "".join(self.square_content[square] for row in board for square in row)
     #     return board_s
 
     def getScore(self, player, m_or_b):
-        return self.states[m_or_b].scores[player]
+        return self.states[m_or_b].scores[player - 1]
 
     def beautify_board(self, m_or_b):
         level_1_cards = []
@@ -928,7 +928,7 @@ class SplendorGame():
             Player {player}:
             """
             for color in 'wugrk':
-                s += f""" {color.upper()}: {self.states[m_or_b].perma_gems[player][color]} """
+                s += f""" {color.upper()}: {self.states[m_or_b].perma_gems[player - 1][color_index[color]]} """
         return s
 
     def beautify_coins(self, m_or_b):
@@ -938,22 +938,22 @@ class SplendorGame():
             Player {player}:
             """
             for color in 'wugrk':
-                if self.states[m_or_b].perma_gems[player][color] > 0:
-                    perma_gem_str = f"[{self.states[m_or_b].perma_gems[player][color]}]"
+                if self.states[m_or_b].perma_gems[player - 1][color_index[color]] > 0:
+                    perma_gem_str = f"[{self.states[m_or_b].perma_gems[player - 1][color_index[color]]}]"
                 else:
                     perma_gem_str = ""
-                s += f""" {color.upper()}: {perma_gem_str}{self.states[m_or_b].coins[player][color]} """
-            s += f""" Y: {self.states[m_or_b].coins[player]['y']} """
+                s += f""" {color.upper()}: {perma_gem_str}{self.states[m_or_b].coins[player - 1][color_index[color]]} """
+            s += f""" Y: {self.states[m_or_b].coins[player - 1][5]} """
 
         return s
 
     def beautify_coins_left(self, m_or_b):
         color_strs = []
         for color in 'wugrk':
-            coins_left = 4 - self.states[m_or_b].coins[1][color] - self.states[m_or_b].coins[2][color]
+            coins_left = 4 - self.states[m_or_b].coins[0][color_index[color]] - self.states[m_or_b].coins[1][color_index[color]]
             color_strs.append(f"{coins_left}{color}")
 
-        color_strs.append(f"{5 - self.states[m_or_b].coins[1]['y'] - self.states[m_or_b].coins[2]['y']}y")
+        color_strs.append(f"{5 - self.states[m_or_b].coins[0][5] - self.states[m_or_b].coins[1][5]}y")
 
         return ' '.join(color_strs)
         # for player in [1,2]:
@@ -974,9 +974,9 @@ class SplendorGame():
         p1_cards = []
         p2_cards = []
 
-        for i in np.where(self.states[m_or_b].reserved[1] == 1)[0]:
+        for i in np.where(self.states[m_or_b].reserved[0] == 1)[0]:
             p1_cards.append(self.config.cards[i])
-        for i in np.where(self.states[m_or_b].reserved[2] == 1)[0]:
+        for i in np.where(self.states[m_or_b].reserved[1] == 1)[0]:
             p2_cards.append(self.config.cards[i])
 
         return f"""
@@ -986,8 +986,8 @@ class SplendorGame():
     def beautify_nobles(self, m_or_b):
         return f"""
         Available: {' | '.join([str(noble) for noble in np.array(self.config.nobles)[np.array(self.states[m_or_b].nobles_board).astype(bool)]])}
-        Player 1: {' | '.join([str(noble) for noble in self.states[m_or_b].gained_nobles[1]])}
-        Player 2: {' | '.join([str(noble) for noble in self.states[m_or_b].gained_nobles[2]])}"""
+        Player 1: {' | '.join([str(self.config.nobles[i]) for i in np.where(self.states[m_or_b].gained_nobles[0] == 1)[0]])}
+        Player 2: {' | '.join([str(self.config.nobles[i]) for i in np.where(self.states[m_or_b].gained_nobles[1] == 1)[0]])}"""
 
     def convert_action_to_readable(self, a):
         if a < self.config.n_cards:
@@ -1145,7 +1145,7 @@ class SplendorGame():
         tabs = '\t\t'
         self.log(f"""
         {tabs}Scores:
-        {tabs}    1: {self.states[m_or_b].scores[1]} | 2: {self.states[m_or_b].scores[2]}
+        {tabs}    1: {self.states[m_or_b].scores[0]} | 2: {self.states[m_or_b].scores[1]}
         {tabs}
         {tabs}Board:
         {tabs}        {self.beautify_board(m_or_b)}
@@ -1181,12 +1181,12 @@ class SplendorGame():
             if match:
                 number = int(match.group(0))
                 try:
-                    card_i = np.where(self.states[m_or_b].reserved[player] == 1)[0][number]
+                    card_i = np.where(self.states[m_or_b].reserved[player - 1] == 1)[0][number]
                     action = card_i
                     return action
                 except IndexError:
                     raise Exception(
-                        f"Tried to get {number}th reserved card but only {np.where(self.states[m_or_b].reserved[player] == 1)[0]} reserved")
+                        f"Tried to get {number}th reserved card but only {np.where(self.states[m_or_b].reserved[player - 1] == 1)[0]} reserved")
 
             else:
                 raise Exception(f"Invalid input_action {input_action}")
@@ -1257,25 +1257,26 @@ class SplendorGame():
 
     def display_valid_moves(self, player, m_or_b):
         tabs = "\t\t\t"
+        valid_moves = self.getValidMoves(None, player, m_or_b)
         self.log(f"""
         {tabs}VALID:
-        {tabs}Level 1 buy:{np.where(self.current_valid_moves[:self.config.n_level_1_cards] == 1)[0]}
-        {tabs}Level 2 buy:{np.where(self.current_valid_moves[self.config.n_level_1_cards:(self.config.n_level_1_cards + self.config.n_level_2_cards)] == 1)[0] + self.config.n_level_1_cards}
-        {tabs}Level 3 buy:{np.where(self.current_valid_moves[(self.config.n_level_1_cards + self.config.n_level_2_cards):(self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards)] == 1)[0] + self.config.n_level_1_cards + self.config.n_level_2_cards}
-
-        {tabs}Level 1 reserve:{np.where(self.current_valid_moves[self.config.n_cards:(self.config.n_cards + self.config.n_level_1_cards)] == 1)[0]}
-        {tabs}Level 2 reserve:{np.where(self.current_valid_moves[(self.config.n_cards + self.config.n_level_1_cards):(self.config.n_cards + self.config.n_level_1_cards + self.config.n_level_2_cards)] == 1)[0] + self.config.n_level_1_cards}
-        {tabs}Level 3 reserve:{np.where(self.current_valid_moves[(self.config.n_cards + self.config.n_level_1_cards + self.config.n_level_2_cards):(self.config.n_cards + self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards)] == 1)[0] + self.config.n_level_1_cards + self.config.n_level_2_cards}
-
-        {tabs}Level 1 reserve random:{self.current_valid_moves[self.config.n_cards * 2]}
-        {tabs}Level 2 reserve random:{self.current_valid_moves[self.config.n_cards * 2 + 1]}
-        {tabs}Level 3 reserve random:{self.current_valid_moves[self.config.n_cards * 2 + 2]}
-
-        {tabs}Taking 3 coins:{self.current_valid_moves[(self.config.n_cards * 2 + 3):(self.config.n_cards * 2 + 13)]}
-        {tabs}Taking 2 coins:{self.current_valid_moves[(self.config.n_cards * 2 + 13):(self.config.n_cards * 2 + 23)]}
-        {tabs}Taking 1 coins:{self.current_valid_moves[(self.config.n_cards * 2 + 23):(self.config.n_cards * 2 + 28)]}
-        {tabs}Taking 2 coins of the same color:{self.current_valid_moves[(self.config.n_cards * 2 + 28):(self.config.n_cards * 2 + 33)]}
-        {tabs}Taking no coins:{self.current_valid_moves[self.config.n_cards * 2 + 33]}
+        {tabs}Level 1 buy:{np.where(valid_moves[:self.config.n_level_1_cards] == 1)[0]}
+        {tabs}Level 2 buy:{np.where(valid_moves[self.config.n_level_1_cards:(self.config.n_level_1_cards + self.config.n_level_2_cards)] == 1)[0] + self.config.n_level_1_cards}
+        {tabs}Level 3 buy:{np.where(valid_moves[(self.config.n_level_1_cards + self.config.n_level_2_cards):(self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards)] == 1)[0] + self.config.n_level_1_cards + self.config.n_level_2_cards}
+
+        {tabs}Level 1 reserve:{np.where(valid_moves[self.config.n_cards:(self.config.n_cards + self.config.n_level_1_cards)] == 1)[0]}
+        {tabs}Level 2 reserve:{np.where(valid_moves[(self.config.n_cards + self.config.n_level_1_cards):(self.config.n_cards + self.config.n_level_1_cards + self.config.n_level_2_cards)] == 1)[0] + self.config.n_level_1_cards}
+        {tabs}Level 3 reserve:{np.where(valid_moves[(self.config.n_cards + self.config.n_level_1_cards + self.config.n_level_2_cards):(self.config.n_cards + self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards)] == 1)[0] + self.config.n_level_1_cards + self.config.n_level_2_cards}
+
+        {tabs}Level 1 reserve random:{valid_moves[self.config.n_cards * 2]}
+        {tabs}Level 2 reserve random:{valid_moves[self.config.n_cards * 2 + 1]}
+        {tabs}Level 3 reserve random:{valid_moves[self.config.n_cards * 2 + 2]}
+
+        {tabs}Taking 3 coins:{valid_moves[(self.config.n_cards * 2 + 3):(self.config.n_cards * 2 + 13)]}
+        {tabs}Taking 2 coins:{valid_moves[(self.config.n_cards * 2 + 13):(self.config.n_cards * 2 + 23)]}
+        {tabs}Taking 1 coins:{valid_moves[(self.config.n_cards * 2 + 23):(self.config.n_cards * 2 + 28)]}
+        {tabs}Taking 2 coins of the same color:{valid_moves[(self.config.n_cards * 2 + 28):(self.config.n_cards * 2 + 33)]}
+        {tabs}Taking no coins:{valid_moves[self.config.n_cards * 2 + 33]}
         """)
 
 
@@ -1296,15 +1297,15 @@ class SplendorGame():
 
                 if "RESERVED" in input_action.upper():
                     print("Player 1:")
+                    print(f"Level 1:{self.states['main'].reserved[0][:self.config.n_level_1_cards]}")
+                    print(f"Level 2:{self.states['main'].reserved[0][self.config.n_level_1_cards:self.config.n_level_1_cards + self.config.n_level_2_cards]}")
+                    print(f"Level 3:{self.states['main'].reserved[0][self.config.n_level_1_cards + self.config.n_level_2_cards:self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards]}")
+
+                    print("Player 2:")
                     print(f"Level 1:{self.states['main'].reserved[1][:self.config.n_level_1_cards]}")
                     print(f"Level 2:{self.states['main'].reserved[1][self.config.n_level_1_cards:self.config.n_level_1_cards + self.config.n_level_2_cards]}")
                     print(f"Level 3:{self.states['main'].reserved[1][self.config.n_level_1_cards + self.config.n_level_2_cards:self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards]}")
 
-                    print("Player 2:")
-                    print(f"Level 1:{self.states['main'].reserved[2][:self.config.n_level_1_cards]}")
-                    print(f"Level 2:{self.states['main'].reserved[2][self.config.n_level_1_cards:self.config.n_level_1_cards + self.config.n_level_2_cards]}")
-                    print(f"Level 3:{self.states['main'].reserved[2][self.config.n_level_1_cards + self.config.n_level_2_cards:self.config.n_level_1_cards + self.config.n_level_2_cards + self.config.n_level_3_cards]}")
-
                 if "VALID" in input_action.upper():
                     self.display_valid_moves(current_player, 'main')
 
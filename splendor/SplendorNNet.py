@@ -44,4 +44,43 @@ class SplendorNNet(nn.Module):
         pi = self.layer_to_action(s)
         v = self.layer_to_value(s)
         
-        return F.log_softmax(pi, dim=1), torch.tanh(v)
\ No newline at end of file
+        return F.log_softmax(pi, dim=1), torch.tanh(v)
+
+def fold_batch_norm(bn, linear):
+    # Linear layer computing linear(bn(x)) for an eval-mode BatchNorm1d bn
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+
+    folded = nn.Linear(linear.in_features, linear.out_features)
+    folded.weight.copy_(linear.weight * scale)
+    folded.bias.copy_(linear.bias + linear.weight @ shift)
+    return folded
+
+
+class SplendorInferenceNet(nn.Module):
+    """
+    Frozen copy of a trained SplendorNNet for inference. Each BatchNorm is folded into the Linear layers after it and
+    the dropouts (no-ops in eval mode) are gone. Returns probabilities instead of log probabilities.
+    """
+
+    def __init__(self, net : SplendorNNet):
+        super(SplendorInferenceNet, self).__init__()
+
+        with torch.no_grad():
+            self.dense1 = nn.Linear(net.dense1.in_features, net.dense1.out_features)
+            self.dense1.load_state_dict(net.dense1.state_dict())
+            self.dense2 = fold_batch_norm(net.bn1, net.dense2)
+            self.dense3 = fold_batch_norm(net.bn2, net.dense3)
+            self.layer_to_action = fold_batch_norm(net.bn3, net.layer_to_action)
+            self.layer_to_value = fold_batch_norm(net.bn3, net.layer_to_value)
+
+        self.to(net.dense1.weight.device)
+        self.eval()
+        for parameter in self.parameters():
+            parameter.requires_grad_(False)
+
+    def forward(self, s):
+        s = F.relu(self.dense1(s))
+        s = F.relu(self.dense2(s))
+        s = F.relu(self.dense3(s))
+        return F.softmax(self.layer_to_action(s), dim=1), torch.tanh(self.layer_to_value(s))
@@ -0,0 +1,290 @@
+import numpy as np
+from numpy.typing import NDArray
+
+from splendor.SplendorGame import SplendorGame, SplendorGameState, cards_per_row_count, color_bits, state_dtype, zobrist_value_mask
+from splendor.config import take_coins_actions
+
+
+class SplendorVecEnv():
+    """
+    N independent Splendor games advanced together with batched NumPy calls.
+
+    Row i of self.buffer is laid out exactly like a SplendorGameState buffer (see SplendorStateLayout), so each field
+    below is a column view with a leading game axis: board (N, n_cards), coins (N, 2, 6), scores (N, 2), etc.
+    self.players holds the player to move in each game. The rules are the ones in SplendorGame.getNextState /
+    getValidMoves / getGameEnded, applied to every game at once.
+    """
+
+    def __init__(self, game : SplendorGame, n_envs : int, randomize : bool | None = None, seed : int | None = None):
+        self.game : SplendorGame = game
+        self.config = game.config
+        self.layout = game.layout
+        self.n_envs : int = n_envs
+        self.randomize : bool = game.randomize if randomize is None else randomize
+        self.rng : np.random.Generator = np.random.default_rng(seed)
+
+        layout = self.layout
+        n_cards = layout.n_cards
+        n_nobles = layout.n_nobles
+        cs = layout.canonical_size
+
+        self.buffer : NDArray[np.int16] = np.zeros((n_envs, layout.size), dtype=state_dtype)
+        self.players : NDArray[np.int_] = np.ones(n_envs, dtype=int)
+
+        b = self.buffer
+        self.board : NDArray[np.int16] = b[:, layout.board:layout.board + n_cards]
+        self.reserved : NDArray[np.int16] = b[:, layout.reserved:layout.reserved + 2 * n_cards].reshape(n_envs, 2, n_cards)
+        self.perma_gems : NDArray[np.int16] = b[:, layout.perma_gems:layout.perma_gems + 10].reshape(n_envs, 2, 5)
+        self.coins : NDArray[np.int16] = b[:, layout.coins:layout.coins + 12].reshape(n_envs, 2, 6)
+        self.scores : NDArray[np.int16] = b[:, layout.scores:layout.scores + 2]
+        self.nobles_board : NDArray[np.int16] = b[:, layout.nobles_board:layout.nobles_board + n_nobles]
+        self.gained_nobles : NDArray[np.int16] = b[:, layout.gained_nobles:layout.gained_nobles + 2 * n_nobles].reshape(n_envs, 2, n_nobles)
+        self.consecutive_do_nothings : NDArray[np.int16] = b[:, layout.consecutive_do_nothings]
+        self.deck_pointers : NDArray[np.int16] = b[:, layout.deck_pointers:layout.deck_pointers + 3]
+        self.deck : NDArray[np.int16] = b[:, layout.deck:layout.deck + n_cards]
+        self.hashes : NDArray[np.uint64] = b[:, layout.hashes:layout.hashes + 8].view(np.uint64)
+        self.canonical_boards : NDArray[np.int16] = b[:, :2 * cs].reshape(n_envs, 2, cs)
+
+        # Coins each take-coins action (in take_coins_actions order, ending with do nothing) adds, per color
+        self.coin_action_deltas : NDArray[np.int_] = np.array(
+            [[colors.count(color) for color in 'wugrk'] for colors in take_coins_actions], dtype=int
+        )
+        self.env_indices : NDArray[np.int_] = np.arange(n_envs)
+
+        self.reset()
+
+    def reset(self, env_indices = None):
+        """Starts new games in env_indices (all games by default), with player 1 to move."""
+        if env_indices is None:
+            env_indices = self.env_indices
+        env_indices = np.asarray(env_indices, dtype=int)
+        n = len(env_indices)
+        layout = self.layout
+        n_cards = layout.n_cards
+
+        self.buffer[env_indices] = 0
+
+        # Shuffle each level's segment of the deck independently: sorting random keys offset by level keeps the
+        # segments apart
+        if self.randomize:
+            sort_keys = self.rng.random((n, n_cards)) + self.config.card_levels
+            decks = np.argsort(sort_keys, axis=1)
+        else:
+            decks = np.tile(np.arange(n_cards), (n, 1))
+        self.deck[env_indices] = decks
+
+        # Deal the first cards of each level's deck
+        for level in [1, 2, 3]:
+            start, end = layout.deck_starts[level - 1], layout.deck_ends[level - 1]
+            n_dealt = min(cards_per_row_count, end - start)
+            self.board[env_indices[:, None], decks[:, start:start + n_dealt]] = 1
+            self.deck_pointers[env_indices, level - 1] = start + n_dealt
+
+        # Pick 3 nobles
+        n_nobles = layout.n_nobles
+        n_to_sample = min(3, n_nobles)
+        if self.randomize:
+            nobles = np.argsort(self.rng.random((n, n_nobles)), axis=1)[:, :n_to_sample]
+        else:
+            nobles = np.tile(np.arange(n_to_sample), (n, 1))
+        self.nobles_board[env_indices[:, None], nobles] = 1
+
+        # Player 1 always goes first
+        self.buffer[env_indices, layout.first_player] = 1
+        self.players[env_indices] = 1
+
+        self.sync(env_indices)
+
+    def sync(self, env_indices):
+        # Rebuild player 2's canonical board and both hashes of the given games from the rest of their state
+        layout = self.layout
+        cs = layout.canonical_size
+        b = self.buffer
+        b[env_indices, cs:2 * cs] = b[env_indices[:, None], layout.player_2_canonical_index]
+        b[env_indices, cs + layout.first_player] = -1
+        self.hashes[env_indices] = self.hash_canonical_boards(self.canonical_boards[env_indices])
+
+    def hash_canonical_boards(self, canonical_boards):
+        # Zobrist hash (as in SplendorGame.stringRepresentation) of canonical boards with any leading shape
+        keys = self.game.zobrist_keys[0, :self.layout.canonical_size]
+        values = canonical_boards & zobrist_value_mask
+        return np.bitwise_xor.reduce(keys[np.arange(keys.shape[0]), values], axis=-1)
+
+    def get_state(self, env_index) -> SplendorGameState:
+        """A SplendorGameState viewing game env_index (changes to it write through to this env)."""
+        return SplendorGameState(self.layout, self.buffer[env_index])
+
+    def canonical(self):
+        """(N, getBoardSize()) canonical boards, each from the point of view of the game's player to move."""
+        return self.canonical_boards[self.env_indices, self.players - 1]
+
+    def state_keys(self):
+        """(N,) uint64 state keys (SplendorGame.stringRepresentation) for the player to move in each game."""
+        return self.hashes[self.env_indices, self.players - 1]
+
+    def valid_moves(self):
+        """(N, getActionSize()) valid moves mask of the player to move in each game."""
+        config = self.config
+        n_cards = config.n_cards
+        idx = self.env_indices
+        p = self.players - 1
+
+        coins = self.coins[idx, p]
+        reserved = self.reserved[idx, p]
+        valid_moves = np.zeros((self.n_envs, self.game.getActionSize()), dtype=int)
+
+        # Cards on the board or reserved by the player that yellow coins can cover the shortfall of
+        buying_power = self.perma_gems[idx, p] + coins[:, :5]
+        yellow_needed = np.maximum(config.card_costs[None] - buying_power[:, None], 0).sum(2)
+        valid_moves[:, :n_cards] = ((self.board + reserved) > 0) & (yellow_needed <= coins[:, 5, None])
+
+        # Reserving, as long as the player has fewer than 3 reserved cards
+        can_reserve = (reserved == 1).sum(1) < 3
+        valid_moves[:, n_cards:n_cards * 2] = self.board * can_reserve[:, None]
+        cards_left = self.layout.deck_ends - self.deck_pointers
+        valid_moves[:, n_cards * 2:n_cards * 2 + 3] = (cards_left > 0) & can_reserve[:, None]
+
+        # Coin actions, looked up from the empty / untouched colors and the player's coin count
+        coins_left = 4 - self.coins[:, 0, :5] - self.coins[:, 1, :5]
+        empty_bits = (coins_left == 0) @ color_bits
+        full_bits = (coins_left == 4) @ color_bits
+        bucket = np.clip(coins.sum(1) - 7, 0, 4)
+        valid_moves[:, n_cards * 2 + 3:n_cards * 2 + 34] = config.coin_action_masks[bucket, empty_bits, full_bits]
+
+        return valid_moves
+
+    def game_ended(self, valid_moves = None):
+        """(N,) SplendorGame.getGameEnded values for the player to move in each game."""
+        if valid_moves is None:
+            valid_moves = self.valid_moves()
+        idx = self.env_indices
+        p = self.players - 1
+        o = 1 - p
+
+        score = self.scores[idx, p]
+        opponent_score = self.scores[idx, o]
+        gems = self.perma_gems[idx, p].sum(1)
+        opponent_gems = self.perma_gems[idx, o].sum(1)
+
+        # Ties on score go to whoever has fewer permanent gems, and a tie on both is a draw (-2)
+        result = np.sign(score - opponent_score)
+        tied = result == 0
+        result[tied] = np.sign(opponent_gems - gems)[tied]
+        result[tied & (result == 0)] = -2
+
+        # The game can only end once player 2 has finished a turn, i.e. with player 1 to move
+        winning_condition_met = (self.scores >= self.config.target_score).any(1)
+        ended = np.where((self.players == 1) & winning_condition_met, result, 0)
+        ended[~valid_moves.any(1)] = -1
+        ended[self.consecutive_do_nothings >= 2] = -2
+
+        return ended
+
+    def observe(self):
+        """(canonical, valid_mask, ended_value, state_key) for every game, like SplendorGame.observe."""
+        valid_moves = self.valid_moves()
+        return self.canonical(), valid_moves, self.game_ended(valid_moves), self.state_keys()
+
+    def step(self, actions):
+        """
+        Plays actions[i] for the player to move in game i, for every game at once. Actions must be valid.
+
+        Returns (canonical, valid_mask, ended_value, state_key, players) for the players now to move, like
+        SplendorGame.step. Games that have ended must be reset() before stepping them again.
+        """
+        config = self.config
+        n_cards = config.n_cards
+        actions = np.asarray(actions, dtype=int)
+        p = self.players - 1
+
+        is_buy = actions < n_cards
+        is_reserve = (actions >= n_cards) & (actions < n_cards * 2)
+        is_blind_reserve = (actions >= n_cards * 2) & (actions < n_cards * 2 + 3)
+        is_coins = actions >= n_cards * 2 + 3
+
+        if is_buy.any():
+            self.buy(self.env_indices[is_buy], p[is_buy], actions[is_buy])
+        if is_reserve.any():
+            self.reserve(self.env_indices[is_reserve], p[is_reserve], actions[is_reserve] - n_cards)
+        if is_blind_reserve.any():
+            self.blind_reserve(self.env_indices[is_blind_reserve], p[is_blind_reserve], actions[is_blind_reserve] - n_cards * 2 + 1)
+        if is_coins.any():
+            idx = self.env_indices[is_coins]
+            self.coins[idx, p[is_coins], :5] += self.coin_action_deltas[actions[is_coins] - (n_cards * 2 + 3)]
+
+        is_nothing = actions == n_cards * 2 + 33
+        self.consecutive_do_nothings[:] = np.where(is_nothing, self.consecutive_do_nothings + 1, 0)
+
+        self.sync(self.env_indices)
+        self.players = 3 - self.players
+
+        return *self.observe(), self.players
+
+    def replenish_board(self, idx, levels):
+        # Deal the next card of each level's deck onto the board, where there's one left
+        pointers = self.deck_pointers[idx, levels - 1]
+        has_cards = pointers < self.layout.deck_ends[levels - 1]
+        idx, levels, pointers = idx[has_cards], levels[has_cards], pointers[has_cards]
+        self.board[idx, self.deck[idx, pointers]] = 1
+        self.deck_pointers[idx, levels - 1] = pointers + 1
+
+    def take_yellow_coin(self, idx, p):
+        # The player gets a yellow coin if any are left; returns which games gave one
+        gets_yellow = self.coins[idx, 0, 5] + self.coins[idx, 1, 5] < 5
+        self.coins[idx[gets_yellow], p[gets_yellow], 5] += 1
+        return gets_yellow
+
+    def buy(self, idx, p, card_ids):
+        config = self.config
+        o = 1 - p
+
+        # Take the card off the board (dealing a replacement) or out of the player's reserved cards
+        from_board = self.board[idx, card_ids] == 1
+        self.board[idx[from_board], card_ids[from_board]] = 0
+        self.reserved[idx[~from_board], p[~from_board], card_ids[~from_board]] = 0
+        self.replenish_board(idx[from_board], config.card_levels[card_ids[from_board]])
+
+        # Pay with colored coins first, yellow coins cover the rest
+        coins = self.coins[idx, p]
+        coins_needed = np.maximum(config.card_costs[card_ids] - self.perma_gems[idx, p], 0)
+        colored_paid = np.minimum(coins_needed, coins[:, :5])
+        coins[:, :5] -= colored_paid
+        coins[:, 5] -= (coins_needed - colored_paid).sum(1)
+        self.coins[idx, p] = coins
+
+        self.perma_gems[idx, p, config.card_colors[card_ids]] += 1
+        self.scores[idx, p] += config.card_points[card_ids]
+
+        # Nobles: of those the player now qualifies for, take the one the opponent is closest to (lowest index on
+        # ties)
+        gems = self.perma_gems[idx, p]
+        qualified = (self.nobles_board[idx] == 1) & (gems[:, None] >= config.noble_costs[None]).all(2)
+        opponent_distance = np.maximum(config.noble_costs[None] - self.perma_gems[idx, o][:, None], 0).sum(2)
+        best_noble = np.argmin(np.where(qualified, opponent_distance, np.iinfo(int).max), axis=1)
+        gets_noble = qualified.any(1)
+
+        idx, p, best_noble = idx[gets_noble], p[gets_noble], best_noble[gets_noble]
+        self.scores[idx, p] += config.noble_points[best_noble]
+        self.gained_nobles[idx, p, best_noble] = 1
+        self.nobles_board[idx, best_noble] = 0
+
+    def reserve(self, idx, p, card_ids):
+        self.board[idx, card_ids] = 0
+        self.replenish_board(idx, self.config.card_levels[card_ids])
+        self.reserved[idx, p, card_ids] = 1
+
+        # Over 10 coins after the yellow coin: throw away a random color the player has
+        gets_yellow = self.take_yellow_coin(idx, p)
+        idx, p = idx[gets_yellow], p[gets_yellow]
+        coins = self.coins[idx, p]
+        too_many = coins.sum(1) > 10
+        if too_many.any():
+            idx, p, coins = idx[too_many], p[too_many], coins[too_many]
+            random_colors = np.argmax(np.where(coins[:, :5] > 0, self.rng.random((len(idx), 5)), -1), axis=1)
+            self.coins[idx, p, random_colors] -= 1
+
+    def blind_reserve(self, idx, p, levels):
+        pointers = self.deck_pointers[idx, levels - 1]
+        self.reserved[idx, p, self.deck[idx, pointers]] = 1
+        self.deck_pointers[idx, levels - 1] = pointers + 1
+        self.take_yellow_coin(idx, p)
@@ -2,6 +2,14 @@ from abc import ABC
 from enum import Enum
 from typing import Dict, List
 
+import numpy as np
+from numpy.typing import NDArray
+
+
+# Coin-taking actions in action order (the last one, taking no coins, is the do-nothing action)
+take_coins_actions = ['wug', 'wur', 'wuk', 'wgr', 'wgk', 'wrk', 'ugr', 'ugk', 'urk', 'grk', 'wu', 'wg', 'wr', 'wk', 'ug',
+                      'ur', 'uk', 'gr', 'gk', 'rk', 'w', 'u', 'g', 'r', 'k', 'ww', 'uu', 'gg', 'rr', 'kk', '']
+
 
 class Card():
     def __init__(self, level : int, color : str, pv : int, w : int, u : int, g : int, r : int, k : int):
@@ -79,8 +87,64 @@ class SplendorConfig(ABC):
         self.n_cards : int = len(row_1_cards) + len(row_2_cards) + len(row_3_cards)
         self.n_nobles : int = len(nobles)
 
+        self.compile_arrays()
+
         self._registry[variant] = self
 
+    def compile_arrays(self):
+        """Compiles the cards and nobles into dense arrays (colors in 'wugrk' order) for the game engine."""
+        cards = [self.cards[i] for i in sorted(self.cards)]
+
+        # Indexed by card id
+        self.card_costs : NDArray[np.int_] = np.array([[card.cost[color] for color in 'wugrk'] for card in cards], dtype=int).reshape(-1, 5)
+        self.card_colors : NDArray[np.int_] = np.array(['wugrk'.index(card.color) for card in cards], dtype=int)
+        self.card_points : NDArray[np.int_] = np.array([card.pv for card in cards], dtype=int)
+        self.card_levels : NDArray[np.int_] = np.array([card.level for card in cards], dtype=int)
+
+        # Indexed by position in self.nobles
+        self.noble_costs : NDArray[np.int_] = np.array([[noble.cost[color] for color in 'wugrk'] for noble in self.nobles], dtype=int).reshape(-1, 5)
+        self.noble_points : NDArray[np.int_] = np.array([noble.pv for noble in self.nobles], dtype=int)
+
+        self.coin_action_masks : NDArray[np.int8] = self.compile_coin_action_masks()
+
+    @staticmethod
+    def coin_bucket(n_player_coins : int) -> int:
+        # 0: 7 coins or fewer, 1: 8 coins, 2: 9 coins, 3: 10 coins, 4: more than 10 (a blind reserve can add an 11th)
+        return min(max(n_player_coins - 7, 0), 4)
+
+    def compile_coin_action_masks(self) -> NDArray[np.int8]:
+        """
+        Which of the 31 take_coins_actions are legal, indexed by [coin bucket, colors with 0 coins left (bitmask over
+        'wugrk'), colors with all 4 coins left (bitmask)]. These are the only facts the coin rules look at.
+        """
+        masks = np.zeros((5, 32, 32, len(take_coins_actions)), dtype=np.int8)
+
+        for empty_bits in range(32):
+            for full_bits in range(32):
+                if empty_bits & full_bits:
+                    continue
+                empty = [bool(empty_bits >> i & 1) for i in range(5)]
+                full = [bool(full_bits >> i & 1) for i in range(5)]
+                available = ''.join(color for i, color in enumerate('wugrk') if not empty[i])
+
+                for i, colors in enumerate(take_coins_actions):
+                    taking_different = len(set(colors)) == len(colors) and all(color in available for color in colors)
+                    taking_two_same = len(colors) == 2 and colors[0] == colors[1] and full['wugrk'.index(colors[0])]
+
+                    # More than 10 coins: no coin action at all
+                    # 10 coins: can only do nothing
+                    masks[3, empty_bits, full_bits, i] = colors == ''
+                    # 9 coins: take any 1 available color
+                    masks[2, empty_bits, full_bits, i] = len(colors) == 1 and taking_different
+                    # 8 coins: take 2 different colors or 2 of a full color, or the last color if only 1 is left
+                    masks[1, empty_bits, full_bits, i] = taking_two_same or (len(colors) == 2 and taking_different) or \
+                                                         (len(available) == 1 and colors == available)
+                    # 7 coins or fewer: take 3 different colors or 2 of a full color, or all that's left if only 1 or 2 colors are left
+                    masks[0, empty_bits, full_bits, i] = taking_two_same or (len(colors) == 3 and taking_different) or \
+                                                         (len(available) in [1, 2] and colors == available)
+
+        return masks
+
     @classmethod
     def get_config(cls, variant: SplendorGameVariant):
         return cls._registry[variant]
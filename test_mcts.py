@@ -0,0 +1,439 @@
+import pickle
+import sys
+import unittest
+
+import numpy as np
+
+from EvalCache import EvalCache
+from MCTS import MCTS, RootParallelPool
+from NodeTable import NodeTable
+from splendor.SplendorGame import SplendorGame as Game
+from splendor.config import SplendorGameVariant
+from utils import dotdict
+
+
+class UniformNNet():
+    """Stand-in network: uniform policy and a value of 0 everywhere."""
+
+    def __init__(self, game):
+        self.action_size = game.getActionSize()
+
+    def predict(self, board):
+        return np.ones(self.action_size) / self.action_size, 0.0
+
+    def predict_batch(self, boards):
+        return np.ones((len(boards), self.action_size)) / self.action_size, np.zeros(len(boards))
+
+
+class SkewedNNet(UniformNNet):
+    """Stand-in network that prefers higher actions, so the search settles on one move."""
+
+    def predict(self, board):
+        pi = np.exp(5. * (np.arange(self.action_size) - self.action_size))
+        return pi / pi.sum(), 0.0
+
+
+class CountingNNet(UniformNNet):
+    """Uniform stand-in network with an evaluation cache, counting the boards it evaluates."""
+
+    def __init__(self, game):
+        super().__init__(game)
+        self.weights_version = 1
+        self.eval_cache = EvalCache(self.action_size, capacity = 1000)
+        self.n_evaluated = 0
+
+    def predict(self, board):
+        self.n_evaluated += 1
+        return super().predict(board)
+
+
+def uniform_onnx_model(board_size, action_size):
+    # An ONNX model in NNetWrapper.export_onnx's format with a uniform policy and a value of 0, built without torch
+    from onnx import TensorProto, helper
+    graph = helper.make_graph(
+        [helper.make_node('MatMul', ['boards', 'policy_weights'], ['logits']),
+         helper.make_node('Softmax', ['logits'], ['pis'], axis=1),
+         helper.make_node('MatMul', ['boards', 'value_weights'], ['vs'])],
+        'uniform',
+        [helper.make_tensor_value_info('boards', TensorProto.FLOAT, ['batch', board_size])],
+        [helper.make_tensor_value_info('pis', TensorProto.FLOAT, ['batch', action_size]),
+         helper.make_tensor_value_info('vs', TensorProto.FLOAT, ['batch', 1])],
+        [helper.make_tensor('policy_weights', TensorProto.FLOAT, [board_size, action_size], [0.] * board_size * action_size),
+         helper.make_tensor('value_weights', TensorProto.FLOAT, [board_size, 1], [0.] * board_size)])
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid('', 17)], ir_version=8).SerializeToString()
+
+
+def torch_imported():
+    return 'torch' in sys.modules
+
+
+class TestEvalCache(unittest.TestCase):
+    def test_lru(self):
+        cache = EvalCache(3, capacity = 2)
+        cache.sync(1)
+        cache.put(10, [0.5, 0.5, 0], 0.25)
+        cache.put(11, [1, 0, 0], -1)
+        self.assertEqual(cache.get(10)[1], 0.25)
+        cache.put(12, [0, 0, 1], 0)
+
+        # 11 was the least recently used
+        self.assertIsNone(cache.get(11))
+        np.testing.assert_array_equal(cache.get(12)[0], [0, 0, 1])
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # New weights drop everything
+        cache.sync(2)
+        self.assertEqual(len(cache), 0)
+
+    def test_shared(self):
+        cache = EvalCache(3, capacity = 8, shared = True)
+        try:
+            cache.sync(1)
+            cache.put(2 ** 63 + 5, [0.5, 0.5, 0], 0.25)
+
+            # A copy (as sent to another process) attaches to the same memory
+            other = pickle.loads(pickle.dumps(cache))
+            pi, v = other.get(2 ** 63 + 5)
+            np.testing.assert_array_equal(pi, [0.5, 0.5, 0])
+            self.assertEqual(v, 0.25)
+            other.put(7, [0, 0, 1], -1)
+            self.assertEqual(cache.get(7)[1], -1)
+            self.assertIsNone(cache.get(15))  # same slot as 7
+
+            # New weights don't see the old entries, and a process still on the old ones neither clears nor
+            # overwrites the new entries
+            cache.sync(2)
+            self.assertEqual(len(cache), 0)
+            self.assertIsNone(cache.get(7))
+            cache.put(7, [0, 1, 0], 0.5)
+            other.sync(1)
+            other.put(7, [0, 0, 1], -1)
+            self.assertIsNone(other.get(7))
+            self.assertEqual(cache.get(7)[1], 0.5)
+            self.assertEqual(len(cache), 1)
+
+            # A half written (or mixed up) entry doesn't match its checksum
+            cache.values[7 % 8] = 1
+            self.assertIsNone(cache.get(7))
+            other.close()
+        finally:
+            cache.close()
+
+
+class TestNodeTable(unittest.TestCase):
+    def test_add_and_grow(self):
+        nodes = NodeTable(node_capacity=2, edge_capacity=4)
+        for key in range(10):
+            nodes.add(key, np.arange(key), np.full(key, 0.5))
+        self.assertEqual(len(nodes), 10)
+        self.assertEqual(nodes.get(11), -1)
+
+        node = nodes.get(7)
+        np.testing.assert_array_equal(nodes.edge_action[nodes.edges(node)], np.arange(7))
+        nodes.edge_visits[nodes.edges(node)] = 3
+        np.testing.assert_array_equal(nodes.action_visits(node, 9), [3] * 7 + [0, 0])
+
+    def test_keep_subtree(self):
+        nodes = NodeTable()
+        a = nodes.add('a', [0, 1], [0.5, 0.5])
+        b = nodes.add('b', [2], [1])
+        c = nodes.add('c', ended = 1)
+        d = nodes.add('d', [3, 4], [0.2, 0.8])
+        nodes.link(nodes.edge_start[a], b)
+        nodes.link(nodes.edge_start[a] + 1, d)
+        nodes.link(nodes.edge_start[b], c)
+        nodes.link(nodes.edge_start[b], d)  # a second card draw after the same move
+        nodes.edge_visits[nodes.edges(d)] = [1, 2]
+
+        self.assertEqual(nodes.keep_subtree(b), 1)
+        self.assertEqual(nodes.node_keys, ['b', 'c', 'd'])
+        self.assertEqual(nodes.get('a'), -1)
+        self.assertEqual(sorted(nodes.children(nodes.get('b'))), [nodes.get('c'), nodes.get('d')])
+        self.assertEqual(nodes.node_ended[nodes.get('c')], 1)
+        np.testing.assert_array_equal(nodes.action_visits(nodes.get('d'), 5), [0, 0, 0, 1, 2])
+        self.assertEqual(nodes.n_edges, 3)
+
+    def test_evict(self):
+        nodes = NodeTable()
+        root = nodes.add('root', [0, 1, 2], [0.2, 0.3, 0.5])
+        for i, visits in enumerate([5, 1, 3]):
+            child = nodes.add(i, [0], [1])
+            nodes.node_visits[child] = visits
+            nodes.link(nodes.edge_start[root] + i, child)
+        grandchild = nodes.add('grandchild')
+        nodes.link(nodes.edge_start[nodes.get(1)], grandchild)
+        nodes.node_visits[grandchild] = 10
+        nodes.edge_visits[nodes.edges(root)] = [6, 2, 4]
+
+        # Nodes are kept most visited first among the ones reachable through kept nodes
+        self.assertEqual(nodes.evict(root, max_nodes = 3), 2)
+        self.assertEqual(nodes.node_keys, ['root', 0, 2])
+        np.testing.assert_array_equal(nodes.edge_child[nodes.edges(0)], [1, -1, 2])
+        np.testing.assert_array_equal(nodes.edge_visits[nodes.edges(0)], [6, 2, 4])
+
+        self.assertEqual(nodes.evict(0, max_bytes = nodes.node_row_bytes + 3 * nodes.edge_row_bytes), 2)
+        self.assertEqual(nodes.node_keys, ['root'])
+        self.assertEqual(nodes.eviction_stats, {
+            'evictions': 2, 'nodes_evicted': 4, 'bytes_evicted': 4 * nodes.node_row_bytes + 3 * nodes.edge_row_bytes
+        })
+
+    def test_update_proofs(self):
+        nodes = NodeTable()
+        root = nodes.add('root', [0, 1], [0.5, 0.5])
+        child = nodes.add('child', [0], [1])
+        lost = nodes.add('lost', ended = -1)
+        nodes.link(nodes.edge_start[root], child)
+        nodes.link(nodes.edge_start[child], lost)
+
+        # From the child, the player can move into a state the other player has lost, so moving into the child loses
+        nodes.update_proofs([(root, nodes.edge_start[root]), (child, nodes.edge_start[child])])
+        self.assertEqual((nodes.node_solved[child], nodes.node_proof[child]), (True, 1))
+        self.assertEqual((nodes.edge_solved[nodes.edge_start[root]], nodes.edge_proof[nodes.edge_start[root]]), (True, -1))
+        self.assertFalse(nodes.node_solved[root])
+
+        # A card draw could have led somewhere else, unless the game ended on the score
+        nodes.edge_chance[nodes.edge_start[root] + 1] = True
+        nodes.link(nodes.edge_start[root] + 1, lost)
+        nodes.update_proofs([(root, nodes.edge_start[root] + 1)])
+        self.assertFalse(nodes.node_solved[root])
+
+        lost_on_score = nodes.add('lost on score', ended = -1, ended_by_score = True)
+        nodes.link(nodes.edge_start[root] + 1, lost_on_score)
+        nodes.edge_child[nodes.edge_start[root] + 1] = lost_on_score
+        nodes.update_proofs([(root, nodes.edge_start[root] + 1)])
+        self.assertEqual((nodes.node_solved[root], nodes.node_proof[root]), (True, 1))
+
+
+class TestMCTS(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.game = Game(game_variant=SplendorGameVariant.LEVEL_1_GRK)
+        self.nnet = UniformNNet(self.game)
+        self.args = dotdict({'numMCTSSims': 50, 'cpuct': 2})
+
+    def test_visit_counts(self):
+        mcts = MCTS(self.game, self.nnet, self.args)
+        before = self.game.states['main'].buffer.copy()
+        probs = mcts.getActionProb(1, temp=1)
+
+        valids = self.game.getValidMoves(None, 1, 'main')
+        self.assertAlmostEqual(sum(probs), 1)
+        self.assertTrue(all(valids[a] for a in range(len(probs)) if probs[a] > 0))
+
+        # The first simulation expands the root, every later one visits one of its children
+        root = mcts.nodes.get(self.game.stringRepresentation(1, 'main'))
+        self.assertEqual(mcts.nodes.node_visits[root], self.args.numMCTSSims - 1)
+        self.assertEqual(mcts.nodes.action_visits(root, self.game.getActionSize()).sum(), self.args.numMCTSSims - 1)
+        np.testing.assert_array_equal(self.game.states['main'].buffer, before)
+        self.assertEqual(mcts.undo_tokens, [])
+
+
+    def test_subtree_reuse(self):
+        mcts = MCTS(self.game, self.nnet, self.args)
+        mcts.getActionProb(1, temp=1)
+        n_nodes = len(mcts.nodes)
+
+        # The child's statistics carry over and the rest of the old tree is dropped
+        # (taking coins, so that the main state doesn't draw a card the search never saw)
+        root = mcts.nodes.get(self.game.stringRepresentation(1, 'main'))
+        edges = mcts.nodes.edges(root)
+        take_coins = mcts.nodes.edge_action[edges] > self.game.config.n_cards * 2 + 2
+        edge = edges.start + np.argmax(mcts.nodes.edge_visits[edges] * take_coins)
+        self.game.getNextState(None, 1, mcts.nodes.edge_action[edge], 'main')
+        child = mcts.nodes.get(self.game.stringRepresentation(2, 'main'))
+        child_visits = mcts.nodes.node_visits[child]
+        self.assertGreater(child_visits, 0)
+
+        mcts.reroot(2)
+        self.assertEqual(mcts.nodes.get(self.game.stringRepresentation(2, 'main')), 0)
+        self.assertEqual(mcts.nodes.node_visits[0], child_visits)
+        self.assertLess(len(mcts.nodes), n_nodes)
+
+        mcts.getActionProb(2, temp=1)
+        self.assertEqual(mcts.nodes.node_visits[0], child_visits + self.args.numMCTSSims)
+
+    def test_eval_cache(self):
+        nnet = CountingNNet(self.game)
+        MCTS(self.game, nnet, self.args).getActionProb(1, temp=1)
+        n_evaluated = nnet.n_evaluated
+        self.assertEqual(nnet.eval_cache.misses, n_evaluated)
+
+        # A new tree for the same position gets its first evaluations from the cache
+        MCTS(self.game, nnet, self.args).getActionProb(1, temp=1)
+        self.assertGreater(nnet.eval_cache.hits, 0)
+        self.assertLess(nnet.n_evaluated, 2 * n_evaluated)
+
+        # Until the weights change
+        nnet.weights_version += 1
+        n_evaluated = nnet.n_evaluated
+        MCTS(self.game, nnet, self.args).getActionProb(1, temp=1)
+        self.assertEqual(len(nnet.eval_cache), nnet.n_evaluated - n_evaluated)
+
+    def test_tree_size_limit(self):
+        self.args['numMCTSSims'] = 100
+        self.args['max_tree_nodes'] = 20
+        for threads in [1, 4]:
+            self.args['tree_parallel_threads'] = threads
+            mcts = MCTS(self.game, self.nnet, self.args)
+            probs = mcts.getActionProb(1, temp=1)
+            self.assertAlmostEqual(sum(probs), 1)
+
+            # The root and its statistics are never evicted. Each thread's simulation in progress when the limit was
+            # reached can add one more node
+            self.assertLessEqual(len(mcts.nodes), 20 + threads - 1)
+            self.assertGreater(mcts.nodes.eviction_stats['nodes_evicted'], 0)
+            root = mcts.nodes.get(self.game.stringRepresentation(1, 'main'))
+            self.assertEqual(mcts.nodes.node_visits[root], self.args.numMCTSSims - 1)
+            mcts.close()
+
+    def test_solver_stops_on_proven_root(self):
+        self.game = Game(game_variant=SplendorGameVariant.LEVEL_0_4U)
+        self.args['numMCTSSims'] = 400
+        self.args['mcts_solver'] = True
+        mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+
+        player = 1
+        while self.game.getGameEnded(None, player, 'main') == 0:
+            n_visits = mcts.nodes.clock
+            probs = mcts.getActionProb(player, temp=0)
+            root = mcts.nodes.get(self.game.stringRepresentation(player, 'main'))
+            if mcts.nodes.node_solved[root] and mcts.nodes.node_proof[root] == 1:
+                break
+            _, player = self.game.getNextState(None, player, int(np.argmax(probs)), 'main')
+        else:
+            self.fail("The solver never proved a win")
+
+        # The search stopped once the root was proven and plays a proven winning move
+        self.assertLess(mcts.nodes.clock - n_visits, self.args.numMCTSSims)
+        edges = mcts.nodes.edges(root)
+        winning = mcts.nodes.edge_action[edges][mcts.nodes.edge_solved[edges] & (mcts.nodes.edge_proof[edges] == 1)]
+        self.assertIn(int(np.argmax(probs)), winning)
+
+    def test_early_stop(self):
+        self.args['numMCTSSims'] = 200
+        self.args['early_stop'] = True
+        self.nnet = SkewedNNet(self.game)
+        mcts = MCTS(self.game, self.nnet, self.args)
+        probs = mcts.getActionProb(1, temp=0)
+
+        # The search stopped as soon as the runner-up couldn't catch up with the remaining simulations
+        root = mcts.nodes.get(self.game.stringRepresentation(1, 'main'))
+        visits = np.sort(mcts.nodes.edge_visits[mcts.nodes.edges(root)])
+        n_sims = mcts.nodes.node_visits[root] + 1
+        self.assertLess(n_sims, self.args.numMCTSSims)
+        self.assertGreater(visits[-1] - visits[-2], self.args.numMCTSSims - n_sims)
+        self.assertEqual(probs[int(mcts.nodes.edge_action[mcts.nodes.edges(root)][np.argmax(mcts.nodes.edge_visits[mcts.nodes.edges(root)])])], 1)
+
+        # A top-two gap of 3 standard deviations is enough with early_stop_z
+        del self.args['early_stop']
+        self.args['early_stop_z'] = 3
+        mcts = MCTS(self.game, self.nnet, self.args)
+        mcts.getActionProb(1, temp=0)
+        root = mcts.nodes.get(self.game.stringRepresentation(1, 'main'))
+        visits = np.sort(mcts.nodes.edge_visits[mcts.nodes.edges(root)])
+        self.assertGreaterEqual((visits[-1] - visits[-2]) / np.sqrt(visits[-1] + visits[-2]), 3)
+        self.assertLess(visits.sum(), 50)
+
+        # Training policies (temp=1) always get the full search
+        mcts = MCTS(self.game, self.nnet, self.args)
+        mcts.getActionProb(1, temp=1)
+        self.assertEqual(mcts.nodes.node_visits[mcts.nodes.get(self.game.stringRepresentation(1, 'main'))], self.args.numMCTSSims - 1)
+
+    def test_batched_leaves(self):
+        self.args['leaf_batch_size'] = 8
+        mcts = MCTS(self.game, self.nnet, self.args)
+        before = self.game.states['main'].buffer.copy()
+        probs = mcts.getActionProb(1, temp=1)
+        self.assertAlmostEqual(sum(probs), 1)
+
+        # Every iteration ends up as exactly one visit of the root, and no virtual loss is left behind
+        root = mcts.nodes.get(self.game.stringRepresentation(1, 'main'))
+        self.assertEqual(mcts.nodes.node_visits[root], self.args.numMCTSSims - 1)
+        self.assertFalse(mcts.nodes.node_virtual.any())
+        self.assertFalse(mcts.nodes.edge_virtual.any())
+        np.testing.assert_array_equal(self.game.states['main'].buffer, before)
+        self.assertEqual(mcts.undo_tokens, [])
+
+    def test_tree_parallel(self):
+        self.args['tree_parallel_threads'] = 4
+        mcts = MCTS(self.game, self.nnet, self.args)
+        before = self.game.states['main'].buffer.copy()
+        probs = mcts.getActionProb(1, temp=1)
+        self.assertAlmostEqual(sum(probs), 1)
+
+        # The root is expanded before the threads start and every later simulation visits one of its children
+        root = mcts.nodes.get(self.game.stringRepresentation(1, 'main'))
+        self.assertEqual(mcts.nodes.node_visits[root], self.args.numMCTSSims - 1)
+        self.assertFalse(mcts.nodes.node_virtual.any())
+        self.assertFalse(mcts.nodes.edge_virtual.any())
+        np.testing.assert_array_equal(self.game.states['main'].buffer, before)
+
+    def test_tree_parallel_error(self):
+        class FailingNNet(UniformNNet):
+            def predict_batch(self, boards):
+                raise RuntimeError("evaluation failed")
+
+        self.args['tree_parallel_threads'] = 4
+        mcts = MCTS(self.game, FailingNNet(self.game), self.args)
+        with self.assertRaises(RuntimeError):
+            mcts.getActionProb(1, temp=1)
+
+        # Every thread took its virtual losses back
+        self.assertFalse(mcts.nodes.node_virtual.any())
+        self.assertFalse(mcts.nodes.edge_virtual.any())
+
+    def test_root_parallel(self):
+        self.args['root_parallel_workers'] = 2
+        self.args['numMCTSSims'] = 21
+        mcts = MCTS(self.game, self.nnet, self.args)
+        before = self.game.states['main'].buffer.copy()
+        try:
+            probs = mcts.getActionProb(1, temp=1)
+            counts = mcts.root_parallel_visit_counts(1, 2)
+        finally:
+            mcts.close()
+
+        # Each worker spends its first simulation expanding the root
+        self.assertEqual(counts.sum(), self.args.numMCTSSims - 2)
+        valids = self.game.getValidMoves(None, 1, 'main')
+        self.assertAlmostEqual(sum(probs), 1)
+        self.assertTrue(all(valids[a] for a in range(len(probs)) if probs[a] > 0))
+        np.testing.assert_array_equal(self.game.states['main'].buffer, before)
+
+    def test_shared_root_parallel_pool(self):
+        self.args['root_parallel_workers'] = 2
+        self.args['early_stop'] = True
+        pool = RootParallelPool(self.game, SkewedNNet(self.game), self.args, 2)
+        try:
+            # MCTS objects given a pool use it and leave it running when closed
+            for _ in range(2):
+                mcts = MCTS(self.game, SkewedNNet(self.game), self.args, pool = pool)
+                counts = mcts.root_parallel_visit_counts(1, 2, stop_early = True)
+                mcts.close()
+                # The workers stopped early on the move the skewed policy prefers
+                self.assertLess(counts.sum(), self.args.numMCTSSims - 2)
+            self.assertEqual(sum(mcts.getActionProb(1, temp=0)), 1)
+        finally:
+            pool.close()
+
+    def test_onnx_root_parallel_pool(self):
+        try:
+            model = uniform_onnx_model(self.game.getBoardSize(), self.game.getActionSize())
+        except ImportError:
+            self.skipTest("onnx isn't installed")
+
+        self.args['root_parallel_workers'] = 2
+        pool = RootParallelPool(self.game, None, self.args, 2, model)
+        try:
+            # The workers predict with onnxruntime and never load torch
+            self.assertEqual(pool.pool.apply(torch_imported), False)
+            mcts = MCTS(self.game, self.nnet, self.args, pool = pool)
+            probs = mcts.getActionProb(1, temp=1)
+            self.assertAlmostEqual(sum(probs), 1)
+            self.assertEqual(pool.pool.apply(torch_imported), False)
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+import pickle
+import unittest
+
+import numpy as np
+
+from splendor.SplendorGame import SplendorGame as Game
+from splendor.config import SplendorGameVariant
+
+
+def play_random_moves(game, n_moves, m_or_b = 'main', player = 1):
+    """Plays up to n_moves random valid moves on m_or_b and returns the player to move next."""
+    for _ in range(n_moves):
+        valids = game.getValidMoves(None, player, m_or_b)
+        if game.getGameEnded(None, player, m_or_b, valid_moves=valids) != 0:
+            break
+        action = np.random.choice(np.where(valids == 1)[0])
+        _, player = game.getNextState(None, player, action, m_or_b)
+    return player
+
+
+class TestSplendorGameState(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.game = Game(game_variant=SplendorGameVariant.VANILLA)
+
+    def test_initial_state(self):
+        state = self.game.states['main']
+        self.assertEqual(state.board.sum(), 12)
+        self.assertEqual(state.nobles_board.sum(), 3)
+        self.assertEqual(state.coins.sum(), 0)
+        for level in [1, 2, 3]:
+            self.assertEqual(state.cards_left(level), self.game.layout.deck_ends[level - 1] - self.game.layout.deck_starts[level - 1] - 4)
+
+    def test_compiled_card_arrays(self):
+        config = self.game.config
+        for card_id, card in config.cards.items():
+            self.assertEqual(config.card_levels[card_id], card.level)
+            self.assertEqual(list(config.card_costs[card_id]), [card.cost[color] for color in 'wugrk'])
+            self.assertTrue(self.game.layout.deck_starts[card.level - 1] <= card_id < self.game.layout.deck_ends[card.level - 1])
+
+    def test_branch_is_independent_copy(self):
+        play_random_moves(self.game, 10)
+        self.game.reset_branch()
+        main = self.game.states['main']
+        branch = self.game.states['branch']
+        self.assertFalse(np.shares_memory(main.buffer, branch.buffer))
+        np.testing.assert_array_equal(self.game.getCanonicalForm(None, 1, 'main'), self.game.getCanonicalForm(None, 1, 'branch'))
+
+        before = main.buffer.copy()
+        play_random_moves(self.game, 10, m_or_b = 'branch')
+        np.testing.assert_array_equal(main.buffer, before)
+
+    def test_pickled_state_keeps_views(self):
+        play_random_moves(self.game, 10)
+        state = pickle.loads(pickle.dumps(self.game.states['main']))
+        np.testing.assert_array_equal(state.buffer, self.game.states['main'].buffer)
+        self.assertTrue(np.shares_memory(state.coins, state.buffer))
+        self.assertTrue(np.shares_memory(state.canonical, state.buffer))
+
+    def test_canonical_form_swaps_players(self):
+        play_random_moves(self.game, 20)
+        state = self.game.states['main']
+        n_cards = self.game.config.n_cards
+
+        canonical_1 = self.game.getCanonicalForm(None, 1, 'main')
+        canonical_2 = self.game.getCanonicalForm(None, 2, 'main')
+        self.assertEqual(len(canonical_1), self.game.getBoardSize())
+        self.assertEqual(len(canonical_2), self.game.getBoardSize())
+
+        np.testing.assert_array_equal(canonical_2[:n_cards], state.board)
+        np.testing.assert_array_equal(canonical_2[n_cards:n_cards * 2], state.reserved[1])
+        np.testing.assert_array_equal(canonical_2[n_cards * 2:n_cards * 3], state.reserved[0])
+        np.testing.assert_array_equal(canonical_1[n_cards * 3 + 10:n_cards * 3 + 16], state.coins[0])
+        np.testing.assert_array_equal(canonical_2[n_cards * 3 + 10:n_cards * 3 + 16], state.coins[1])
+        self.assertEqual(canonical_1[n_cards * 3 + 24], 1)
+        self.assertEqual(canonical_2[n_cards * 3 + 24], -1)
+
+    def test_canonical_form_is_maintained_view(self):
+        layout = self.game.layout
+        canonical_1 = self.game.getCanonicalForm(None, 1, 'main')
+        canonical_2 = self.game.getCanonicalForm(None, 2, 'main')
+        self.assertFalse(canonical_1.flags.writeable)
+
+        for _ in range(10):
+            play_random_moves(self.game, 3)
+            state = self.game.states['main']
+            # The views follow the state, and player 2's matches a fresh gather of the buffer
+            expected_2 = state.buffer[layout.player_2_canonical_index].astype(int)
+            expected_2[layout.first_player] = -1
+            np.testing.assert_array_equal(canonical_1, state.buffer[:layout.canonical_size])
+            np.testing.assert_array_equal(canonical_2, expected_2)
+
+    def test_buy_takes_noble_opponent_is_closest_to(self):
+        state = self.game.states['main']
+        costs = self.game.config.noble_costs
+        # Two nobles the player qualifies for, one the opponent is closer to
+        first, second = [i for i in range(len(costs)) if (costs[i] <= [0, 0, 4, 4, 4]).all()][:2]
+        state.nobles_board[:] = 0
+        state.nobles_board[[first, second]] = 1
+        state.perma_gems[0] = [0, 0, 4, 4, 4]
+        state.perma_gems[1] = np.minimum(costs[second], 3)
+        state.coins[0] = [4, 4, 4, 4, 4, 5]
+
+        card_id = int(np.where(state.board == 1)[0][0])
+        self.game.getNextState(None, 1, card_id, 'main')
+
+        self.assertEqual(state.gained_nobles[0][second], 1)
+        self.assertEqual(state.gained_nobles[0].sum(), 1)
+        self.assertEqual(state.nobles_board[first], 1)
+        self.assertEqual(state.nobles_board[second], 0)
+        self.assertEqual(state.scores[0], self.game.config.card_points[card_id] + self.game.config.noble_points[second])
+
+    def test_random_outcomes(self):
+        game = self.game
+        game.reset_branch()
+        state = game.states['branch']
+        level = 1
+        state.deck_pointers[level - 1] = game.layout.deck_ends[level - 1]  # nothing left to draw
+        card_id = int(np.where(state.board[:game.config.n_level_1_cards] == 1)[0][0])
+        before = game.randomOutcomes()
+
+        # Reserving with 10 coins throws one away at random, even with no card to draw
+        state.coins[0] = [2, 2, 2, 2, 2, 0]
+        token = game.apply(game.config.n_cards + card_id, 1)
+        self.assertEqual(state.coins[0].sum(), 10)
+        self.assertEqual(game.randomOutcomes(), before + 1)
+        game.undo(token)
+
+        state.coins[0] = [1, 1, 1, 1, 1, 0]
+        game.apply(game.config.n_cards + card_id, 1)
+        self.assertEqual(game.randomOutcomes(), before + 1)
+
+
+class TestApplyUndo(unittest.TestCase):
+    def test_undo_restores_state(self):
+        np.random.seed(1)
+        for variant in [SplendorGameVariant.LEVEL_1_GRK, SplendorGameVariant.VANILLA]:
+            game = Game(game_variant=variant)
+            for _ in range(20):
+                game.reset_main()
+                play_random_moves(game, np.random.randint(30))
+                game.reset_branch()
+                start = game.states['branch'].buffer.copy()
+
+                # Walk a random line down and back up again
+                player = 1
+                tokens = []
+                for _ in range(15):
+                    valids = game.getValidMoves(None, player, 'branch')
+                    if valids.sum() == 0:
+                        break
+                    tokens.append(game.apply(np.random.choice(np.where(valids == 1)[0]), player))
+                    player = game.switch_player(player)
+                for token in reversed(tokens):
+                    game.undo(token)
+
+                np.testing.assert_array_equal(game.states['branch'].buffer, start)
+
+
+    def test_branch_draws_from_unseen_cards(self):
+        np.random.seed(5)
+        game = Game(game_variant=SplendorGameVariant.VANILLA)
+        play_random_moves(game, 10)
+        main = game.states['main']
+        level = 1
+        unseen = set(main.deck[main.deck_pointers[level - 1]:game.layout.deck_ends[level - 1]].tolist())
+        before = main.buffer.copy()
+
+        game.reset_branch()
+        drawn = set()
+        blind_reserve = game.config.n_cards * 2 + level - 1
+        for _ in range(200):
+            token = game.apply(blind_reserve, 1)
+            drawn.add(int(np.where(game.states['branch'].reserved[0] != main.reserved[0])[0][0]))
+            game.undo(token)
+
+        # Random picks among the cards main hasn't drawn yet, and main's own deck order is untouched
+        self.assertTrue(drawn <= unseen)
+        self.assertGreater(len(drawn), 1)
+        np.testing.assert_array_equal(main.buffer, before)
+
+
+class TestStep(unittest.TestCase):
+    def test_step_matches_separate_calls(self):
+        np.random.seed(4)
+        game = Game(game_variant=SplendorGameVariant.VANILLA)
+        for _ in range(5):
+            game.reset_main()
+            _, valid_mask, ended, _ = game.observe(1)
+            player = 1
+            while ended == 0:
+                action = np.random.choice(np.where(valid_mask == 1)[0])
+                canonical, valid_mask, ended, key, next_player = game.step(action, player)
+
+                self.assertEqual(next_player, game.switch_player(player))
+                player = next_player
+                np.testing.assert_array_equal(canonical, game.getCanonicalForm(None, player, 'main'))
+                np.testing.assert_array_equal(valid_mask, game.getValidMoves(None, player, 'main'))
+                self.assertEqual(ended, game.getGameEnded(None, player, 'main'))
+                self.assertEqual(key, game.stringRepresentation(player, 'main'))
+
+
+class TestStateHash(unittest.TestCase):
+    def test_incremental_hash_matches_recompute(self):
+        np.random.seed(2)
+        game = Game(game_variant=SplendorGameVariant.VANILLA, check_hash_collisions=True)
+        canonical_keys = game.zobrist_keys[0, :game.layout.canonical_size]
+        for _ in range(5):
+            game.reset_main()
+            player = 1
+            for _ in range(40):
+                state = game.states['main']
+                np.testing.assert_array_equal(state.hashes, game.compute_hashes(state))
+                for p in [1, 2]:
+                    # The hash only depends on the canonical form
+                    canonical = game.getCanonicalForm(None, p, 'main')
+                    expected = np.bitwise_xor.reduce(canonical_keys[np.arange(len(canonical)), canonical & 63])
+                    self.assertEqual(game.stringRepresentation(p, 'main'), int(expected))
+                player = play_random_moves(game, 1, player=player)
+
+    def test_undo_restores_hash(self):
+        np.random.seed(3)
+        game = Game(game_variant=SplendorGameVariant.VANILLA)
+        play_random_moves(game, 10)
+        game.reset_branch()
+        key = game.stringRepresentation(1, 'branch')
+        valids = game.getValidMoves(None, 1, 'branch')
+        token = game.apply(np.random.choice(np.where(valids == 1)[0]), 1)
+        game.undo(token)
+        self.assertEqual(game.stringRepresentation(1, 'branch'), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -69,11 +69,11 @@ class TestSplendorLearning(unittest.TestCase):
         
         # Patch the arena playGame method to track game lengths
         self.original_playGame = self.coach.game.getGameEnded
-        def patched_getGameEnded(board, player, m_or_b, print_to_terminal=False):
-            result = self.original_playGame(board, player, m_or_b, print_to_terminal)
+        def patched_getGameEnded(board, player, m_or_b, print_to_terminal=False, valid_moves=None):
+            result = self.original_playGame(board, player, m_or_b, print_to_terminal, valid_moves)
             if result != 0 and hasattr(self.game, 'states') and 'main' in self.game.states:
                 # Only track completed games
-                self.game_lengths.append(len(self.game.states['main'].gained_nobles[1]) + len(self.game.states['main'].gained_nobles[2]))
+                self.game_lengths.append(int(self.game.states['main'].gained_nobles.sum()))
             return result
         
         self.coach.game.getGameEnded = patched_getGameEnded
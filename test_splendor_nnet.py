@@ -0,0 +1,111 @@
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from MCTS import MCTS
+from splendor import NNet
+from splendor.NNet import NNetWrapper
+from splendor.SplendorGame import SplendorGame as Game
+from splendor.config import SplendorGameVariant
+from utils import dotdict
+
+
+class TestNNetWrapper(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.game = Game(game_variant=SplendorGameVariant.LEVEL_1_GRK)
+        self.nnet = NNetWrapper(self.game)
+
+    def random_boards(self, n_boards):
+        # Canonical boards of random positions
+        boards = []
+        player = 1
+        for _ in range(n_boards):
+            boards.append(self.game.getCanonicalForm(None, player, 'main').copy())
+            valids = self.game.getValidMoves(None, player, 'main')
+            _, player = self.game.getNextState(None, player, np.random.choice(np.where(valids)[0]), 'main')
+        return np.array(boards)
+
+    def test_predict_batch(self):
+        boards = self.random_boards(8)
+        for dtype in [np.int8, np.int16, np.int64]:
+            pis, vs = self.nnet.predict_batch(boards.astype(dtype))
+            self.assertEqual((pis.dtype, vs.dtype), (np.float32, np.float32))
+            self.assertEqual(pis.shape, (8, self.game.getActionSize()))
+            self.assertEqual(vs.shape, (8,))
+            np.testing.assert_allclose(pis.sum(1), 1, rtol=1e-5)
+
+        # predict is a batch of one
+        pi, v = self.nnet.predict(boards[3])
+        np.testing.assert_allclose(pi, pis[3], rtol=1e-5)
+        self.assertAlmostEqual(v, vs[3], places=5)
+
+    def test_inference_net_matches_nnet(self):
+        # Give the batch norms running statistics to fold
+        self.nnet.nnet.train()
+        with torch.no_grad():
+            for _ in range(5):
+                self.nnet.nnet(torch.randn(64, self.game.getBoardSize()) * 3 + 1)
+
+        boards = self.random_boards(8)
+        self.nnet.nnet.eval()
+        with torch.no_grad():
+            log_pis, vs = self.nnet.nnet(torch.FloatTensor(boards.astype(np.float32)))
+        pis, values = self.nnet.predict_batch(boards)
+        np.testing.assert_allclose(pis, np.exp(log_pis.numpy()), rtol=1e-4, atol=1e-7)
+        np.testing.assert_allclose(values, vs.numpy()[:, 0], rtol=1e-4, atol=1e-6)
+
+        # Loading other weights rebuilds it
+        with tempfile.TemporaryDirectory() as folder:
+            other = NNetWrapper(self.game)
+            other.save_checkpoint(folder=folder, filename='other.pth.tar')
+            self.nnet.load_checkpoint(folder=folder, filename='other.pth.tar')
+        np.testing.assert_allclose(self.nnet.predict_batch(boards)[0], other.predict_batch(boards)[0], rtol=1e-5)
+
+    def test_quantized_predictions(self):
+        boards = self.random_boards(32)
+        error = self.nnet.check_quantization(boards)
+        self.assertLess(error['policy_kl'], 1e-3)
+        self.assertLess(error['value_mae'], 1e-2)
+
+        pis, vs = self.nnet.predict_batch(boards)
+        NNet.args['quantize'] = True
+        try:
+            self.nnet.inference_net = None
+            quantized_pis, quantized_vs = self.nnet.predict_batch(boards)
+        finally:
+            NNet.args['quantize'] = False
+        np.testing.assert_allclose(quantized_pis.sum(1), 1, rtol=1e-5)
+        np.testing.assert_allclose(quantized_vs, vs, atol=0.05)
+
+    def test_onnx_export(self):
+        try:
+            from splendor.OnnxNNet import OnnxNNetWrapper
+        except ImportError:
+            self.skipTest("onnxruntime isn't installed")
+
+        boards = self.random_boards(8)
+        pis, vs = self.nnet.predict_batch(boards)
+        with tempfile.TemporaryDirectory() as folder:
+            self.nnet.export_onnx(folder=folder, filename='best.onnx')
+            onnx_nnet = OnnxNNetWrapper(self.game)
+            onnx_nnet.load_checkpoint(folder=folder, filename='best.onnx')
+        onnx_pis, onnx_vs = onnx_nnet.predict_batch(boards)
+        self.assertEqual((onnx_pis.dtype, onnx_vs.dtype), (np.float32, np.float32))
+        np.testing.assert_allclose(onnx_pis, pis, rtol=1e-4, atol=1e-7)
+        np.testing.assert_allclose(onnx_vs, vs, rtol=1e-4, atol=1e-6)
+
+        # Root-parallel workers predicting from the exported model
+        args = dotdict({'numMCTSSims': 20, 'cpuct': 2, 'root_parallel_workers': 2, 'onnx_workers': True})
+        mcts = MCTS(self.game, self.nnet, args)
+        try:
+            probs = mcts.getActionProb(1, temp=1)
+        finally:
+            mcts.close()
+        self.assertAlmostEqual(sum(probs), 1)
+        self.assertIsNone(mcts.pool)
+
+if __name__ == '__main__':
+    unittest.main()
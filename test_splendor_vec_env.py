@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+
+from splendor.SplendorGame import SplendorGame as Game, SplendorGameState
+from splendor.SplendorVecEnv import SplendorVecEnv
+from splendor.config import SplendorGameVariant
+
+
+class TestSplendorVecEnv(unittest.TestCase):
+    def check_against_game(self, variant, n_envs, n_steps):
+        game = Game(game_variant=variant)
+        env = SplendorVecEnv(game, n_envs, seed=0)
+        rng = np.random.default_rng(1)
+
+        canonical, valids, ended, keys = env.observe()
+        for _ in range(n_steps):
+            # Every game matches what SplendorGame makes of the same state
+            for i in range(n_envs):
+                game.states['main'].load(env.get_state(i))
+                player = env.players[i]
+                game_canonical, game_valids, game_ended, game_key = game.observe(player)
+                np.testing.assert_array_equal(canonical[i], game_canonical)
+                np.testing.assert_array_equal(valids[i], game_valids)
+                self.assertEqual(ended[i], game_ended)
+                self.assertEqual(keys[i], game_key)
+
+            done = np.where(ended != 0)[0]
+            if len(done):
+                env.reset(done)
+                canonical, valids, ended, keys = env.observe()
+
+            actions = np.array([rng.choice(np.where(v == 1)[0]) for v in valids])
+            before = env.buffer.copy()
+            players = env.players.copy()
+            canonical, valids, ended, keys, next_players = env.step(actions)
+            np.testing.assert_array_equal(next_players, 3 - players)
+
+            for i in range(n_envs):
+                game.states['main'].load(SplendorGameState(game.layout, before[i].copy()))
+                game.getNextState(None, players[i], actions[i], 'main')
+                expected = game.states['main']
+                state = env.get_state(i)
+                if (expected.coins != state.coins).any():
+                    # A reserve that pushed the player over 10 coins threw away a random color
+                    p = players[i] - 1
+                    self.assertTrue(game.config.n_cards <= actions[i] < game.config.n_cards * 2)
+                    self.assertEqual(expected.coins[p].sum(), state.coins[p].sum())
+                    continue
+                np.testing.assert_array_equal(expected.buffer, state.buffer)
+
+    def test_matches_game_level_1(self):
+        self.check_against_game(SplendorGameVariant.LEVEL_1_GRK, 16, 150)
+
+    def test_matches_game_vanilla(self):
+        self.check_against_game(SplendorGameVariant.VANILLA, 16, 150)
+
+    def test_reset_deals_cards(self):
+        game = Game(game_variant=SplendorGameVariant.VANILLA)
+        env = SplendorVecEnv(game, 8, seed=2)
+        np.testing.assert_array_equal(env.board.sum(1), 12)
+        np.testing.assert_array_equal(env.nobles_board.sum(1), 3)
+        for level in [1, 2, 3]:
+            start, end = game.layout.deck_starts[level - 1], game.layout.deck_ends[level - 1]
+            np.testing.assert_array_equal(np.sort(env.deck[:, start:end], axis=1), np.tile(np.arange(start, end), (8, 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()